@@ -13,66 +13,14 @@ import torch.optim as optim
 from lib.adv_model import *
 from lib.cifar_resnet import *
 from lib.dataset_utils import *
+from lib.distributed import (cleanup_distributed, init_distributed,
+                             is_main_process, launched_distributed, wrap_ddp)
+from lib.trainer import Trainer, adv_classification_step
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
 
-def evaluate(net, dataloader, criterion, device, adv=False):
-
-    net.eval()
-    val_loss = 0
-    val_correct = 0
-    val_total = 0
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(dataloader):
-            inputs, targets = inputs.to(device), targets.to(device)
-            outputs = net(inputs, targets, attack=adv)
-            loss = criterion(outputs, targets)
-            val_loss += loss.item()
-            _, predicted = outputs.max(1)
-            val_total += targets.size(0)
-            val_correct += predicted.eq(targets).sum().item()
-
-    return val_loss / val_total, val_correct / val_total
-
-
-def train(net, trainloader, validloader, criterion, optimizer, epoch, device,
-          log, save_best_only=True, best_loss=1e9, model_path='./model.pt'):
-
-    net.train()
-    train_loss = 0
-    train_correct = 0
-    train_total = 0
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), targets.to(device)
-        optimizer.zero_grad()
-        outputs = net(inputs, targets, attack=True)
-        loss = criterion(outputs, targets)
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss.item()
-        _, predicted = outputs.max(1)
-        train_total += targets.size(0)
-        train_correct += predicted.eq(targets).sum().item()
-
-    adv_loss, adv_acc = evaluate(net, validloader, criterion, device, adv=True)
-    val_loss, val_acc = evaluate(
-        net, validloader, criterion, device, adv=False)
-
-    log.info(' %5d | %.4f, %.4f | %.4f, %.4f | %.4f, %.4f | ', epoch,
-             train_loss / train_total, train_correct / train_total,
-             adv_loss, adv_acc, val_loss, val_acc)
-
-    # Save model weights
-    if not save_best_only or (save_best_only and adv_loss < best_loss):
-        log.info('Saving model...')
-        torch.save(net.state_dict(), model_path)
-        best_loss = adv_loss
-    return best_loss
-
-
 def main():
 
     # Set experiment id
@@ -95,13 +43,21 @@ def main():
     np.random.seed(seed)
     torch.manual_seed(seed)
 
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # run with torchrun to train with DistributedDataParallel, one process
+    # per GPU or several processes per CPU node (gloo backend)
+    distributed = launched_distributed()
+    if distributed:
+        device = init_distributed()
+    else:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
     # Set up model directory
     save_dir = os.path.join(os.getcwd(), 'saved_models')
-    if not os.path.isdir(save_dir):
+    if is_main_process() and not os.path.isdir(save_dir):
         os.makedirs(save_dir)
     model_path = os.path.join(save_dir, model_name + '.h5')
+    # resumable checkpoint with optimizer, scheduler, RNG and epoch state
+    checkpoint_path = os.path.join(save_dir, model_name + '.ckpt')
 
     # Get logger
     log_file = model_name + '.log'
@@ -110,11 +66,13 @@ def main():
     # Create formatter and add it to the handlers
     formatter = logging.Formatter(
         '[%(levelname)s %(asctime)s %(name)s] %(message)s')
-    # Create file handler
-    fh = logging.FileHandler(log_file, mode='w')
-    fh.setLevel(logging.DEBUG)
-    fh.setFormatter(formatter)
-    log.addHandler(fh)
+    if is_main_process():
+        # Create file handler (on the main process only)
+        # append so that a resumed run keeps the log of the earlier part
+        fh = logging.FileHandler(log_file, mode='a')
+        fh.setLevel(logging.DEBUG)
+        fh.setFormatter(formatter)
+        log.addHandler(fh)
 
     log.info(log_file)
     log.info(('CIFAR10 | exp_id: {}, seed: {}, init_learning_rate: {}, ' +
@@ -124,13 +82,10 @@ def main():
                   epochs, data_augmentation, subtract_pixel_mean))
 
     log.info('Preparing data...')
-    trainloader, validloader, testloader = load_cifar10(batch_size,
-                                                        data_dir='/data',
-                                                        val_size=0.1,
-                                                        normalize=False,
-                                                        augment=data_augmentation,
-                                                        shuffle=True,
-                                                        seed=seed)
+    trainloader, validloader, testloader = load_cifar10(
+        batch_size, data_dir='/data', val_size=0.1, normalize=False,
+        augment=data_augmentation, shuffle=True, seed=seed,
+        distributed=distributed)
 
     log.info('Building model...')
     net = PreActResNet(PreActBlock, [2, 2, 2, 2])
@@ -149,7 +104,9 @@ def main():
     net = PGDL2Model(net, config)
 
     net = net.to(device)
-    # if device == 'cuda':
+    if distributed:
+        net = wrap_ddp(net, device)
+    # elif device == 'cuda':
     #     net = torch.nn.DataParallel(net)
     #     cudnn.benchmark = True
 
@@ -158,20 +115,20 @@ def main():
     lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(
         optimizer, [80, 120, 160], gamma=0.1)
 
-    log.info(' epoch | loss  , acc    | adv_l , adv_a  | val_l , val_a |')
-    best_loss = 1e9
-    for epoch in range(epochs):
-        lr_scheduler.step()
-        best_loss = train(net, trainloader, validloader, criterion, optimizer,
-                          epoch, device, log, save_best_only=True,
-                          best_loss=best_loss, model_path=model_path)
+    adv_step = adv_classification_step(criterion, attack=True)
+    clean_step = adv_classification_step(criterion, attack=False)
+    trainer = Trainer(net, optimizer, adv_step, device=device,
+                      lr_scheduler=lr_scheduler, log=log,
+                      model_path=model_path, monitor='adv_loss', mode='min',
+                      checkpoint_path=checkpoint_path)
+    trainer.fit(trainloader, validloader, epochs,
+                eval_steps={'adv': adv_step, 'val': clean_step}, resume=True)
 
-    test_loss, test_acc = evaluate(
-        net, testloader, criterion, device, adv=False)
+    test_loss, test_acc = trainer.evaluate(testloader, clean_step)
     log.info('Test loss: %.4f, Test acc: %.4f', test_loss, test_acc)
-    test_loss, test_acc = evaluate(
-        net, testloader, criterion, device, adv=True)
+    test_loss, test_acc = trainer.evaluate(testloader, adv_step)
     log.info('Test adv loss: %.4f, Test adv acc: %.4f', test_loss, test_acc)
+    cleanup_distributed()
 
 
 if __name__ == '__main__':
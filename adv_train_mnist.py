@@ -13,66 +13,12 @@ import torch.optim as optim
 from lib.adv_model import *
 from lib.dataset_utils import *
 from lib.mnist_model import *
+from lib.trainer import Trainer, adv_classification_step, adv_training_step
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
 
-def evaluate(net, dataloader, criterion, device, adv=False):
-
-    net.eval()
-    val_loss = 0
-    val_correct = 0
-    val_total = 0
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(dataloader):
-            inputs, targets = inputs.to(device), inputs.to(device)
-            outputs = net(inputs, targets, attack=adv)
-            loss = criterion(outputs, targets)
-            val_loss += loss.item()
-            _, predicted = outputs.max(1)
-            val_total += targets.size(0)
-            val_correct += predicted.eq(targets).sum().item()
-
-    return val_loss / val_total, val_correct / val_total
-
-
-def train(net, trainloader, validloader, criterion, optimizer, epoch, device,
-          log, save_best_only=True, best_loss=1e9, model_path='./model.pt'):
-
-    net.train()
-    train_loss = 0
-    train_correct = 0
-    train_total = 0
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), inputs.to(device)
-        optimizer.zero_grad()
-        outputs = net(inputs, targets, attack=True)
-        loss = criterion(outputs, targets)
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss.item()
-        _, predicted = outputs.max(1)
-        train_total += targets.size(0)
-        train_correct += predicted.eq(targets).sum().item()
-
-    adv_loss, adv_acc = evaluate(net, validloader, criterion, device, adv=True)
-    val_loss, val_acc = evaluate(
-        net, validloader, criterion, device, adv=False)
-
-    log.info(' %5d | %.4f, %.4f | %.4f, %.4f | %.4f, %.4f | ', epoch,
-             train_loss / train_total, train_correct / train_total,
-             adv_loss, adv_acc, val_loss, val_acc)
-
-    # Save model weights
-    if not save_best_only or (save_best_only and adv_loss < best_loss):
-        log.info('Saving model...')
-        torch.save(net.state_dict(), model_path)
-        best_loss = adv_loss
-    return best_loss
-
-
 def main():
 
     # Set experiment id
@@ -138,10 +84,13 @@ def main():
     #           'random_start': True,
     #           'loss_func': 'xent'}
     # net = PGDModel(basic_net, config)
+    # train_mode is one of 'pgd', 'free', 'fgsm' or 'yopo' (see
+    # lib/adv_model.py). With 'free', divide epochs by num_replays.
     config = {'num_steps': 40,
               'step_size': 0.1,
               'random_start': True,
-              'loss_func': 'xent'}
+              'loss_func': 'xent',
+              'train_mode': 'pgd'}
     net = PGDL2Model(basic_net, config)
 
     net = net.to(device)
@@ -154,19 +103,17 @@ def main():
     lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(
         optimizer, [40, 50, 60], gamma=0.1)
 
-    log.info(' epoch | loss  , acc    | adv_l , adv_a  | val_l , val_a |')
-    best_loss = 1e9
-    for epoch in range(epochs):
-        lr_scheduler.step()
-        best_loss = train(net, trainloader, validloader, criterion, optimizer,
-                          epoch, device, log, save_best_only=True,
-                          best_loss=best_loss, model_path=model_path)
+    adv_step = adv_classification_step(criterion, attack=True)
+    clean_step = adv_classification_step(criterion, attack=False)
+    trainer = Trainer(net, optimizer, adv_training_step(), device=device,
+                      lr_scheduler=lr_scheduler, log=log,
+                      model_path=model_path, monitor='adv_loss', mode='min')
+    trainer.fit(trainloader, validloader, epochs,
+                eval_steps={'adv': adv_step, 'val': clean_step})
 
-    test_loss, test_acc = evaluate(
-        net, testloader, criterion, device, adv=False)
+    test_loss, test_acc = trainer.evaluate(testloader, clean_step)
     log.info('Test loss: %.4f, Test acc: %.4f', test_loss, test_acc)
-    test_loss, test_acc = evaluate(
-        net, testloader, criterion, device, adv=True)
+    test_loss, test_acc = trainer.evaluate(testloader, adv_step)
     log.info('Test adv loss: %.4f, Test adv acc: %.4f', test_loss, test_acc)
 
 
@@ -13,58 +13,12 @@ import torch.optim as optim
 from lib.adv_model import *
 from lib.dataset_utils import *
 from lib.mnist_model import *
+from lib.trainer import Trainer
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
 
-def evaluate(net, dataloader, criterion, device, adv=False):
-
-    net.eval()
-    val_loss = 0
-    val_total = 0
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(dataloader):
-            inputs, targets = inputs.to(device), inputs.to(device)
-            _, outputs = net(inputs, targets, attack=adv)
-            loss = criterion(outputs, targets)
-            val_loss += loss.item()
-            val_total += targets.size(0)
-
-    return val_loss / val_total
-
-
-def train(net, trainloader, validloader, criterion, optimizer, epoch, device,
-          log, save_best_only=True, best_loss=1e9, model_path='./model.pt'):
-
-    net.train()
-    train_loss = 0
-    train_total = 0
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), inputs.to(device)
-        optimizer.zero_grad()
-        _, outputs = net(inputs, targets, attack=True)
-        loss = criterion(outputs, targets)
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss.item()
-        train_total += targets.size(0)
-
-    adv_loss = evaluate(net, validloader, criterion, device, adv=True)
-    val_loss = evaluate(net, validloader, criterion, device, adv=False)
-
-    log.info(' %5d | %.4f | %.4f | %.4f | ',
-             epoch, train_loss / train_total, adv_loss, val_loss)
-
-    # Save model weights
-    if not save_best_only or (save_best_only and adv_loss < best_loss):
-        log.info('Saving model...')
-        torch.save(net.state_dict(), model_path)
-        best_loss = adv_loss
-    return best_loss
-
-
 def main():
 
     # Set experiment id
@@ -145,17 +99,23 @@ def main():
     lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(
         optimizer, [40, 50, 60], gamma=0.1)
 
-    log.info(' epoch | loss | adv_l | val_l |')
-    best_loss = 1e9
-    for epoch in range(epochs):
-        lr_scheduler.step()
-        best_loss = train(net, trainloader, validloader, criterion, optimizer,
-                          epoch, device, log, save_best_only=True,
-                          best_loss=best_loss, model_path=model_path)
+    def adv_step(net, inputs, targets):
+        _, outputs = net(inputs, inputs, attack=True)
+        return criterion(outputs, inputs), None
+
+    def clean_step(net, inputs, targets):
+        _, outputs = net(inputs, inputs, attack=False)
+        return criterion(outputs, inputs), None
+
+    trainer = Trainer(net, optimizer, adv_step, device=device,
+                      lr_scheduler=lr_scheduler, log=log,
+                      model_path=model_path, monitor='adv_loss', mode='min')
+    trainer.fit(trainloader, validloader, epochs,
+                eval_steps={'adv': adv_step, 'val': clean_step})
 
-    test_loss = evaluate(net, testloader, criterion, device, adv=False)
+    test_loss, _ = trainer.evaluate(testloader, clean_step)
     log.info('Test loss: %.4f', test_loss)
-    test_loss = evaluate(net, testloader, criterion, device, adv=True)
+    test_loss, _ = trainer.evaluate(testloader, adv_step)
     log.info('Test adv loss: %.4f', test_loss)
 
 
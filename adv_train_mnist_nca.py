@@ -14,70 +14,12 @@ from lib.dataset_utils import *
 from lib.dknn import DKNNL2
 from lib.lip_model import *
 from lib.mnist_model import *
+from lib.trainer import Trainer
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "1"
 
 
-def evaluate(net, dataloader, device, config, adv=False):
-
-    net.eval()
-    val_loss = 0
-    val_total = 0
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(dataloader):
-            inputs, targets = inputs.to(device), targets.to(device)
-            if adv:
-                outputs, outputs_adv = net.forward_adv(inputs, targets,
-                                                       config['step_size'],
-                                                       config['num_steps'],
-                                                       config['random_start'])
-                loss = net.loss_function(outputs_adv, targets, orig=outputs)
-            else:
-                outputs = net(inputs)
-                loss = net.loss_function(outputs, targets)
-            val_loss += loss.item()
-            val_total += 1
-
-    return val_loss / val_total
-
-
-def train(net, trainloader, validloader, optimizer, epoch, device, log, config,
-          save_best_only=True, best_loss=0, model_path='./model.pt'):
-
-    net.train()
-    train_loss = 0
-    train_total = 0
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), targets.to(device)
-        optimizer.zero_grad()
-        outputs, outputs_adv = net.forward_adv(inputs, targets,
-                                               config['step_size'],
-                                               config['num_steps'],
-                                               config['random_start'])
-        loss = net.loss_function(outputs_adv, targets, orig=outputs)
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss.item()
-        train_total += 1
-
-    adv_loss = evaluate(net, validloader, device, config, adv=True)
-    val_loss = evaluate(net, validloader, device, config, adv=False)
-
-    log.info(' %5d | %.4f | %8.4f | %8.4f', epoch,
-             train_loss / train_total, adv_loss, val_loss)
-
-    # Save model weights
-    log.info('Saving model...')
-    if (save_best_only and adv_loss < best_loss):
-        torch.save(net.state_dict(), model_path + '.h5')
-        best_loss = adv_loss
-    else:
-        torch.save(net.state_dict(), model_path + '_epoch{}.h5'.format(epoch))
-    return best_loss
-
-
 def predict(net, data, log):
     (x_train, y_train), (x_valid, y_valid), (x_test, y_test) = data
     layers = ['fc']
@@ -158,6 +100,8 @@ def main():
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
     model_path = os.path.join(save_dir, model_name)
+    # resumable checkpoint with optimizer, RNG and epoch state
+    checkpoint_path = model_path + '.ckpt'
 
     # Get logger
     log_file = model_name + '.log'
@@ -167,7 +111,8 @@ def main():
     formatter = logging.Formatter(
         '[%(levelname)s %(asctime)s %(name)s] %(message)s')
     # Create file handler
-    fh = logging.FileHandler(log_file, mode='w')
+    # append so that a resumed run keeps the log of the earlier part
+    fh = logging.FileHandler(log_file, mode='a')
     fh.setLevel(logging.DEBUG)
     fh.setFormatter(formatter)
     log.addHandler(fh)
@@ -197,22 +142,39 @@ def main():
 
     data = load_mnist_all('/data', val_size=0.1, seed=seed)
 
-    log.info(' epoch |   loss | adv_loss | val_loss')
-    best_loss = 1e5
-    for epoch in range(epochs):
+    # number of PGD steps grows with the epoch
+    config['num_steps'] = 0
+
+    def adv_step(net, inputs, targets):
+        outputs, outputs_adv = net.forward_adv(inputs, targets,
+                                               config['step_size'],
+                                               config['num_steps'],
+                                               config['random_start'])
+        return net.loss_function(outputs_adv, targets, orig=outputs), None
 
-        config = {'num_steps': epoch,
-                  'step_size': 0.1,
-                  'random_start': True}
+    def clean_step(net, inputs, targets):
+        outputs = net(inputs)
+        return net.loss_function(outputs, targets), None
 
-        best_loss = train(net, trainloader, validloader, optimizer,
-                          epoch, device, log, config, save_best_only=False,
-                          best_loss=best_loss, model_path=model_path)
+    def end_epoch(trainer, metrics):
+        # keep a snapshot of every epoch in addition to the best model
+        trainer.save(model_path + '_epoch{}.h5'.format(trainer.epoch - 1))
+        config['num_steps'] = trainer.epoch
         predict(net, data, log)
 
-    test_loss = evaluate(net, testloader, device, config, adv=True)
+    trainer = Trainer(net, optimizer, adv_step, device=device, log=log,
+                      model_path=model_path + '.h5', monitor='adv_loss',
+                      mode='min', checkpoint_path=checkpoint_path)
+    # continue the curriculum from where a preempted run stopped
+    trainer.resume()
+    config['num_steps'] = trainer.epoch
+    trainer.fit(trainloader, validloader, epochs,
+                eval_steps={'adv': adv_step, 'val': clean_step},
+                callbacks=[end_epoch])
+
+    test_loss, _ = trainer.evaluate(testloader, adv_step)
     log.info('Adv Test loss: %.4f', test_loss)
-    test_loss = evaluate(net, testloader, device, config, adv=False)
+    test_loss, _ = trainer.evaluate(testloader, clean_step)
     log.info('Test loss: %.4f', test_loss)
 
 
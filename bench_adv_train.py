@@ -0,0 +1,123 @@
+'''
+Compare adversarial training modes of lib/adv_model.py on MNIST: wall-clock
+training time until the model reaches a target accuracy under a fixed PGD
+attack. Evaluation time is not counted.
+'''
+from __future__ import print_function
+
+import logging
+import time
+
+import numpy as np
+import torch
+import torch.optim as optim
+
+from lib.adv_model import PGDModel
+from lib.dataset_utils import load_mnist
+from lib.mnist_model import BasicModel
+from lib.trainer import Trainer, adv_classification_step, adv_training_step
+
+# attack used to measure robust accuracy for every mode
+EVAL_CONFIG = {'epsilon': 0.3,
+               'num_steps': 40,
+               'step_size': 0.01,
+               'random_start': True,
+               'loss_func': 'xent',
+               'early_stop': True}
+
+# training config of each mode (epsilon is the same as EVAL_CONFIG)
+MODES = {
+    'pgd': {'train_mode': 'pgd', 'num_steps': 40, 'step_size': 0.01},
+    'free': {'train_mode': 'free', 'num_replays': 8, 'step_size': 0.3},
+    'fgsm': {'train_mode': 'fgsm', 'fgsm_step_size': 0.375},
+    'yopo': {'train_mode': 'yopo', 'yopo_outer': 5, 'yopo_inner': 3,
+             'step_size': 0.03},
+}
+
+
+def run_mode(name, mode_config, trainloader, evalloader, device, target_acc,
+             max_epochs, seed, log):
+    """Train a fresh model with one training mode until PGD accuracy on
+    <evalloader> reaches <target_acc>. Return (train time, epochs, acc)."""
+    torch.manual_seed(seed)
+    basic_net = BasicModel().to(device)
+    config = dict(EVAL_CONFIG, early_stop=False, **mode_config)
+    net = PGDModel(basic_net, config).to(device)
+    eval_net = PGDModel(basic_net, EVAL_CONFIG).to(device)
+    optimizer = optim.Adam(net.parameters(), lr=1e-3)
+    trainer = Trainer(net, optimizer, adv_training_step(), device=device,
+                      async_checkpoint=False)
+    eval_trainer = Trainer(eval_net, optimizer, None, device=device,
+                           async_checkpoint=False)
+    adv_step = adv_classification_step(torch.nn.CrossEntropyLoss())
+
+    # free adversarial training makes num_replays updates per batch, so one
+    # of its epochs counts as num_replays epochs
+    replays = config['num_replays'] if name == 'free' else 1
+    train_time = 0
+    acc = 0
+    epoch = 0
+    while epoch < max_epochs:
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        trainer.run_epoch(trainloader, train=True)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        train_time += time.time() - start
+        epoch += replays
+        eval_net.reset_attack_stats()
+        _, acc = eval_trainer.evaluate(evalloader, adv_step)
+        log.info('%5s | epoch %3d | train time %8.1fs | pgd acc %.4f | '
+                 'eval steps saved %.1f%%', name, epoch, train_time, acc,
+                 100 * eval_net.steps_saved())
+        if acc >= target_acc:
+            break
+    return train_time, epoch, acc
+
+
+def main():
+
+    batch_size = 128
+    target_acc = 0.85
+    max_epochs = 40
+    num_eval = 1000
+    modes = ['pgd', 'free', 'fgsm', 'yopo']
+    seed = 2019
+    np.random.seed(seed)
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    log = logging.getLogger('bench_adv_train')
+    log.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        '[%(levelname)s %(asctime)s %(name)s] %(message)s')
+    sh = logging.StreamHandler()
+    sh.setFormatter(formatter)
+    log.addHandler(sh)
+
+    trainloader, validloader, _ = load_mnist(
+        batch_size, data_dir='/data', val_size=0.1, shuffle=True, seed=seed)
+    x_eval, y_eval = validloader.dataset[:num_eval]
+    evalloader = torch.utils.data.DataLoader(
+        torch.utils.data.TensorDataset(x_eval, y_eval),
+        batch_size=batch_size)
+
+    results = {}
+    for name in modes:
+        results[name] = run_mode(name, MODES[name], trainloader, evalloader,
+                                 device, target_acc, max_epochs, seed, log)
+
+    log.info('Target PGD accuracy: %.2f', target_acc)
+    log.info(' mode | train time | epochs | pgd acc | speedup')
+    base_time = results['pgd'][0] if 'pgd' in results else None
+    for name in modes:
+        train_time, epochs, acc = results[name]
+        speedup = base_time / train_time if base_time else np.nan
+        reached = '' if acc >= target_acc else ' (target not reached)'
+        log.info('%5s | %9.1fs | %6d | %7.4f | %6.2fx%s', name, train_time,
+                 epochs, acc, speedup, reached)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+'''
+Throughput of CWL2Attack on MNIST BasicModel: images attacked per second,
+mean L2 norm of the successful adversarial examples and success rate for
+a few settings of the attack. The implementation of lib/cwl2_attack.py at
+another git revision (--ref, the root commit by default) is loaded with
+git show and benchmarked with the default settings as 'reference', and the
+speedup of each configuration is reported relative to it.
+'''
+from __future__ import print_function
+
+import argparse
+import importlib.util
+import logging
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from lib.cwl2_attack import CWL2Attack
+from lib.dataset_utils import load_mnist_all
+from lib.mnist_model import BasicModel
+
+# settings shared by every configuration (same as test_dknn.py)
+ATTACK_PARAMS = {'targeted': False,
+                 'binary_search_steps': 5,
+                 'max_iterations': 1000,
+                 'confidence': 0,
+                 'learning_rate': 1e-1,
+                 'initial_const': 1,
+                 'abort_early': True}
+
+# extra parameters of each configuration of CWL2Attack
+CONFIGS = {
+    'default': {},
+    'const-tol': {'const_tol': 1e-2},
+    'warm-start': {'warm_start': True, 'max_iterations': 200},
+}
+
+
+def root_commit():
+    return subprocess.check_output(
+        ['git', 'rev-list', '--max-parents=0', 'HEAD']).decode().split()[0]
+
+
+def load_reference(revision):
+    """Return the CWL2Attack class of lib/cwl2_attack.py at git <revision>"""
+    source = subprocess.check_output(
+        ['git', 'show', '%s:lib/cwl2_attack.py' % revision])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'cwl2_reference.py')
+        with open(path, 'wb') as f:
+            f.write(source)
+        spec = importlib.util.spec_from_file_location('cwl2_reference', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module.CWL2Attack
+
+
+def run_config(name, attack, params, net, x, y, batch_size, device, log):
+    """Attack (<x>, <y>) in batches of <batch_size>. Return (images per
+    second, mean L2 norm of the successful attacks, success rate)."""
+    x_adv = torch.zeros_like(x)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for begin in range(0, x.size(0), batch_size):
+        end = begin + batch_size
+        x_adv[begin:end] = attack(
+            net, x[begin:end].to(device), y[begin:end].to(device),
+            **params).detach().cpu()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    throughput = x.size(0) / (time.time() - start)
+
+    with torch.no_grad():
+        y_pred = net(x_adv.to(device)).argmax(1).cpu()
+    success = (y_pred != y).numpy()
+    dist = (x_adv - x).view(x.size(0), -1).norm(2, 1).numpy()
+    mean_dist = dist[success].mean() if success.any() else np.nan
+    log.info('%10s | %8.2f img/s | l2 %.4f | success %.4f', name, throughput,
+             mean_dist, success.mean())
+    return throughput, mean_dist, success.mean()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ref', default=None,
+                        help='git revision of the reference implementation '
+                        '(default is the root commit)')
+    args = parser.parse_args()
+    ref = args.ref if args.ref is not None else root_commit()
+
+    model_name = 'train_mnist_exp0.h5'
+    num = 1000
+    batch_size = 100
+    seed = 2019
+
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    log = logging.getLogger('bench_cwl2')
+    log.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        '[%(levelname)s %(asctime)s %(name)s] %(message)s')
+    sh = logging.StreamHandler()
+    sh.setFormatter(formatter)
+    log.addHandler(sh)
+
+    net = torch.nn.DataParallel(BasicModel())
+    model_path = os.path.join(os.getcwd(), 'saved_models', model_name)
+    net.load_state_dict(torch.load(model_path, map_location='cpu'))
+    net = net.module.to(device).eval()
+    for param in net.parameters():
+        param.requires_grad_(False)
+
+    (x_train, y_train), (x_valid, y_valid), (x_test, y_test) = load_mnist_all(
+        '/data', val_size=0.1, seed=seed)
+    x, y = x_test[:num], y_test[:num]
+
+    attacks = {name: (CWL2Attack(), dict(ATTACK_PARAMS, **params))
+               for name, params in CONFIGS.items()}
+    attacks['reference'] = (load_reference(ref)(), dict(ATTACK_PARAMS))
+    log.info('reference: lib/cwl2_attack.py at %s', ref)
+
+    results = {}
+    for name, (attack, params) in attacks.items():
+        torch.manual_seed(seed)
+        results[name] = run_config(name, attack, params, net, x, y,
+                                   batch_size, device, log)
+
+    log.info('    config |   img/s |     l2 | success | speedup')
+    base = results['reference'][0]
+    for name, (throughput, mean_dist, success) in results.items():
+        log.info('%10s | %7.2f | %.4f | %7.4f | %6.2fx', name, throughput,
+                 mean_dist, success, throughput / base)
+
+
+if __name__ == '__main__':
+    main()
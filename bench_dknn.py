@@ -0,0 +1,223 @@
+'''
+Benchmark suite of the DkNN hot paths: DKNNL2 index build time and memory,
+classify throughput for several batch sizes and k, credibility cost,
+find_guide_samples latency and iterations per second of DKNNL2Attack,
+DKNN_PGD and the black-box attack. The model has random weights and the data
+is random, so it runs offline on CPU. Each run is appended to a JSON history
+and compared with the last run of the same config to catch regressions.
+'''
+from __future__ import print_function
+
+import json
+import logging
+import os
+import subprocess
+import time
+
+import numpy as np
+import torch
+
+import faiss
+from lib.blackbox_attack import TrainCandidates, attack_untargeted
+from lib.dknn import DKNNL2
+from lib.dknn_attack_l2 import DKNNL2Attack
+from lib.dknn_attack_pgd import DKNN_PGD
+from lib.mnist_model import BasicModel
+from lib.profiler import Profiler
+
+CONFIG = {'seed': 2019,
+          'num_threads': 4,
+          'num_train': 2000,
+          'num_cal': 200,
+          'num_test': 512,
+          'layers': ['relu1', 'relu2', 'relu3'],
+          'k': 75,
+          'batch_sizes': [1, 16, 128, 512],
+          'ks': [1, 10, 75],
+          'attack_batch': 16,
+          'guide_m': 100,
+          'attack_iterations': 20,
+          'blackbox_iterations': 5}
+
+HISTORY = 'bench_history.json'
+# a metric is flagged if it is worse than the last run by this fraction
+TOLERANCE = 0.2
+
+
+def timeit(fn, repeat=3):
+    """Return the best wall time of <repeat> calls of fn()"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_build(net, x_train, y_train, x_cal, y_cal):
+    """Build time and index memory of DKNNL2"""
+    with Profiler() as prof:
+        start = time.perf_counter()
+        dknn = DKNNL2(net, x_train, y_train, x_cal, y_cal, CONFIG['layers'],
+                      k=CONFIG['k'], num_classes=10, device='cpu')
+        build_s = time.perf_counter() - start
+    index_bytes = sum(index.ntotal * index.d * 4 for index in dknn.indices)
+    results = {'build_s': build_s,
+               'index_mb': index_bytes / 2**20,
+               'build_peak_rss_mb': prof.report()['peak_rss_bytes'] / 2**20}
+    return dknn, results
+
+
+def bench_classify(dknn, x_test):
+    """classify throughput (samples per second) for each batch size and k
+    without the cache, of repeated samples served by the cache, and
+    credibility cost"""
+    results = {}
+    for k in CONFIG['ks']:
+        dknn.k = k
+        for batch_size in CONFIG['batch_sizes']:
+            x = x_test[:batch_size]
+            with torch.no_grad():
+                t = timeit(lambda: dknn.classify(x))
+            results['classify_k%d_b%d_per_s' % (k, batch_size)] = \
+                batch_size / t
+    dknn.k = CONFIG['k']
+
+    dknn.cache_size = x_test.size(0)
+    with torch.no_grad():
+        dknn.classify(x_test)
+        t = timeit(lambda: dknn.classify(x_test))
+    results['classify_cached_per_s'] = x_test.size(0) / t
+    dknn.cache_size = 0
+    dknn.clear_cache()
+
+    with torch.no_grad():
+        class_counts = dknn.classify(x_test)
+    t = timeit(lambda: dknn.credibility(class_counts))
+    results['credibility_per_s'] = x_test.size(0) / t
+    return results
+
+
+def bench_attacks(dknn, x_test, y_test, candidates):
+    """find_guide_samples latency and attack iterations per second"""
+    results = {}
+    num = CONFIG['attack_batch']
+    iterations = CONFIG['attack_iterations']
+    x, y = x_test[:num], y_test[:num]
+
+    results['find_guide_samples_s'] = timeit(
+        lambda: DKNNL2Attack.find_guide_samples(
+            dknn, x, y.numpy(), k=CONFIG['guide_m'],
+            layer=CONFIG['layers'][0]),
+        repeat=1)
+
+    attack = DKNNL2Attack()
+    t = timeit(lambda: attack(
+        dknn, x, y, guide_layer=CONFIG['layers'][0], m=CONFIG['guide_m'],
+        binary_search_steps=1, max_iterations=iterations,
+        abort_early=False), repeat=1)
+    results['dknn_l2_attack_it_per_s'] = iterations / t
+
+    attack = DKNN_PGD(dknn)
+    t = timeit(lambda: attack(
+        x, y, guide_layer=CONFIG['layers'][0], m=CONFIG['guide_m'],
+        max_iterations=iterations, rand_start=False,
+        check_adv_steps=iterations, verbose=False), repeat=1)
+    results['dknn_pgd_it_per_s'] = iterations / t
+
+    # attack a sample with the label DkNN predicts for it, so that the
+    # attack does not stop right away
+    x0 = x_test[0]
+    y0 = torch.tensor(dknn.predict(x0))
+    blackbox_iterations = CONFIG['blackbox_iterations']
+    t = timeit(lambda: attack_untargeted(
+        dknn, candidates, x0, y0, alpha=2, beta=0.005,
+        iterations=blackbox_iterations), repeat=1)
+    results['blackbox_it_per_s'] = blackbox_iterations / t
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, history, log):
+    """Compare <results> with the last run of the same config. Metrics
+    ending with '_per_s' are higher-is-better, others lower-is-better."""
+    previous = [h for h in history if h['config'] == CONFIG]
+    if not previous:
+        log.info('no previous run with this config')
+        return
+    last = previous[-1]
+    log.info('comparing with run of %s (commit %s)', last['time'],
+             last['commit'])
+    for name, value in sorted(results.items()):
+        old = last['results'].get(name)
+        if old is None or old == 0:
+            continue
+        ratio = value / old
+        worse = (1 / ratio if name.endswith('_per_s') else ratio) - 1
+        flag = 'REGRESSION' if worse > TOLERANCE else ''
+        log.info('%32s | %12.4f | %12.4f | %6.2fx %s', name, old, value,
+                 ratio, flag)
+
+
+def main():
+
+    np.random.seed(CONFIG['seed'])
+    torch.manual_seed(CONFIG['seed'])
+    torch.set_num_threads(CONFIG['num_threads'])
+    faiss.omp_set_num_threads(CONFIG['num_threads'])
+
+    log = logging.getLogger('bench_dknn')
+    log.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        '[%(levelname)s %(asctime)s %(name)s] %(message)s')
+    sh = logging.StreamHandler()
+    sh.setFormatter(formatter)
+    log.addHandler(sh)
+
+    # random weights and random data
+    net = BasicModel().eval()
+    for param in net.parameters():
+        param.requires_grad_(False)
+
+    def data(num):
+        return (torch.rand((num, 1, 28, 28)),
+                torch.randint(0, 10, (num, ), dtype=torch.long))
+
+    x_train, y_train = data(CONFIG['num_train'])
+    x_cal, y_cal = data(CONFIG['num_cal'])
+    x_test, y_test = data(CONFIG['num_test'])
+
+    results = {}
+    dknn, build = bench_build(net, x_train, y_train, x_cal, y_cal)
+    results.update(build)
+    results.update(bench_classify(dknn, x_test))
+    candidates = TrainCandidates(dknn, x_train)
+    results.update(bench_attacks(dknn, x_test, y_test, candidates))
+
+    for name, value in sorted(results.items()):
+        log.info('%32s | %12.4f', name, value)
+
+    history = []
+    if os.path.exists(HISTORY):
+        with open(HISTORY) as f:
+            history = json.load(f)
+    compare(results, history, log)
+    history.append({'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'commit': git_commit(),
+                    'torch': torch.__version__,
+                    'config': CONFIG,
+                    'results': results})
+    with open(HISTORY, 'w') as f:
+        json.dump(history, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
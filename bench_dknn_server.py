@@ -0,0 +1,70 @@
+'''
+Latency and throughput of DkNNServer on CPU with MNIST BasicModel: p50/p99
+latency of single-sample requests and requests served per second, for a few
+micro-batching settings. max_batch = 1 serves the requests one at a time.
+'''
+from __future__ import print_function
+
+import logging
+import os
+
+import numpy as np
+import torch
+
+from lib.dataset_utils import load_mnist_all
+from lib.dknn import DKNNL2
+from lib.dknn_server import benchmark
+from lib.mnist_model import BasicModel
+
+# (max_batch, max_wait, concurrency, rate) of each configuration, rate is
+# None for closed-loop clients
+CONFIGS = {
+    'unbatched': (1, 0, 16, None),
+    'batch-16': (16, 2e-3, 16, None),
+    'batch-64': (64, 2e-3, 64, None),
+    'batch-64-open': (64, 5e-3, None, 500),
+}
+
+
+def main():
+
+    model_name = 'train_mnist_exp0.h5'
+    layers = ['relu1', 'relu2', 'relu3']
+    num_requests = 2000
+    seed = 2019
+
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    device = 'cpu'
+
+    log = logging.getLogger('bench_dknn_server')
+    log.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        '[%(levelname)s %(asctime)s %(name)s] %(message)s')
+    sh = logging.StreamHandler()
+    sh.setFormatter(formatter)
+    log.addHandler(sh)
+
+    net = torch.nn.DataParallel(BasicModel())
+    model_path = os.path.join(os.getcwd(), 'saved_models', model_name)
+    net.load_state_dict(torch.load(model_path, map_location='cpu'))
+    net = net.module.to(device).eval()
+
+    (x_train, y_train), (x_valid, y_valid), (x_test, y_test) = load_mnist_all(
+        '/data', val_size=0.1, seed=seed)
+    # requests are drawn from the test set, so some of them repeat
+    dknn = DKNNL2(net, x_train, y_train, x_valid, y_valid, layers,
+                  k=75, num_classes=10, device=device, cache_size=10000)
+
+    log.info('        config |    p50 ms |    p99 ms |  req/s | mean batch')
+    for name, (max_batch, max_wait, concurrency, rate) in CONFIGS.items():
+        report = benchmark(dknn, x_test, num_requests, max_batch=max_batch,
+                           max_wait=max_wait, concurrency=concurrency,
+                           rate=rate)
+        log.info('%14s | %9.2f | %9.2f | %6.1f | %10.1f', name,
+                 report['p50'] * 1e3, report['p99'] * 1e3,
+                 report['throughput'], report['mean_batch'])
+
+
+if __name__ == '__main__':
+    main()
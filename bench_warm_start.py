@@ -0,0 +1,134 @@
+'''
+Compare DKNNL2Attack with and without warm-started binary search on MNIST:
+mean L2 norm of the adversarial examples, success rate, wall-clock time and
+number of forward passes (counted per sample) for each configuration.
+'''
+from __future__ import print_function
+
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+
+from lib.dataset_utils import load_mnist_all
+from lib.dknn import DKNNL2
+from lib.dknn_attack_l2 import DKNNL2Attack
+from lib.mnist_model import BasicModel
+
+# settings shared by every configuration (same as test_dknn.py)
+ATTACK_PARAMS = {'guide_layer': 'relu3',
+                 'm': 100,
+                 'learning_rate': 1e-1,
+                 'initial_const': 1e-3,
+                 'abort_early': True,
+                 'random_start': False}
+
+# (binary_search_steps, max_iterations, warm_start) of each configuration
+CONFIGS = {
+    'cold-10x500': (10, 500, False),
+    'warm-10x100': (10, 100, True),
+    'warm-10x50': (10, 50, True),
+    'cold-10x100': (10, 100, False),
+}
+
+
+class ForwardCounter(object):
+    """Forward hook that counts the samples passed through a module"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, module, inputs, output):
+        self.count += inputs[0].size(0)
+
+
+def run_config(name, config, dknn, counter, x, y, batch_size, device, log):
+    """Attack (<x>, <y>) with one configuration. Return (mean L2 norm of the
+    successful attacks, success rate, time, forward passes per sample)."""
+    binary_search_steps, max_iterations, warm_start = config
+    attack = DKNNL2Attack()
+    x_adv = torch.zeros_like(x)
+    counter.count = 0
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for begin in range(0, x.size(0), batch_size):
+        end = begin + batch_size
+        x_adv[begin:end] = attack(
+            dknn, x[begin:end].to(device), y[begin:end],
+            binary_search_steps=binary_search_steps,
+            max_iterations=max_iterations, warm_start=warm_start,
+            **ATTACK_PARAMS).cpu()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    attack_time = time.time() - start
+    forwards = counter.count / x.size(0)
+
+    with torch.no_grad():
+        y_pred = dknn.classify(x_adv.to(device)).argmax(1)
+    success = y_pred != y.numpy()
+    dist = (x_adv - x).view(x.size(0), -1).norm(2, 1).numpy()
+    mean_dist = dist[success].mean() if success.any() else np.nan
+    log.info('%12s | l2 %.4f | success %.4f | time %8.1fs | forward %8.0f',
+             name, mean_dist, success.mean(), attack_time, forwards)
+    return mean_dist, success.mean(), attack_time, forwards
+
+
+def main():
+
+    model_name = 'train_mnist_exp0.h5'
+    layers = ['relu3']
+    num = 200
+    batch_size = 100
+    seed = 2019
+
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    log = logging.getLogger('bench_warm_start')
+    log.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        '[%(levelname)s %(asctime)s %(name)s] %(message)s')
+    sh = logging.StreamHandler()
+    sh.setFormatter(formatter)
+    log.addHandler(sh)
+
+    net = torch.nn.DataParallel(BasicModel())
+    model_path = os.path.join(os.getcwd(), 'saved_models', model_name)
+    net.load_state_dict(torch.load(model_path, map_location='cpu'))
+    net = net.module.to(device).eval()
+    counter = ForwardCounter()
+    net.register_forward_hook(counter)
+
+    (x_train, y_train), (x_valid, y_valid), (x_test, y_test) = load_mnist_all(
+        '/data', val_size=0.1, seed=seed)
+    dknn = DKNNL2(net, x_train, y_train, x_valid, y_valid, layers,
+                  k=75, num_classes=10, device=device)
+
+    # attack test samples that are correctly classified
+    with torch.no_grad():
+        y_pred = dknn.classify(x_test[:2 * num])
+    ind = np.where(y_pred.argmax(1) == y_test[:2 * num].numpy())[0][:num]
+    x, y = x_test[ind], y_test[ind]
+
+    results = {}
+    for name in CONFIGS:
+        torch.manual_seed(seed)
+        results[name] = run_config(name, CONFIGS[name], dknn, counter, x, y,
+                                   batch_size, device, log)
+
+    log.info('      config |     l2 | success |       time | forward | '
+             'speedup')
+    base_time = results['cold-10x500'][2]
+    for name in CONFIGS:
+        mean_dist, success, attack_time, forwards = results[name]
+        log.info('%12s | %.4f | %7.4f | %9.1fs | %7.0f | %6.2fx', name,
+                 mean_dist, success, attack_time, forwards,
+                 base_time / attack_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,242 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+TRAIN_MODES = ('pgd', 'free', 'fgsm', 'yopo')
 
-class PGDModel(nn.Module):
+
+class _StopForward(Exception):
+    """Raised by the YOPO hook to stop a forward pass at the first layer"""
+
+    def __init__(self, output):
+        super(_StopForward, self).__init__()
+        self.output = output
+
+
+class AdvTrainModel(nn.Module):
+    """
+    Base class of the PGD wrappers. Implements the adversarial training modes
+    used by train_step(). The subclasses define the threat model through
+    _init_delta(), _ascend() and _project(), and may use another
+    projection for the PGD attack through _project_attack().
+
+    If config['early_stop'] is True, the PGD attack of forward(attack=True)
+    stops perturbing a sample as soon as it is misclassified, and samples
+    drop out of the batch as the attack succeeds. attack_stats counts the
+    sample-steps computed ('steps') out of the ones a full attack would take
+    ('max_steps').
+
+    Training modes (config['train_mode'], default is 'pgd'):
+    - 'pgd': full PGD attack (forward with attack=True), then one weight
+      update. Costs num_steps + 1 forward/backward passes per batch.
+    - 'free': "free" adversarial training (Shafahi et al., 2019). Each batch
+      is replayed config['num_replays'] times. Every replay does a single
+      backward pass whose gradient updates the weights and the perturbation,
+      which is carried over to the next batch. Divide the number of epochs
+      by num_replays to keep the same number of weight updates.
+    - 'fgsm': fast FGSM with random init (Wong et al., 2020). One gradient
+      step of size config['fgsm_step_size'] from a random start, then one
+      weight update.
+    - 'yopo': YOPO-m-n (Zhang et al., 2019). config['yopo_outer'] full
+      forward/backward passes accumulate the weight gradient. After each,
+      the gradient w.r.t. the output of the first layer is frozen and the
+      perturbation takes config['yopo_inner'] steps that only run the first
+      layer. The first layer is basic_net's first child module unless
+      config['yopo_layer'] names another one.
+    """
+
+    def _setup(self, config):
+        self.early_stop = config.get('early_stop', False)
+        self.reset_attack_stats()
+        self.train_mode = config.get('train_mode', 'pgd')
+        if self.train_mode not in TRAIN_MODES:
+            raise ValueError('Invalid train_mode (choose from %s)' %
+                             ', '.join(TRAIN_MODES))
+        self.num_replays = config.get('num_replays', 8)
+        self.fgsm_step_size = config.get('fgsm_step_size', None)
+        self.yopo_outer = config.get('yopo_outer', 5)
+        self.yopo_inner = config.get('yopo_inner', 3)
+        self.yopo_layer = config.get('yopo_layer', None)
+        # perturbation carried across batches by free adversarial training
+        self._free_delta = None
+        self._yopo_stop = False
+        self._yopo_grad = None
+
+    def reset_attack_stats(self):
+        self.attack_stats = {'steps': 0, 'max_steps': 0}
+
+    def steps_saved(self):
+        """Return the fraction of attack steps skipped by early stopping"""
+        if self.attack_stats['max_steps'] == 0:
+            return 0.
+        return 1. - self.attack_stats['steps'] / self.attack_stats['max_steps']
+
+    def forward(self, inputs, targets, attack=False):
+        if not attack:
+            return self.basic_net(inputs)
+
+        x = inputs.detach().clone()
+        if self.rand:
+            x = x + self._init_delta(x)
+        self.attack_stats['max_steps'] += x.size(0) * self.num_steps
+
+        # <active> holds the batch indices of the samples still attacked,
+        # <x_orig> and <y> their clean inputs and labels
+        active = torch.arange(x.size(0), device=x.device)
+        x_orig, y = inputs, targets
+        x_active = x.detach()
+        for _ in range(self.num_steps):
+            x_active.requires_grad_()
+            with torch.enable_grad():
+                logits = self.basic_net(x_active)
+                loss = F.cross_entropy(logits, y, reduction='sum')
+            grad = torch.autograd.grad(loss, x_active)[0].detach()
+            x_active = x_active.detach()
+            self.attack_stats['steps'] += x_active.size(0)
+
+            if self.early_stop:
+                # misclassified samples keep their current perturbation
+                keep = logits.detach().argmax(1).eq(y)
+                active, x_orig, y = active[keep], x_orig[keep], y[keep]
+                x_active, grad = x_active[keep], grad[keep]
+                if active.size(0) == 0:
+                    break
+
+            x_active = self._ascend(x_active, grad, self.step_size)
+            x_active = x_orig + self._project_attack(x_active - x_orig)
+            x_active = torch.clamp(x_active, 0, 1)
+            if self.early_stop:
+                x[active] = x_active
+            else:
+                x = x_active
+
+        return self.basic_net(x)
+
+    def _project_attack(self, delta):
+        """Threat model of the PGD attack of forward(attack=True)"""
+        return self._project(delta)
+
+    def train_step(self, inputs, targets, optimizer):
+        """Run one training iteration in self.train_mode. This does its own
+        zero_grad(), backward() and optimizer.step().
+
+        Returns
+        -------
+        loss : torch.tensor
+            training loss of the last weight update, averaged over the batch
+        logits : torch.tensor
+            logits the loss was computed on
+        """
+        if self.train_mode == 'free':
+            return self._train_free(inputs, targets, optimizer)
+        if self.train_mode == 'fgsm':
+            return self._train_fgsm(inputs, targets, optimizer)
+        if self.train_mode == 'yopo':
+            return self._train_yopo(inputs, targets, optimizer)
+        logits = self.forward(inputs, targets, attack=True)
+        loss = F.cross_entropy(logits, targets)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        return loss.detach(), logits.detach()
+
+    def _clip(self, delta, inputs):
+        """Project <delta> onto the threat model and keep inputs + delta in
+        the valid pixel range"""
+        delta = self._project(delta)
+        return torch.clamp(inputs + delta, 0, 1) - inputs
+
+    def _train_free(self, inputs, targets, optimizer):
+        delta = self._free_delta
+        if delta is None or delta.size() != inputs.size():
+            delta = torch.zeros_like(inputs)
+        for _ in range(self.num_replays):
+            delta.requires_grad_()
+            logits = self.basic_net(inputs + delta)
+            loss = F.cross_entropy(logits, targets)
+            optimizer.zero_grad()
+            # the same backward pass gives the weight and the input gradient
+            loss.backward()
+            grad = delta.grad.detach()
+            optimizer.step()
+            delta = self._ascend(delta.detach(), grad, self.step_size)
+            delta = self._clip(delta, inputs)
+        self._free_delta = delta.detach()
+        return loss.detach(), logits.detach()
+
+    def _train_fgsm(self, inputs, targets, optimizer):
+        step_size = self.fgsm_step_size
+        if step_size is None:
+            step_size = self._default_fgsm_step_size()
+        delta = self._clip(self._init_delta(inputs), inputs)
+        delta.requires_grad_()
+        loss = F.cross_entropy(self.basic_net(inputs + delta), targets)
+        grad = torch.autograd.grad(loss, delta)[0].detach()
+        delta = self._clip(self._ascend(delta.detach(), grad, step_size),
+                           inputs)
+
+        logits = self.basic_net(inputs + delta)
+        loss = F.cross_entropy(logits, targets)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        return loss.detach(), logits.detach()
+
+    def _get_yopo_layer(self):
+        if self.yopo_layer is not None:
+            return dict(self.basic_net.named_modules())[self.yopo_layer]
+        return next(self.basic_net.children())
+
+    def _yopo_hook(self, module, inputs, output):
+        if self._yopo_stop:
+            raise _StopForward(output)
+        output.register_hook(self._save_yopo_grad)
+        # the next layer may be in-place (e.g. ReLU(inplace=True)), so hand it
+        # a copy to keep the hooked tensor intact
+        return output.clone()
+
+    def _save_yopo_grad(self, grad):
+        self._yopo_grad = grad.detach()
+
+    def _first_layer(self, x):
+        """Run basic_net on <x> up to and including the YOPO layer"""
+        self._yopo_stop = True
+        try:
+            self.basic_net(x)
+        except _StopForward as e:
+            return e.output
+        finally:
+            self._yopo_stop = False
+        raise RuntimeError('YOPO layer is not used in the forward pass')
+
+    def _train_yopo(self, inputs, targets, optimizer):
+        handle = self._get_yopo_layer().register_forward_hook(self._yopo_hook)
+        try:
+            delta = self._clip(self._init_delta(inputs), inputs)
+            optimizer.zero_grad()
+            for _ in range(self.yopo_outer):
+                logits = self.basic_net(inputs + delta)
+                loss = F.cross_entropy(logits, targets)
+                # weight gradient accumulates over the outer iterations, the
+                # hook records the gradient w.r.t. the first layer output
+                (loss / self.yopo_outer).backward()
+                p = self._yopo_grad * self.yopo_outer
+                for _ in range(self.yopo_inner):
+                    delta.requires_grad_()
+                    with torch.enable_grad():
+                        out = self._first_layer(inputs + delta)
+                        hamiltonian = (out * p).sum()
+                    grad = torch.autograd.grad(hamiltonian, delta)[0]
+                    delta = self._ascend(delta.detach(), grad.detach(),
+                                         self.step_size)
+                    delta = self._clip(delta, inputs)
+            optimizer.step()
+        finally:
+            handle.remove()
+            self._yopo_grad = None
+        return loss.detach(), logits.detach()
+
+
+class PGDModel(AdvTrainModel):
     """
     code adapted from
     https://github.com/karandwivedi42/adversarial/blob/master/main.py
@@ -17,32 +251,29 @@ class PGDModel(nn.Module):
         self.epsilon = config['epsilon']
         self.num_steps = config['num_steps']
         assert config['loss_func'] == 'xent', 'Only xent supported for now.'
+        self._setup(config)
 
-    def forward(self, inputs, targets, attack=False):
-        if not attack:
-            return self.basic_net(inputs)
+    def _init_delta(self, x):
+        return torch.zeros_like(x).uniform_(-self.epsilon, self.epsilon)
 
-        x = inputs.detach()
-        if self.rand:
-            x = x + torch.zeros_like(x).uniform_(-self.epsilon, self.epsilon)
-        for _ in range(self.num_steps):
-            x.requires_grad_()
-            with torch.enable_grad():
-                logits = self.basic_net(x)
-                loss = F.cross_entropy(logits, targets, reduction='sum')
-            grad = torch.autograd.grad(loss, x)[0]
-            x = x.detach() + self.step_size * torch.sign(grad.detach())
-            x = torch.min(torch.max(x, inputs - self.epsilon),
-                          inputs + self.epsilon)
-            x = torch.clamp(x, 0, 1)
+    def _ascend(self, delta, grad, step_size):
+        return delta + step_size * torch.sign(grad)
 
-        return self.basic_net(x)
+    def _project(self, delta):
+        return torch.clamp(delta, -self.epsilon, self.epsilon)
+
+    def _default_fgsm_step_size(self):
+        return 1.25 * self.epsilon
 
 
-class PGDL2Model(nn.Module):
+class PGDL2Model(AdvTrainModel):
     """
     code adapted from
     https://github.com/karandwivedi42/adversarial/blob/master/main.py
+
+    The PGD attack of forward(attack=True) (also used by the 'pgd' training
+    mode) does not bound the perturbation. config['epsilon'], if given, is
+    the L2 ball of the 'free', 'fgsm' and 'yopo' training modes only.
     """
 
     def __init__(self, basic_net, config):
@@ -51,30 +282,32 @@ class PGDL2Model(nn.Module):
         self.rand = config['random_start']
         self.step_size = config['step_size']
         self.num_steps = config['num_steps']
+        # optional L2 ball of the free, fgsm and yopo modes, the
+        # perturbation is unbounded if not given
+        self.epsilon = config.get('epsilon', None)
         assert config['loss_func'] == 'xent', 'Only xent supported for now.'
+        self._setup(config)
 
-    def forward(self, inputs, targets, attack=False):
-        if not attack:
-            return self.basic_net(inputs)
+    def _init_delta(self, x):
+        return torch.zeros_like(x).normal_(0, self.step_size)
 
-        x = inputs.detach()
-        if self.rand:
-            # x = x + torch.zeros_like(x).uniform_(-self.epsilon, self.epsilon)
-            x = x + torch.zeros_like(x).normal_(0, self.step_size)
+    def _ascend(self, delta, grad, step_size):
+        grad_norm = grad.view(grad.size(0), -1).norm(2, 1).clamp_min(1e-12)
+        return delta + step_size * grad / grad_norm.view(
+            (-1, ) + (1, ) * (grad.dim() - 1))
 
-        for _ in range(self.num_steps):
-            x.requires_grad_()
-            with torch.enable_grad():
-                logits = self.basic_net(x)
-                loss = F.cross_entropy(logits, targets, reduction='sum')
-                # _, logits = self.basic_net(x)
-                # loss = F.mse_loss(logits, targets, reduction='sum')
-            grad = torch.autograd.grad(loss, x)[0].detach()
-            grad_norm = grad.view(x.size(0), -1).norm(2, 1)
-            delta = self.step_size * grad / grad_norm.view(x.size(0), 1, 1, 1)
-            x = x.detach() + delta
-            # x = torch.min(torch.max(x, inputs - self.epsilon),
-            #               inputs + self.epsilon)
-            x = torch.clamp(x, 0, 1)
+    def _project(self, delta):
+        if self.epsilon is None:
+            return delta
+        norm = delta.view(delta.size(0), -1).norm(2, 1).clamp_min(1e-12)
+        factor = torch.clamp(self.epsilon / norm, max=1)
+        return delta * factor.view((-1, ) + (1, ) * (delta.dim() - 1))
 
-        return self.basic_net(x)
+    def _project_attack(self, delta):
+        # the PGD attack stays unbounded as it always was
+        return delta
+
+    def _default_fgsm_step_size(self):
+        if self.epsilon is None:
+            return self.step_size
+        return 1.25 * self.epsilon
@@ -0,0 +1,223 @@
+'''
+Run an attack over a large set of samples in shards. Each finished shard is
+written to an on-disk store as soon as it completes, so a crashed or
+interrupted job resumes from the shards that are already done. Shards can
+run in a pool of worker processes.
+'''
+import glob
+import hashlib
+import os
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from lib.checkpoint import load_checkpoint, save_checkpoint
+
+# context built by the setup function in each worker process
+_worker_context = None
+
+
+class AttackStore(object):
+    """
+    Directory holding the results of an attack job: meta.pt describes the job
+    and shard_<id>.pt holds the adversarial examples and metrics of one
+    finished shard. Files are written atomically, so a shard file is either
+    complete or absent.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _shard_path(self, shard):
+        return os.path.join(self.path, 'shard_%05d.pt' % shard)
+
+    def check_meta(self, meta):
+        """Write <meta> for a new job, or make sure that it matches the job
+        found in the store, so that a store is never resumed with other
+        samples or settings"""
+        meta_path = os.path.join(self.path, 'meta.pt')
+        old_meta = load_checkpoint(meta_path)
+        if old_meta is None:
+            save_checkpoint(meta, meta_path)
+        elif old_meta != meta:
+            raise ValueError(
+                'Store %s holds a different job (%s), expected %s' %
+                (self.path, old_meta, meta))
+
+    def finished(self):
+        """Return the set of shard ids already in the store"""
+        paths = glob.glob(os.path.join(self.path, 'shard_*.pt'))
+        return set(int(os.path.basename(p)[6:-3]) for p in paths)
+
+    def append(self, shard, begin, end, x_adv, metrics):
+        """Write the result of one shard"""
+        save_checkpoint({'begin': begin, 'end': end, 'x_adv': x_adv,
+                         'metrics': metrics}, self._shard_path(shard))
+
+    def load(self):
+        """Return the adversarial examples and the metrics of the finished
+        shards, concatenated in sample order
+
+        Returns
+        -------
+        x_adv : torch.tensor
+            adversarial examples of the finished shards
+        metrics : dict
+            dict of np.array, one entry per sample of the finished shards
+        """
+        shards = [load_checkpoint(self._shard_path(s))
+                  for s in sorted(self.finished())]
+        if not shards:
+            return None, {}
+        x_adv = torch.cat([s['x_adv'] for s in shards])
+        metrics = {key: np.concatenate([s['metrics'][key] for s in shards])
+                   for key in shards[0]['metrics']}
+        return x_adv, metrics
+
+
+def fingerprint(*tensors):
+    """Return the sha1 of the shapes, dtypes and bytes of <tensors>"""
+    sha1 = hashlib.sha1()
+    for tensor in tensors:
+        array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+        sha1.update(str((array.shape, array.dtype.str)).encode())
+        sha1.update(array.tobytes())
+    return sha1.hexdigest()
+
+
+def _init_worker(setup, counter):
+    """Build the attack context of a worker process"""
+    global _worker_context
+    with counter.get_lock():
+        rank = counter.value
+        counter.value += 1
+    _worker_context = setup(rank)
+
+
+def _run_shard(attack, context, shard, begin, end, x, y, seed):
+    """Attack one shard and return its adversarial examples and metrics"""
+    if context is None:
+        context = _worker_context
+    if seed is not None:
+        # every shard has its own seed so that a resumed job reproduces it
+        np.random.seed(seed + shard)
+        torch.manual_seed(seed + shard)
+    start = time.time()
+    output = attack(context, x, y)
+    x_adv, metrics = output if isinstance(output, tuple) else (output, {})
+    x_adv = x_adv.detach().cpu()
+    metrics = {key: np.asarray(value) for key, value in metrics.items()}
+    metrics['l2'] = (x_adv - x).view(x.size(0), -1).norm(2, 1).numpy()
+    metrics['time'] = np.zeros(x.size(0)) + (time.time() - start) / x.size(0)
+    return shard, begin, end, x_adv, metrics
+
+
+def _run_shard_args(args):
+    return _run_shard(*args)
+
+
+class AttackRunner(object):
+    """
+    Attack a set of samples shard by shard and store the results in an
+    AttackStore.
+
+    Parameters
+    ----------
+    attack : callable
+        attack(context, x, y) returns the adversarial examples of the samples
+        (x, y) of one shard, or a tuple (x_adv, metrics) where metrics is a
+        dict of per-sample arrays. The L2 norm of the perturbation ('l2') and
+        the time per sample ('time') are always recorded. Must be defined at
+        module level if num_workers > 0
+    store_dir : str
+        directory of the AttackStore
+    shard_size : int, optional
+        number of samples per shard. Default is 100
+    num_workers : int, optional
+        number of worker processes. Shards run in the current process if 0.
+        Default is 0
+    setup : callable, optional
+        setup(rank) builds the context (e.g. model and DkNN) passed to
+        <attack> in worker <rank>. Required if num_workers > 0. It is sent
+        to spawned processes, so it must be defined at module level
+    context : object, optional
+        context passed to <attack> when num_workers is 0. If None, it is
+        built with setup(0)
+    seed : int, optional
+        shard i runs with random seed (seed + i). Default is None (no seeding)
+    config : dict, optional
+        settings of the job (e.g. model, layers and attack parameters). It
+        is stored with the results and a store written with a different
+        config is never resumed. Default is None
+    """
+
+    def __init__(self, attack, store_dir, shard_size=100, num_workers=0,
+                 setup=None, context=None, seed=None, config=None):
+        if num_workers > 0 and setup is None:
+            raise ValueError('setup is required when num_workers > 0')
+        self.attack = attack
+        self.store = AttackStore(store_dir)
+        self.shard_size = shard_size
+        self.num_workers = num_workers
+        self.setup = setup
+        self.context = context
+        self.seed = seed
+        self.config = config
+
+    def run(self, x, y):
+        """Attack every sample of (x, y) that is not in the store yet and
+        return the adversarial examples of all of them. Raise ValueError if
+        the store holds a job with other samples, seed or config."""
+        x, y = x.detach().cpu(), y.detach().cpu()
+        num_samples = x.size(0)
+        self.store.check_meta({'num_samples': num_samples,
+                               'shard_size': self.shard_size,
+                               'input_shape': tuple(x.size()[1:]),
+                               'data': fingerprint(x, y),
+                               'seed': self.seed,
+                               'config': self.config})
+        num_shards = int(np.ceil(num_samples / self.shard_size))
+        finished = self.store.finished()
+        todo = [s for s in range(num_shards) if s not in finished]
+        print('%d/%d shards already done' % (num_shards - len(todo),
+                                             num_shards))
+
+        def tasks(context):
+            for shard in todo:
+                begin = shard * self.shard_size
+                end = min(begin + self.shard_size, num_samples)
+                yield (self.attack, context, shard, begin, end, x[begin:end],
+                       y[begin:end], self.seed)
+
+        if self.num_workers == 0:
+            context = self.context
+            if context is None and todo:
+                context = self.setup(0)
+            for args in tasks(context):
+                self._append(*_run_shard(*args))
+        elif todo:
+            ctx = mp.get_context('spawn')
+            counter = ctx.Value('i', 0)
+            with ctx.Pool(self.num_workers, initializer=_init_worker,
+                          initargs=(self.setup, counter)) as pool:
+                # results are written by this process as they complete
+                for result in pool.imap_unordered(_run_shard_args,
+                                                  tasks(None)):
+                    self._append(*result)
+
+        x_adv, _ = self.store.load()
+        return x_adv
+
+    def _append(self, shard, begin, end, x_adv, metrics):
+        self.store.append(shard, begin, end, x_adv, metrics)
+        print('shard %d (samples %d-%d): mean l2 %.4f, %.2fs per sample' %
+              (shard, begin, end, metrics['l2'].mean(),
+               metrics['time'].mean()))
+
+    def metrics(self):
+        """Return the metrics of the finished shards"""
+        return self.store.load()[1]
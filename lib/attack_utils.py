@@ -0,0 +1,206 @@
+'''
+Bookkeeping shared by the binary-search attacks (lib/cwl2_attack.py and the
+DkNN attacks): vectorized updates of the penalty constant and of the best
+adversarial examples, compaction of the batch to the samples that are
+still being optimized, and warm starts across binary search steps. Also
+helpers to run random restarts stacked along the batch dimension.
+'''
+import torch
+
+from lib.profiler import profiled
+
+
+def select(t, keep):
+    """Return t[keep], or <t> itself if it is a scalar shared by the batch"""
+    if torch.is_tensor(t) and t.dim() > 0:
+        return t[keep]
+    return t
+
+
+@profiled('attack.update_const')
+def update_const(const, lower_bound, upper_bound, is_adv, idx, infty):
+    """Binary search step on the penalty constant of the samples <idx>.
+    Samples with an adversarial example get a smaller constant, the others a
+    larger one. Tensors are updated in place.
+
+    Parameters
+    ----------
+    const, lower_bound, upper_bound : torch.tensor
+        constant and its bounds of the whole batch, shape (batch_size, )
+    is_adv : torch.tensor
+        bool tensor, whether each sample in <idx> is adversarial
+    idx : torch.tensor
+        indices of the samples to update
+    infty : float
+        value of upper_bound when no adversarial example has been found yet.
+        The constant of such samples is multiplied by 10.
+    """
+    c = const[idx]
+    upper = torch.where(is_adv, c, upper_bound[idx])
+    lower = torch.where(is_adv, lower_bound[idx], c)
+    upper_bound[idx] = upper
+    lower_bound[idx] = lower
+    const[idx] = torch.where(upper >= infty, c * 10, (lower + upper) / 2)
+
+
+@profiled('attack.update_best')
+def update_best(x_adv, best_dist, x, dist, is_adv, idx):
+    """Keep the adversarial example with the smallest <dist> for each of
+    the samples <idx>. <x>, <dist> and <is_adv> are indexed like <idx>.
+    Return the bool mask of the samples that improved."""
+    better = is_adv & (dist < best_dist[idx])
+    x_adv[idx[better]] = x[better].to(x_adv.dtype)
+    best_dist[idx[better]] = dist[better]
+    return better
+
+
+def converged_const(lower_bound, upper_bound, const_tol):
+    """Return the bool mask of the samples whose bounds on the constant are
+    within a relative tolerance of <const_tol>. Always False if <const_tol>
+    is None."""
+    if const_tol is None:
+        return torch.zeros_like(upper_bound, dtype=torch.bool)
+    return upper_bound - lower_bound <= const_tol * upper_bound
+
+
+@profiled('attack.compact_optimizer')
+def compact_optimizer(optimizer, param, keep):
+    """Keep the rows <keep> of <param>, the only parameter of <optimizer>.
+    Per-element state (e.g. the moments of Adam or RMSprop) is compacted the
+    same way so the optimization of the remaining rows is unaffected.
+    Return the new parameter."""
+    new_param = param.detach()[keep].requires_grad_()
+    state = optimizer.state.pop(param, {})
+    new_state = {}
+    for key, value in state.items():
+        if torch.is_tensor(value) and value.size() == param.size():
+            value = value[keep]
+        new_state[key] = value
+    optimizer.state[new_param] = new_state
+    optimizer.param_groups[0]['params'] = [new_param]
+    return new_param
+
+
+class WarmStart(object):
+    """
+    Perturbation (in attack space) and optimizer state each sample starts
+    from in the next binary search step. The optimizer must have a single
+    parameter with one row per sample. Per-element state (e.g. the moments of
+    Adam or RMSprop) is kept per sample, other entries (e.g. the step count
+    of Adam) are shared by the batch.
+    """
+
+    def __init__(self, z_delta):
+        self.z_delta = z_delta.detach().clone()
+        self.rows = {}
+        self.shared = {}
+
+    @profiled('attack.warm_save')
+    def save(self, optimizer, param, rows, idx):
+        """Save the rows <rows> of <param> and their optimizer state as the
+        start of the samples <idx>"""
+        self.z_delta[idx] = param.detach()[rows]
+        for key, value in optimizer.state.get(param, {}).items():
+            if torch.is_tensor(value) and value.size() == param.size():
+                if key not in self.rows:
+                    self.rows[key] = torch.zeros_like(self.z_delta)
+                self.rows[key][idx] = value[rows]
+            else:
+                self.shared[key] = (value.clone() if torch.is_tensor(value)
+                                    else value)
+
+    @profiled('attack.warm_update')
+    def update(self, other, rows, idx):
+        """Copy the rows <rows> of another WarmStart to the samples <idx>"""
+        self.z_delta[idx] = other.z_delta[rows]
+        for key, value in other.rows.items():
+            if key not in self.rows:
+                self.rows[key] = torch.zeros_like(self.z_delta)
+            self.rows[key][idx] = value[rows]
+        self.shared.update(other.shared)
+
+    @profiled('attack.warm_start')
+    def start(self, idx, optimizer_cls, **kwargs):
+        """Return a perturbation for the samples <idx> and an optimizer of
+        class <optimizer_cls> on it, resuming from the saved state"""
+        z_delta = self.z_delta[idx].clone().requires_grad_()
+        optimizer = optimizer_cls([z_delta], **kwargs)
+        if self.rows:
+            state = {key: value[idx].clone()
+                     for key, value in self.rows.items()}
+            for key, value in self.shared.items():
+                state[key] = (value.clone() if torch.is_tensor(value)
+                              else value)
+            optimizer.state[z_delta] = state
+        return z_delta, optimizer
+
+
+def estimate_max_batch(probe, num_rows, device, probe_rows=4,
+                       fraction=0.8):
+    """Return the number of rows (at most <num_rows>) that fit in <fraction>
+    of the free memory of <device>. probe(n) must allocate what one step of
+    the attack allocates for n rows. Its peak memory on <probe_rows> rows
+    gives the memory per row (an overestimate, since it includes the memory
+    that does not depend on the number of rows). All rows fit on the CPU."""
+    device = torch.device(device)
+    if device.type != 'cuda':
+        return num_rows
+    probe_rows = min(probe_rows, num_rows)
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    probe(probe_rows)
+    torch.cuda.synchronize(device)
+    per_row = (torch.cuda.max_memory_allocated(device) - base) / probe_rows
+    free = torch.cuda.mem_get_info(device)[0]
+    return int(max(1, min(num_rows, fraction * free / max(per_row, 1))))
+
+
+def run_chunked(fn, commit, num_rows, max_batch=None, probe=None,
+                device='cpu', verbose=False):
+    """Call fn(begin, end) on consecutive chunks of the rows 0, ..., num_rows
+    - 1, and commit(begin, end, result) with what it returns.
+
+    A chunk has at most <max_batch> rows (all rows if None) and, if <probe>
+    is given, at most the number of rows that fit in the memory of <device>
+    (see estimate_max_batch). If a chunk still runs out of GPU memory, the
+    chunk size is halved and the chunk is run again. <fn> must therefore
+    only write to its own scratch buffers and return them: the state of the
+    caller (best examples, counters) is updated by <commit>, which is only
+    called once the chunk has succeeded."""
+    chunk = num_rows if max_batch is None else min(max_batch, num_rows)
+    if probe is not None:
+        chunk = min(chunk, estimate_max_batch(probe, num_rows, device))
+    begin = 0
+    while begin < num_rows:
+        end = min(begin + chunk, num_rows)
+        try:
+            result = fn(begin, end)
+            oom = False
+        except RuntimeError as e:
+            if 'out of memory' not in str(e) or chunk == 1:
+                raise
+            oom = True
+        if oom:
+            # the tensors of the failed chunk are freed with the exception
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            chunk = max(1, chunk // 2)
+            if verbose:
+                print('out of memory, retrying with chunks of %d' % chunk)
+            continue
+        commit(begin, end, result)
+        begin = end
+
+
+def best_restart(score, num_restart):
+    """Pick the best restart of each sample. <score> has one entry per row of
+    the stacked batch, rows r * batch_size + i are restart r of sample i.
+    Return the index of the best row of each sample and its score. Ties go
+    to the earliest restart."""
+    score = score.view(num_restart, -1)
+    batch_size = score.size(1)
+    # argmax returns the first maximal index
+    r = score.argmax(0)
+    row = r * batch_size + torch.arange(batch_size, device=score.device)
+    return row, score.view(-1)[row]
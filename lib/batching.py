@@ -0,0 +1,128 @@
+'''
+Dynamic micro-batching shared by BatchedDkNNFoolboxModel and DkNNServer. A
+dispatcher thread collects pending requests until it has max_batch samples
+or max_wait seconds have passed since the first one, and processes them with
+one call.
+'''
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+class _Request(object):
+    """Samples submitted together and the callback that gets their output"""
+
+    def __init__(self, x, callback):
+        self.x = x
+        self.callback = callback
+
+
+def _rows(output, begin, end):
+    """Rows begin to end of <output>, or of each entry if it is a tuple"""
+    if isinstance(output, tuple):
+        return tuple(o[begin:end] for o in output)
+    return output[begin:end]
+
+
+class MicroBatcher(object):
+    """
+    Process the samples submitted from any thread in micro-batches. Call
+    close() to stop the dispatcher thread.
+
+    Parameters
+    ----------
+    process : callable
+        process(x) returns the output of a batch of samples x (one row per
+        sample), an array or a tuple of arrays with one row per sample
+    max_batch : int
+        the dispatcher stops collecting requests once it has this many
+        samples
+    max_wait : float
+        time in seconds the dispatcher waits for more requests after the
+        first one of a batch
+    """
+
+    def __init__(self, process, max_batch, max_wait):
+        self.process = process
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        # guards the stats
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self.reset_stats()
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'requests': 0, 'samples': 0, 'batches': 0}
+
+    def stats(self):
+        """Return the number of requests, samples and batches since the
+        last reset, and the mean number of samples per batch"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['mean_batch'] = stats['samples'] / max(1, stats['batches'])
+        return stats
+
+    def submit(self, x, callback):
+        """Queue the samples <x> (np.array or torch.tensor, one row per
+        sample). callback(output, error) is called from the dispatcher
+        thread with the rows of the output that belong to <x> and None, or
+        with None and the exception raised by process."""
+        self._queue.put(_Request(x, callback))
+
+    def close(self):
+        """Process the pending requests and stop the dispatcher thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, request):
+        """Return the requests of the batch started by <request>, and
+        whether close was called in the meantime"""
+        requests = [request]
+        num_samples = len(request.x)
+        deadline = time.time() + self.max_wait
+        while num_samples < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                return requests, True
+            requests.append(request)
+            num_samples += len(request.x)
+        return requests, False
+
+    def _dispatch(self):
+        stop = False
+        while not stop:
+            request = self._queue.get()
+            if request is None:
+                return
+            requests, stop = self._collect(request)
+
+            if torch.is_tensor(requests[0].x):
+                x = torch.cat([r.x for r in requests])
+            else:
+                x = np.concatenate([r.x for r in requests])
+            try:
+                output = self.process(x)
+            except Exception as e:
+                for r in requests:
+                    r.callback(None, e)
+            else:
+                begin = 0
+                for r in requests:
+                    r.callback(_rows(output, begin, begin + len(r.x)), None)
+                    begin += len(r.x)
+            with self._lock:
+                self._stats['requests'] += len(requests)
+                self._stats['samples'] += len(x)
+                self._stats['batches'] += 1
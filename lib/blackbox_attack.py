@@ -18,10 +18,178 @@ from torch.autograd import Variable
 #                     show_image)
 
 
+# number of sections an interval is split into by one round of the
+# multi-section search (sections - 1 points are queried in one batch)
+NUM_SECTIONS = 16
+
+
+def predict_batch(model, x):
+    """Return the labels of the samples <x> predicted in one model call"""
+    if hasattr(model, 'classify'):
+        with torch.no_grad():
+            return np.asarray(model.classify(x)).argmax(1)
+    return np.array([model.predict(xi) for xi in x])
+
+
+def _query(model, x0, thetas, lbds, is_adv):
+    """Return whether x0 + lbds[i, j] * thetas[i] is adversarial, for all
+    i, j, with one batched prediction"""
+    n, m = lbds.shape
+    lbds = torch.tensor(lbds, dtype=x0.dtype, device=x0.device)
+    x = x0 + lbds.view((n, m) + (1, ) * x0.dim()) * thetas.unsqueeze(1)
+    labels = predict_batch(model, x.view((n * m, ) + x0.size()))
+    return is_adv(labels).reshape(n, m)
+
+
+def _multisection(model, x0, thetas, lo, hi, tol, is_adv, sections):
+    """Shrink the intervals [lo[i], hi[i]] that contain the decision boundary
+    along thetas[i] until they are smaller than <tol>. x0 + lo * theta is not
+    adversarial and x0 + hi * theta is. Each round queries sections - 1
+    points of every interval in one batch, where bisection would query one.
+    Return hi and the number of queries."""
+    lo = np.array(lo, dtype=np.float64)
+    hi = np.array(hi, dtype=np.float64)
+    fracs = np.arange(1, sections) / sections
+    nquery = 0
+    while True:
+        idx = np.where(hi - lo > tol)[0]
+        if idx.size == 0:
+            return hi, nquery
+        lbds = lo[idx, None] + (hi - lo)[idx, None] * fracs
+        adv = _query(model, x0, thetas[torch.from_numpy(idx)], lbds, is_adv)
+        nquery += adv.size
+        # the boundary is between the first adversarial point and the point
+        # before it (lo and hi are the end points)
+        first = np.where(adv.any(1), adv.argmax(1), sections - 1)
+        lbds = np.concatenate([lo[idx, None], lbds, hi[idx, None]], 1)
+        rows = np.arange(idx.size)
+        lo[idx] = lbds[rows, first]
+        hi[idx] = lbds[rows, first + 1]
+
+
+def _bracket(model, x0, thetas, lbd, is_adv, sections, limit, grow=1.01,
+             shrink=0.99):
+    """Find intervals [lo, hi] around the decision boundary along thetas,
+    starting from <lbd>. If x0 + lbd * theta is not adversarial, lbd is
+    multiplied by <grow> until it is, otherwise by <shrink> until it is not
+    (if shrink is None, the interval is [0, lbd]). <sections> factors are
+    tried per batched query. hi is inf if it would exceed <limit>. Return lo,
+    hi and the number of queries."""
+    n = len(thetas)
+    lbd = np.zeros((n, )) + np.asarray(lbd, dtype=np.float64)
+    adv = _query(model, x0, thetas, lbd[:, None], is_adv)[:, 0]
+    nquery = n
+    lo = np.where(adv, 0., lbd)
+    hi = np.where(adv, lbd, np.inf)
+    # <find_adv> tells if a direction looks for an adversarial point (grow)
+    # or for a non-adversarial one (shrink)
+    find_adv = ~adv
+    todo = find_adv.copy() if shrink is None else np.ones((n, ), dtype=bool)
+    factor = np.where(find_adv, grow, shrink or 1.)
+    steps = np.arange(1, sections + 1)
+    while todo.any():
+        idx = np.where(todo)[0]
+        lbds = lbd[idx, None] * factor[idx, None] ** steps
+        found = _query(model, x0, thetas[torch.from_numpy(idx)], lbds,
+                       is_adv) == find_adv[idx, None]
+        nquery += found.size
+        hit = found.any(1)
+        rows = np.arange(idx.size)
+        first = found.argmax(1)
+        point = lbds[rows, first]
+        prev = np.where(first > 0, lbds[rows, first - 1], lbd[idx])
+        up = hit & find_adv[idx]
+        lo[idx[up]], hi[idx[up]] = prev[up], point[up]
+        down = hit & ~find_adv[idx]
+        lo[idx[down]], hi[idx[down]] = point[down], prev[down]
+        lbd[idx] = lbds[:, -1]
+        done = hit.copy()
+        # give up once the grown lambda exceeds the limit
+        over = find_adv[idx] & (np.where(hit, point, lbds[:, -1]) > limit)
+        hi[idx[over]] = np.inf
+        done |= over
+        # x0 itself is adversarial along this direction
+        tiny = ~find_adv[idx] & ~hit & (lbds[:, -1] < 1e-10)
+        lo[idx[tiny]], hi[idx[tiny]] = 0., lbds[tiny, -1]
+        done |= tiny
+        todo[idx[done]] = False
+    return lo, hi, nquery
+
+
+def _local_search(model, x0, thetas, initial_lbd, tol, is_adv, limit,
+                  sections):
+    """Distance to the decision boundary along every direction of <thetas>,
+    starting from <initial_lbd>. Return the distances and number of
+    queries."""
+    lo, hi, nquery = _bracket(model, x0, thetas, initial_lbd, is_adv,
+                              sections, limit)
+    ok = np.where(np.isfinite(hi))[0]
+    if ok.size > 0:
+        hi[ok], count = _multisection(
+            model, x0, thetas[torch.from_numpy(ok)], lo[ok], hi[ok], tol,
+            is_adv, sections)
+        nquery += count
+    return hi, nquery
+
+
+def _normalize(theta):
+    """Normalize each direction of the batch <theta> to unit L2 norm"""
+    norm = theta.view(theta.size(0), -1).norm(2, 1)
+    return theta / norm.view((-1, ) + (1, ) * (theta.dim() - 1))
+
+
+class TrainCandidates(object):
+    """
+    Training samples indexed by the label the model predicts for them. They
+    are the candidates for the initial direction of the attacks, (x - x0)
+    is adversarial if x is predicted as another class than x0. Predictions
+    on training samples do not depend on the attacked sample, so one
+    TrainCandidates is built once and shared by all attacks.
+    """
+
+    def __init__(self, model, x_train, batch_size=1000):
+        self.x_train = x_train
+        self.labels = np.concatenate([
+            predict_batch(model, x_train[i:i + batch_size])
+            for i in range(0, len(x_train), batch_size)])
+        self.by_class = {c: np.where(self.labels == c)[0]
+                         for c in np.unique(self.labels)}
+
+    def sample(self, num_samples, labels):
+        """Return at most <num_samples> random training samples predicted as
+        one of <labels>"""
+        idx = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                             [self.by_class.get(int(c), []) for c in labels])
+        idx = idx.astype(np.int64)
+        idx = random.sample(list(idx), min(num_samples, len(idx)))
+        return self.x_train[torch.tensor(idx, dtype=torch.long)]
+
+
+def _initial_candidates(model, train_dataset, num_samples):
+    """Return a TrainCandidates and the number of queries it took. A list
+    of (x, y) is turned into the candidates of <num_samples> random samples
+    predicted in one batch."""
+    if isinstance(train_dataset, TrainCandidates):
+        return train_dataset, 0
+    samples = random.sample(range(len(train_dataset)), num_samples)
+    x = torch.stack([train_dataset[i][0] for i in samples])
+    return TrainCandidates(model, x), num_samples
+
+
+def _directions(x, x0):
+    """Return the normalized directions from x0 to the samples <x> and their
+    lengths"""
+    theta = x - x0
+    norm = theta.view(theta.size(0), -1).norm(2, 1)
+    return (theta / norm.view((-1, ) + (1, ) * x0.dim()),
+            norm.cpu().numpy())
+
+
 def attack_targeted(model, train_dataset, x0, y0, target, alpha=0.1, beta=0.001, iterations=1000):
     """ Attack the original image and return adversarial example of target t
         model: (pytorch model)
-        train_dataset: set of training data
+        train_dataset: set of training data, list of (x, y) or
+            TrainCandidates
         (x0, y0): original image
         t: target
     """
@@ -38,21 +206,19 @@ def attack_targeted(model, train_dataset, x0, y0, target, alpha=0.1, beta=0.001,
 
     print("Searching for the initial direction on %d samples: " % (num_samples))
     timestart = time.time()
-    samples = set(random.sample(range(len(train_dataset)), num_samples))
-    for i, (xi, yi) in enumerate(train_dataset):
-        if i not in samples:
-            continue
-        query_count += 1
-        if model.predict(xi) == target:
-            theta = xi - x0
-            initial_lbd = torch.norm(theta)
-            theta = theta / torch.norm(theta)
-            lbd, count = fine_grained_binary_search_targeted(
-                model, x0, y0, target, theta, initial_lbd)
-            query_count += count
-            if lbd < g_theta:
-                best_theta, g_theta = theta, lbd
-                print("--------> Found distortion %.4f" % g_theta)
+    candidates, query_count = _initial_candidates(model, train_dataset,
+                                                  num_samples)
+    xi = candidates.sample(num_samples, [target])
+    if len(xi) > 0:
+        # all candidate directions are searched together
+        thetas, initial_lbd = _directions(xi, x0)
+        lbd, count = fine_grained_binary_search_targeted_batch(
+            model, x0, y0, target, thetas, initial_lbd)
+        query_count += count
+        best = lbd.argmin()
+        if lbd[best] < g_theta:
+            best_theta, g_theta = thetas[best], float(lbd[best])
+            print("--------> Found distortion %.4f" % g_theta)
 
     timeend = time.time()
     print("==========> Found best distortion %.4f in %.4f seconds using %d queries" % (
@@ -66,26 +232,21 @@ def attack_targeted(model, train_dataset, x0, y0, target, alpha=0.1, beta=0.001,
     opt_count = 0
 
     for i in range(iterations):
-        gradient = torch.zeros(theta.size())
         q = 10
-        min_g1 = float('inf')
-        for _ in range(q):
-            u = torch.randn(theta.size()).type(torch.FloatTensor)
-            u = u / torch.norm(u)
-            ttt = theta + beta * u
-            ttt = ttt / torch.norm(ttt)
-            g1, count = fine_grained_binary_search_local_targeted(
-                model, x0, y0, target, ttt, initial_lbd=g2, tol=beta / 500)
-            opt_count += count
-            gradient += (g1 - g2) / beta * u
-            if g1 < min_g1:
-                min_g1 = g1
-                min_ttt = ttt
-        gradient = 1.0 / q * gradient
+        # the q perturbed directions are searched together
+        u = _normalize(torch.randn((q, ) + theta.size()))
+        ttt = _normalize(theta + beta * u)
+        g1, count = fine_grained_binary_search_local_targeted_batch(
+            model, x0, y0, target, ttt, initial_lbd=g2, tol=beta / 500)
+        opt_count += count
+        coef = torch.tensor((g1 - g2) / beta, dtype=u.dtype)
+        gradient = (coef.view((-1, ) + (1, ) * theta.dim()) * u).mean(0)
+        min_g1 = float(g1.min())
+        min_ttt = ttt[g1.argmin()]
 
         if (i + 1) % 50 == 0:
             print("Iteration %3d: g(theta + beta*u) = %.4f g(theta) = %.4f distortion %.4f num_queries %d" %
-                  (i + 1, g1, g2, torch.norm(g2 * theta), opt_count))
+                  (i + 1, g1[-1], g2, torch.norm(g2 * theta), opt_count))
 
         min_theta = theta
         min_g2 = g2
@@ -139,76 +300,53 @@ def attack_targeted(model, train_dataset, x0, y0, target, alpha=0.1, beta=0.001,
     return x0 + g_theta * best_theta
 
 
-def fine_grained_binary_search_local_targeted(model, x0, y0, t, theta, initial_lbd=1.0, tol=1e-5):
-    nquery = 0
-    lbd = initial_lbd
-
-    if model.predict(x0 + lbd * theta) != t:
-        lbd_lo = lbd
-        lbd_hi = lbd * 1.01
-        nquery += 1
-        while model.predict(x0 + lbd_hi * theta) != t:
-            lbd_hi = lbd_hi * 1.01
-            nquery += 1
-            if lbd_hi > 100:
-                return float('inf'), nquery
-    else:
-        lbd_hi = lbd
-        lbd_lo = lbd * 0.99
-        nquery += 1
-        while model.predict(x0 + lbd_lo * theta) == t:
-            lbd_lo = lbd_lo * 0.99
-            nquery += 1
-
-    while (lbd_hi - lbd_lo) > tol:
-        lbd_mid = (lbd_lo + lbd_hi) / 2.0
-        nquery += 1
-        if model.predict(x0 + lbd_mid * theta) == t:
-            lbd_hi = lbd_mid
-        else:
-            lbd_lo = lbd_mid
-    return lbd_hi, nquery
+def fine_grained_binary_search_local_targeted(model, x0, y0, t, theta, initial_lbd=1.0, tol=1e-5, sections=NUM_SECTIONS):
+    lbd, nquery = fine_grained_binary_search_local_targeted_batch(
+        model, x0, y0, t, theta.unsqueeze(0), initial_lbd, tol, sections)
+    return float(lbd[0]), nquery
 
 
-def fine_grained_binary_search_targeted(model, x0, y0, t, theta, initial_lbd=1.0):
-    nquery = 0
-    lbd = initial_lbd
-
-    while model.predict(x0 + lbd * theta) != t:
-        lbd *= 1.05
-        nquery += 1
-        if lbd > 100:
-            return float('inf'), nquery
-
-    num_intervals = 100
-
-    lambdas = np.linspace(0.0, lbd, num_intervals)[1:]
-    lbd_hi = lbd
-    lbd_hi_index = 0
-    for i, lbd in enumerate(lambdas):
-        nquery += 1
-        if model.predict(x0 + lbd * theta) == t:
-            lbd_hi = lbd
-            lbd_hi_index = i
-            break
-
-    lbd_lo = lambdas[lbd_hi_index - 1]
-
-    while (lbd_hi - lbd_lo) > 1e-7:
-        lbd_mid = (lbd_lo + lbd_hi) / 2.0
-        nquery += 1
-        if model.predict(x0 + lbd_mid * theta) == t:
-            lbd_hi = lbd_mid
-        else:
-            lbd_lo = lbd_mid
+def fine_grained_binary_search_local_targeted_batch(model, x0, y0, t, thetas, initial_lbd=1.0, tol=1e-5, sections=NUM_SECTIONS):
+    """Distance to the boundary of class <t> along each direction of the
+    batch <thetas>, all searched together"""
+    t = int(t)
+    return _local_search(model, x0, thetas, initial_lbd, tol,
+                         lambda labels: labels == t, 100, sections)
+
+
+def fine_grained_binary_search_targeted(model, x0, y0, t, theta, initial_lbd=1.0, sections=NUM_SECTIONS):
+    lbd, nquery = fine_grained_binary_search_targeted_batch(
+        model, x0, y0, t, theta.unsqueeze(0), initial_lbd, sections)
+    return float(lbd[0]), nquery
 
-    return lbd_hi, nquery
+
+def fine_grained_binary_search_targeted_batch(model, x0, y0, t, thetas, initial_lbd=1.0, sections=NUM_SECTIONS):
+    """Distance to the boundary of class <t> along each direction of the
+    batch <thetas>, starting from <initial_lbd> (scalar or one per
+    direction). inf if the boundary is too far."""
+    t = int(t)
+
+    def is_adv(labels):
+        return labels == t
+
+    _, hi, nquery = _bracket(model, x0, thetas, initial_lbd, is_adv,
+                             sections, 100, grow=1.05, shrink=None)
+    ok = np.where(np.isfinite(hi))[0]
+    if ok.size > 0:
+        # the boundary is searched in [0, hi] (the linear scan and bisection
+        # of the original code are rounds of the multi-section search)
+        hi[ok], count = _multisection(
+            model, x0, thetas[torch.from_numpy(ok)], np.zeros(ok.size),
+            hi[ok], 1e-7, is_adv, sections)
+        nquery += count
+    return hi, nquery
 
 
 def attack_untargeted(model, train_dataset, x0, y0, alpha=0.2, beta=0.001, iterations=1000):
     """ Attack the original image and return adversarial example
         model: (pytorch model)
-        train_dataset: set of training data
+        train_dataset: set of training data, list of (x, y) or
+            TrainCandidates
         (x0, y0): original image
     """
 
@@ -222,21 +360,20 @@ def attack_untargeted(model, train_dataset, x0, y0, alpha=0.2, beta=0.001, itera
 
     print("Searching for the initial direction on %d samples: " % (num_samples))
     timestart = time.time()
-    samples = set(random.sample(range(len(train_dataset)), num_samples))
-    for i, (xi, yi) in enumerate(train_dataset):
-        if i not in samples:
-            continue
-        query_count += 1
-        if model.predict(xi) != y0:
-            theta = xi - x0
-            initial_lbd = torch.norm(theta)
-            theta = theta / torch.norm(theta)
-            lbd, count = fine_grained_binary_search(
-                model, x0, y0, theta, initial_lbd, g_theta)
-            query_count += count
-            if lbd < g_theta:
-                best_theta, g_theta = theta, lbd
-                print("--------> Found distortion %.4f" % g_theta)
+    candidates, query_count = _initial_candidates(model, train_dataset,
+                                                  num_samples)
+    other = [c for c in candidates.by_class if c != int(y0)]
+    xi = candidates.sample(num_samples, other)
+    if len(xi) > 0:
+        # all candidate directions are searched together
+        thetas, initial_lbd = _directions(xi, x0)
+        lbd, count = fine_grained_binary_search_batch(
+            model, x0, y0, thetas, initial_lbd, g_theta)
+        query_count += count
+        best = lbd.argmin()
+        if lbd[best] < g_theta:
+            best_theta, g_theta = thetas[best], float(lbd[best])
+            print("--------> Found distortion %.4f" % g_theta)
 
     timeend = time.time()
     print("==========> Found best distortion %.4f in %.4f seconds using %d queries" % (
@@ -250,26 +387,21 @@ def attack_untargeted(model, train_dataset, x0, y0, alpha=0.2, beta=0.001, itera
     stopping = 0.01
     prev_obj = 100000
     for i in range(iterations):
-        gradient = torch.zeros(theta.size())
         q = 10
-        min_g1 = float('inf')
-        for _ in range(q):
-            u = torch.randn(theta.size()).type(torch.FloatTensor)
-            u = u / torch.norm(u)
-            ttt = theta + beta * u
-            ttt = ttt / torch.norm(ttt)
-            g1, count = fine_grained_binary_search_local(
-                model, x0, y0, ttt, initial_lbd=g2, tol=beta / 500)
-            opt_count += count
-            gradient += (g1 - g2) / beta * u
-            if g1 < min_g1:
-                min_g1 = g1
-                min_ttt = ttt
-        gradient = 1.0 / q * gradient
+        # the q perturbed directions are searched together
+        u = _normalize(torch.randn((q, ) + theta.size()))
+        ttt = _normalize(theta + beta * u)
+        g1, count = fine_grained_binary_search_local_batch(
+            model, x0, y0, ttt, initial_lbd=g2, tol=beta / 500)
+        opt_count += count
+        coef = torch.tensor((g1 - g2) / beta, dtype=u.dtype)
+        gradient = (coef.view((-1, ) + (1, ) * theta.dim()) * u).mean(0)
+        min_g1 = float(g1.min())
+        min_ttt = ttt[g1.argmin()]
 
         if (i + 1) % 50 == 0:
             print("Iteration %3d: g(theta + beta*u) = %.4f g(theta) = %.4f distortion %.4f num_queries %d" %
-                  (i + 1, g1, g2, torch.norm(g2 * theta), opt_count))
+                  (i + 1, g1[-1], g2, torch.norm(g2 * theta), opt_count))
             if g2 > prev_obj - stopping:
                 break
             prev_obj = g2
@@ -326,79 +458,56 @@ def attack_untargeted(model, train_dataset, x0, y0, alpha=0.2, beta=0.001, itera
     return x0 + g_theta * best_theta
 
 
-def fine_grained_binary_search_local(model, x0, y0, theta, initial_lbd=1.0, tol=1e-5):
-    nquery = 0
-    lbd = initial_lbd
-
-    if model.predict(x0 + lbd * theta) == y0:
-        lbd_lo = lbd
-        lbd_hi = lbd * 1.01
-        nquery += 1
-        while model.predict(x0 + lbd_hi * theta) == y0:
-            lbd_hi = lbd_hi * 1.01
-            nquery += 1
-            if lbd_hi > 20:
-                return float('inf'), nquery
-    else:
-        lbd_hi = lbd
-        lbd_lo = lbd * 0.99
-        nquery += 1
-        while model.predict(x0 + lbd_lo * theta) != y0:
-            lbd_lo = lbd_lo * 0.99
-            nquery += 1
-
-    while (lbd_hi - lbd_lo) > tol:
-        lbd_mid = (lbd_lo + lbd_hi) / 2.0
-        nquery += 1
-        if model.predict(x0 + lbd_mid * theta) != y0:
-            lbd_hi = lbd_mid
-        else:
-            lbd_lo = lbd_mid
-    return lbd_hi, nquery
+def fine_grained_binary_search_local(model, x0, y0, theta, initial_lbd=1.0, tol=1e-5, sections=NUM_SECTIONS):
+    lbd, nquery = fine_grained_binary_search_local_batch(
+        model, x0, y0, theta.unsqueeze(0), initial_lbd, tol, sections)
+    return float(lbd[0]), nquery
+
 
+def fine_grained_binary_search_local_batch(model, x0, y0, thetas, initial_lbd=1.0, tol=1e-5, sections=NUM_SECTIONS):
+    """Distance to the decision boundary along each direction of the batch
+    <thetas>, all searched together"""
+    y0 = int(y0)
+    return _local_search(model, x0, thetas, initial_lbd, tol,
+                         lambda labels: labels != y0, 20, sections)
 
-def fine_grained_binary_search(model, x0, y0, theta, initial_lbd, current_best):
+
+def fine_grained_binary_search(model, x0, y0, theta, initial_lbd, current_best, sections=NUM_SECTIONS):
+    lbd, nquery = fine_grained_binary_search_batch(
+        model, x0, y0, theta.unsqueeze(0), initial_lbd, current_best,
+        sections)
+    return float(lbd[0]), nquery
+
+
+def fine_grained_binary_search_batch(model, x0, y0, thetas, initial_lbd, current_best=float('inf'), sections=NUM_SECTIONS):
+    """Distance to the decision boundary along each direction of the batch
+    <thetas>, knowing that x0 + initial_lbd * theta is adversarial
+    (<initial_lbd> is a scalar or one value per direction). Directions that
+    cannot beat the best distance found so far are not searched and get
+    inf."""
+    y0 = int(y0)
+    n = len(thetas)
+
+    def is_adv(labels):
+        return labels != y0
+
+    lbd = np.zeros((n, )) + np.asarray(initial_lbd, dtype=np.float64)
+    # the shortest initial lambda of the batch is also a distance to beat
+    current_best = min(float(current_best), lbd.min())
     nquery = 0
-    if initial_lbd > current_best:
-        if model.predict(x0 + current_best * theta) == y0:
-            nquery += 1
-            return float('inf'), nquery
-        lbd = current_best
-    else:
-        lbd = initial_lbd
-
-    # original version
-    #lbd = initial_lbd
-    # while model.predict(x0 + lbd*theta) == y0:
-    #    lbd *= 2
-    #    nquery += 1
-    #    if lbd > 100:
-    #        return float('inf'), nquery
-
-    #num_intervals = 100
-
-    # lambdas = np.linspace(0.0, lbd, num_intervals)[1:]
-    # lbd_hi = lbd
-    # lbd_hi_index = 0
-    # for i, lbd in enumerate(lambdas):
-    #     nquery += 1
-    #     if model.predict(x0 + lbd*theta) != y0:
-    #         lbd_hi = lbd
-    #         lbd_hi_index = i
-    #         break
-
-    # lbd_lo = lambdas[lbd_hi_index - 1]
-    lbd_hi = lbd
-    lbd_lo = 0.0
-
-    while (lbd_hi - lbd_lo) > 1e-5:
-        lbd_mid = (lbd_lo + lbd_hi) / 2.0
-        nquery += 1
-        if model.predict(x0 + lbd_mid * theta) != y0:
-            lbd_hi = lbd_mid
-        else:
-            lbd_lo = lbd_mid
-    return lbd_hi, nquery
+    check = np.where(lbd > current_best)[0]
+    if check.size > 0:
+        adv = _query(model, x0, thetas[torch.from_numpy(check)],
+                     np.full((check.size, 1), current_best), is_adv)[:, 0]
+        nquery += check.size
+        lbd[check] = np.where(adv, current_best, np.inf)
+
+    # bisection of [0, lbd] done as a multi-section search
+    ok = np.where(np.isfinite(lbd))[0]
+    lbd[ok], count = _multisection(
+        model, x0, thetas[torch.from_numpy(ok)], np.zeros(ok.size), lbd[ok],
+        1e-5, is_adv, sections)
+    return lbd, nquery + count
 
 
 def attack_mnist(alpha=0.2, beta=0.001, isTarget=False, num_attacks=100):
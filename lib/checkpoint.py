@@ -0,0 +1,109 @@
+'''
+Checkpoints that hold everything needed to resume training: model, optimizer,
+LR scheduler, RNG and epoch state. Writes happen on a background thread.
+'''
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    """Recursively copy every tensor in <obj> to CPU memory so that it can be
+    written out while training keeps modifying the originals"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    """Return RNG states of python, numpy and torch (CPU and CUDA)"""
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restore RNG states returned by get_rng_state"""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_checkpoint(state, path):
+    """Write <state> to <path> atomically (a crash mid-write never leaves a
+    truncated checkpoint behind)"""
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """Load a checkpoint written by save_checkpoint, return None if <path>
+    does not exist"""
+    if not os.path.isfile(path):
+        return None
+    # checkpoints hold the numpy RNG state and other python objects that the
+    # weights_only loader (the default from torch 2.6) rejects. They are
+    # local files written by save_checkpoint.
+    return torch.load(path, map_location=map_location, weights_only=False)
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Write checkpoints from a background thread. The caller snapshots the state
+    to CPU (see to_cpu) and hands it over, so the training loop only pays for
+    the device-to-host copy and not for serialization and disk I/O.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            state, path = item
+            try:
+                save_checkpoint(state, path)
+            except Exception as e:
+                self._error = e
+            self._queue.task_done()
+
+    def save(self, state, path):
+        """Queue <state> to be written to <path>. Raise the error of a
+        previous failed write, if any."""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        self._queue.put((state, path))
+
+    def wait(self):
+        """Block until every queued checkpoint has been written"""
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        """Flush pending writes and stop the background thread"""
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
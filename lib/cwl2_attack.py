@@ -1,21 +1,39 @@
-import logging
-
 import torch
 import torch.optim as optim
 
 import numpy as np
 
+from lib.attack_utils import (WarmStart, compact_optimizer, converged_const,
+                              update_best, update_const)
+from lib.profiler import profiled, stage
+
 
 class CWL2Attack(object):
     """
+    Carlini-Wagner L-2 attack. Each sample stops being optimized when its
+    own loss stops improving (abort_early) and the batch is compacted to the
+    samples that are still active. Success is read from the logits computed
+    by the optimization loop, so the attack needs no extra forward pass.
     """
 
+    @profiled('attack.CWL2Attack')
     def __call__(self, net, x_orig, label, targeted=False,
                  binary_search_steps=10, max_iterations=1000,
                  confidence=0, learning_rate=1e-1,
-                 initial_const=1, abort_early=True):
+                 initial_const=1, abort_early=True, const_tol=None,
+                 warm_start=False):
         """
         x_orig is tensor (requires_grad=False)
+
+        const_tol is the relative tolerance of the binary search: a sample is
+        skipped in the remaining binary search steps once
+        upper_bound - lower_bound <= const_tol * upper_bound. Set to None to
+        always run every step.
+
+        If warm_start is True, each binary search step starts from the best
+        adversarial perturbation found so far (or from where the previous
+        step stopped if none is found yet) with the Adam moments carried
+        over, instead of starting from zero.
         """
 
         min_, max_ = x_orig.max(), x_orig.min()
@@ -61,6 +79,7 @@ class CWL2Attack(object):
         upper_bound = torch.zeros_like(const) + 1e9
         best_l2dist = torch.zeros_like(const) + 1e9
 
+        warm = WarmStart(torch.zeros_like(z_orig))
         for binary_search_step in range(binary_search_steps):
             if binary_search_step == binary_search_steps - 1 and \
                     binary_search_steps >= 10:
@@ -68,61 +87,98 @@ class CWL2Attack(object):
                 # TODO: find out why... it's not obvious why this is useful
                 const = upper_bound
 
-            z_delta = torch.zeros_like(z_orig, requires_grad=True)
-            loss_at_previous_check = torch.zeros(1, device=x_orig.device) + 1e9
+            # samples attacked in this binary search step
+            active = (~converged_const(lower_bound, upper_bound, const_tol)
+                      ).nonzero().view(-1)
+            if active.size(0) == 0:
+                break
+            # state of the attack at the last iteration of each active sample
+            x_final = torch.zeros_like(x_orig[active])
+            l2dist_final = torch.zeros_like(const[active])
+            is_adv = torch.zeros_like(active, dtype=torch.bool)
+
+            # <pos> are the positions in <active> of the samples still
+            # optimized. Per-sample tensors are compacted along with it.
+            pos = torch.arange(active.size(0), device=active.device)
+            z_orig_, x_recon_ = z_orig[active], x_recon[active]
+            label_, const_ = label[active], const[active]
+            if not warm_start:
+                warm = WarmStart(torch.zeros_like(z_orig))
+            else:
+                # perturbation and optimizer state where each sample stops
+                final = WarmStart(torch.zeros_like(z_orig_))
+            loss_at_previous_check = torch.zeros_like(const_) + 1e9
 
             # create a new optimizer
-            optimizer = optim.Adam([z_delta], lr=learning_rate)
+            z_delta, optimizer = warm.start(
+                active, optim.Adam, lr=learning_rate)
 
             for iteration in range(max_iterations):
                 optimizer.zero_grad()
-                x = to_model_space(z_orig + z_delta)
+                x = to_model_space(z_orig_ + z_delta)
                 logits = net(x)
                 loss, l2dist = self.loss_function(
-                    x, label, logits, targeted, const, x_recon, confidence)
-                loss.backward()
-                optimizer.step()
+                    x, label_, logits, targeted, const_, x_recon_, confidence)
+                # normalize by the full batch size so that the gradient of
+                # each sample does not depend on how many are still active
+                with stage('attack.backward', batch=loss.size(0)):
+                    (loss.sum() / batch_size).backward()
+                    optimizer.step()
 
                 if iteration % (np.ceil(max_iterations / 10)) == 0:
                     print('    step: %d; loss: %.3f; l2dist: %.3f' %
-                          (iteration, loss.cpu().detach().numpy(),
+                          (iteration, loss.mean().cpu().detach().numpy(),
                            l2dist.mean().cpu().detach().numpy()))
 
-                if abort_early and iteration % (np.ceil(max_iterations / 10)) == 0:
-                    # after each tenth of the iterations, check progress
-                    if torch.gt(loss, .9999 * loss_at_previous_check):
-                        break  # stop Adam if there has not been progress
+                # samples that stop here: no progress since the last check
+                # (after each tenth of the iterations), or last iteration
+                check = (abort_early and
+                         iteration % (np.ceil(max_iterations / 10)) == 0)
+                last = iteration == max_iterations - 1
+                if not (check or last):
+                    continue
+                loss = loss.detach()
+                done = torch.zeros_like(loss, dtype=torch.bool)
+                if check:
+                    done = torch.gt(loss, .9999 * loss_at_previous_check)
                     loss_at_previous_check = loss
-
-            with torch.no_grad():
-                is_adv = self.check_adv(
-                    logits, label, targeted, confidence)
-
-            for i in range(batch_size):
-                if is_adv[i]:
-                    # sucessfully find adv
-                    upper_bound[i] = const[i]
-                else:
-                    # fail to find adv
-                    lower_bound[i] = const[i]
-
-            for i in range(batch_size):
-                if upper_bound[i] == 1e9:
-                    # exponential search if adv has not been found
-                    const[i] *= 10
-                else:
-                    # binary search if adv has been found
-                    const[i] = (lower_bound[i] + upper_bound[i]) / 2
-                # only keep adv with smallest l2dist
-                if is_adv[i] and best_l2dist[i] > l2dist[i]:
-                    x_adv[i] = x[i]
-                    best_l2dist[i] = l2dist[i]
-
-            with torch.no_grad():
-                logits = net(x_adv)
-                is_adv = self.check_adv(logits, label, targeted, confidence)
+                if last:
+                    done[:] = True
+                if not done.any():
+                    continue
+
+                x_final[pos[done]] = x.detach()[done]
+                l2dist_final[pos[done]] = l2dist.detach()[done]
+                with torch.no_grad():
+                    is_adv[pos[done]] = self.check_adv(
+                        logits[done], label_[done], targeted, confidence)
+                if warm_start:
+                    final.save(optimizer, z_delta, done, pos[done])
+                if done.all():
+                    break
+                # drop finished samples from the batch
+                keep = ~done
+                pos = pos[keep]
+                z_orig_, x_recon_ = z_orig_[keep], x_recon_[keep]
+                label_, const_ = label_[keep], const_[keep]
+                loss_at_previous_check = loss_at_previous_check[keep]
+                z_delta = compact_optimizer(optimizer, z_delta, keep)
+
+            update_const(const, lower_bound, upper_bound, is_adv, active, 1e9)
+            # only keep adv with smallest l2dist
+            better = update_best(x_adv, best_l2dist, x_final, l2dist_final,
+                                 is_adv, active)
+            if warm_start:
+                # resume from the best adversarial example, or from where the
+                # optimization stopped if none has been found
+                resume = better | (best_l2dist[active] == 1e9)
+                warm.update(final, resume, active[resume])
+
+            # success is tracked from the logits of the optimization loop, a
+            # sample has an adversarial example once its best_l2dist is set
+            num_adv = (best_l2dist < 1e9).sum().item()
             print('binary step: %d; number of successful adv: %d/%d' %
-                  (binary_search_step, is_adv.sum().cpu().numpy(), batch_size))
+                  (binary_search_step, num_adv, batch_size))
 
         return x_adv
 
@@ -130,14 +186,14 @@ class CWL2Attack(object):
     def check_adv(cls, logits, label, targeted, confidence):
         if targeted:
             return torch.eq(torch.argmax(logits - confidence, 1),
-                            label.squeeze())
-        return torch.ne(torch.argmax(logits - confidence, 1), label.squeeze())
+                            label.view(-1))
+        return torch.ne(torch.argmax(logits - confidence, 1), label.view(-1))
 
     @classmethod
     def loss_function(cls, x, label, logits, targeted, const, x_recon,
                       confidence):
-        """Returns the loss and the gradient of the loss w.r.t. x,
-        assuming that logits = model(x)."""
+        """Returns the loss of each sample and the L-2 norm of the
+        perturbation, assuming that logits = model(x)."""
 
         other = cls.best_other_class(logits, label)
         if targeted:
@@ -148,9 +204,9 @@ class CWL2Attack(object):
 
         size = x.size(1) * x.size(2) * x.size(3)
         l2dist = torch.norm((x - x_recon).view(-1, size), dim=1)**2
-        total_loss = l2dist + const * adv_loss.squeeze()
+        total_loss = l2dist + const * adv_loss.view(-1)
 
-        return total_loss.mean(), l2dist.sqrt()
+        return total_loss, l2dist.sqrt()
 
     @staticmethod
     def best_other_class(logits, exclude):
@@ -7,15 +7,81 @@ import pickle
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import torchvision
 import torchvision.transforms as transforms
 from PIL import Image
 from torch.utils.data import Dataset
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.sampler import Sampler, SubsetRandomSampler
 
 from sklearn.model_selection import train_test_split
 
 
+class SubsetDistributedSampler(Sampler):
+    """
+    Distributed counterpart of SubsetRandomSampler: each process draws its
+    own shard of <indices>. Call set_epoch() at the start of every epoch to
+    reshuffle (Trainer does this).
+    """
+
+    def __init__(self, indices, num_replicas=None, rank=None, shuffle=True,
+                 pad=True, seed=0):
+        """
+        Parameters
+        ----------
+        indices : list
+            indices of the dataset to sample from
+        num_replicas : int, optional
+            number of processes (Default is the world size)
+        rank : int, optional
+            rank of this process (Default is the rank in the process group)
+        shuffle : bool, optional
+            shuffle the indices every epoch (Default is True)
+        pad : bool, optional
+            repeat a few indices so that every process gets the same number
+            of samples. Needed for training where every process has to run
+            the same number of steps. Set to False for evaluation so that
+            each sample is counted once (Default is True)
+        seed : int, optional
+            seed of the shuffling, must be the same on every process
+            (Default is 0)
+        """
+        if num_replicas is None:
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            rank = dist.get_rank()
+        self.indices = list(indices)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.pad = pad
+        self.seed = seed
+        self.epoch = 0
+
+    def _shard_size(self):
+        if self.pad:
+            return int(np.ceil(len(self.indices) / self.num_replicas))
+        return len(range(self.rank, len(self.indices), self.num_replicas))
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            perm = torch.randperm(len(indices), generator=g).tolist()
+            indices = [indices[i] for i in perm]
+        if self.pad:
+            total_size = self._shard_size() * self.num_replicas
+            indices = indices + indices[:total_size - len(indices)]
+        return iter(indices[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return self._shard_size()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
 def rotate_img(img, rot):
     if rot == 0:  # 0 degrees rotation
         return img
@@ -135,8 +201,11 @@ def load_cifar10(batch_size,
                  normalize=True,
                  augment=True,
                  shuffle=True,
-                 seed=1):
-    """Load CIFAR-10 data into train/val/test data loader"""
+                 seed=1,
+                 distributed=False):
+    """Load CIFAR-10 data into train/val/test data loader. If <distributed>,
+    every split is sharded across the processes of the default process group
+    and <batch_size> is the batch size per process."""
 
     mean = (0.4914, 0.4822, 0.4465)
     std = (0.2023, 0.1994, 0.2010)
@@ -185,8 +254,16 @@ def load_cifar10(batch_size,
         np.random.shuffle(indices)
 
     train_idx, valid_idx = indices[split:], indices[:split]
-    train_sampler = SubsetRandomSampler(train_idx)
-    valid_sampler = SubsetRandomSampler(valid_idx)
+    if distributed:
+        train_sampler = SubsetDistributedSampler(train_idx, seed=seed)
+        valid_sampler = SubsetDistributedSampler(
+            valid_idx, shuffle=False, pad=False)
+        test_sampler = SubsetDistributedSampler(
+            range(len(testset)), shuffle=False, pad=False)
+    else:
+        train_sampler = SubsetRandomSampler(train_idx)
+        valid_sampler = SubsetRandomSampler(valid_idx)
+        test_sampler = None
 
     trainloader = torch.utils.data.DataLoader(
         trainset, batch_size=batch_size, sampler=train_sampler,
@@ -195,7 +272,8 @@ def load_cifar10(batch_size,
         validset, batch_size=batch_size, sampler=valid_sampler,
         num_workers=num_workers)
     testloader = torch.utils.data.DataLoader(
-        testset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        testset, batch_size=batch_size, shuffle=False, sampler=test_sampler,
+        num_workers=num_workers)
 
     return trainloader, validloader, testloader
 
@@ -242,22 +320,35 @@ def load_cifar10_all(data_dir='./data', val_size=0.1, shuffle=True, seed=1):
 
 
 def load_cifar10_rot(batch_size, data_dir='./data', val_size=0.1, shuffle=True,
-                     seed=1):
+                     seed=1, distributed=False):
 
     (x_train, _), (x_valid, _), (x_test, _) = load_cifar10_all(
         data_dir, val_size=val_size, seed=seed)
 
     traindataset = RotateDataset(x_train.numpy().transpose(0, 2, 3, 1))
-    trainloader = torch.utils.data.DataLoader(
-        traindataset, batch_size=batch_size, shuffle=shuffle, num_workers=4)
-
     validdataset = RotateDataset(x_valid.numpy().transpose(0, 2, 3, 1))
-    validloader = torch.utils.data.DataLoader(
-        validdataset, batch_size=batch_size, shuffle=False, num_workers=4)
-
     testdataset = RotateDataset(x_test.numpy().transpose(0, 2, 3, 1))
+    if distributed:
+        train_sampler = SubsetDistributedSampler(
+            range(len(traindataset)), shuffle=shuffle, seed=seed)
+        valid_sampler = SubsetDistributedSampler(
+            range(len(validdataset)), shuffle=False, pad=False)
+        test_sampler = SubsetDistributedSampler(
+            range(len(testdataset)), shuffle=False, pad=False)
+        # shuffling is done by the sampler
+        shuffle = False
+    else:
+        train_sampler = valid_sampler = test_sampler = None
+
+    trainloader = torch.utils.data.DataLoader(
+        traindataset, batch_size=batch_size, shuffle=shuffle,
+        sampler=train_sampler, num_workers=4)
+    validloader = torch.utils.data.DataLoader(
+        validdataset, batch_size=batch_size, shuffle=False,
+        sampler=valid_sampler, num_workers=4)
     testloader = torch.utils.data.DataLoader(
-        testdataset, batch_size=batch_size, shuffle=False, num_workers=4)
+        testdataset, batch_size=batch_size, shuffle=False,
+        sampler=test_sampler, num_workers=4)
 
     return trainloader, validloader, testloader
 
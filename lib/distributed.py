@@ -0,0 +1,95 @@
+'''
+Helpers for multi-process training with DistributedDataParallel. Works on
+CPU with the gloo backend and on GPU with nccl. Scripts are launched with
+torchrun, e.g.
+    torchrun --nnodes=2 --nproc_per_node=8 --rdzv_endpoint=<host>:<port>
+        adv_train_cifar10.py
+'''
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def is_distributed():
+    """Return True if the default process group is initialized"""
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def launched_distributed():
+    """Return True if the script was started by torchrun with more than one
+    process"""
+    return int(os.environ.get('WORLD_SIZE', 1)) > 1
+
+
+def init_distributed(backend=None):
+    """Initialize the default process group from the environment variables
+    set by torchrun and return the device of this process
+
+    Parameters
+    ----------
+    backend : str, optional
+        'gloo' or 'nccl'. Default is nccl if CUDA is available, otherwise
+        gloo
+
+    Returns
+    -------
+    device : str
+        'cuda:<local_rank>' or 'cpu'
+    """
+    use_cuda = torch.cuda.is_available() and backend != 'gloo'
+    if backend is None:
+        backend = 'nccl' if use_cuda else 'gloo'
+    dist.init_process_group(backend=backend)
+
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if use_cuda:
+        torch.cuda.set_device(local_rank)
+        return 'cuda:%d' % local_rank
+
+    # split the cores of this node between its processes, otherwise every
+    # process spawns one thread per core and they oversubscribe the CPU
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    num_threads = max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(num_threads)
+    return 'cpu'
+
+
+def wrap_ddp(net, device):
+    """Wrap <net> (already on <device>) with DistributedDataParallel"""
+    if str(device).startswith('cuda'):
+        index = torch.device(device).index
+        return DistributedDataParallel(net, device_ids=[index],
+                                       output_device=index)
+    return DistributedDataParallel(net)
+
+
+def all_reduce_sum(tensor):
+    """Sum <tensor> over all processes in place and return it. No-op when
+    not running distributed."""
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
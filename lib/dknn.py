@@ -1,10 +1,16 @@
 '''
 Define multiple Deep k-Nearest Neighbor objects
 '''
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 import faiss
 from lib.faiss_utils import *
+from lib.profiler import profiled, stage
 
 
 class DKNNL2(object):
@@ -14,7 +20,7 @@ class DKNNL2(object):
     """
 
     def __init__(self, model, x_train, y_train, x_cal, y_cal, layers, k=75,
-                 num_classes=10, device='cuda'):
+                 num_classes=10, device='cuda', cache_size=0):
         """
         Parameters
         ----------
@@ -40,6 +46,13 @@ class DKNNL2(object):
             the number of classes (default is 10)
         device : str, optional
             name of the device model is on (default is 'cuda')
+        cache_size : int, optional
+            number of class counts of single samples that classify and
+            predict keep in an LRU cache keyed by the bytes of the sample,
+            0 disables the cache. Hashing costs a copy of every sample, so
+            only enable it when inputs repeat (e.g. queries of decision-based
+            attacks or of a server). Call clear_cache after changing the model
+            (default is 0)
         """
         self.model = model
         self.x_train = x_train
@@ -50,6 +63,18 @@ class DKNNL2(object):
         self.device = device
         self.indices = []
         self.activations = {}
+        # labels as numpy array for the neighbor search, and buffer of the
+        # vote counts used by predict
+        self.y_train_np = y_train.cpu().numpy()
+        self._counts = np.zeros((num_classes, ), dtype=np.int64)
+        # the id of a training sample in the indices is its row in x_train.
+        # Removed samples keep their row and are only marked inactive.
+        self.active = np.ones((x_train.size(0), ), dtype=bool)
+        # LRU cache of classify, guarded by _cache_lock with its stats
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.reset_cache_stats()
 
         # register hook to get representations
         layer_count = 0
@@ -69,11 +94,190 @@ class DKNNL2(object):
             index = self._build_index(rep)
             self.indices.append(index)
 
-        # set up calibration for credibility score
-        y_pred = self.classify(x_cal)
-        self.A = np.zeros((x_cal.size(0), )) + self.k * len(self.layers)
-        for i, (y_c, y_p) in enumerate(zip(y_cal, y_pred)):
-            self.A[i] -= y_p[y_c]
+        # set up calibration for credibility score. The neighbors of the
+        # calibration samples are kept to find the ones affected by changes
+        # of the training set. A is the nonconformity score of each
+        # calibration sample (-1 until it is computed) and _A_counts the
+        # number of calibration samples with each score: scores are
+        # integers in [0, k * len(layers)], so inserting or removing one is
+        # O(1) and credibility is a lookup in the suffix sums.
+        self.x_cal = x_cal[:0]
+        self.y_cal = y_cal[:0]
+        self.A = np.zeros((0, ))
+        self._A_counts = np.zeros((k * len(layers) + 1, ), dtype=np.int64)
+        self._cal_ids = np.zeros((0, ), dtype=np.int64)
+        self._next_cal_id = 0
+        self._cal_kth = np.zeros((len(layers), 0), dtype=np.float32)
+        self._cal_I = np.zeros((len(layers), 0, k), dtype=np.int64)
+        self.add_calibration_samples(x_cal, y_cal)
+
+    def _calibrate(self, rows):
+        """Compute the calibration statistics of the calibration samples
+        <rows> from their current neighbors"""
+        if len(rows) == 0:
+            return
+        nb = self.get_neighbors(self.x_cal[torch.from_numpy(rows)])
+        class_counts = np.zeros((len(rows), self.num_classes))
+        for l, (D, I) in enumerate(nb):
+            self._cal_kth[l, rows] = D[:, -1]
+            self._cal_I[l, rows] = -1
+            self._cal_I[l, rows, :I.shape[1]] = I
+            y_pred = self.y_train_np[I]
+            for i in range(len(rows)):
+                class_counts[i] += np.bincount(
+                    y_pred[i], minlength=self.num_classes)
+        y_cal = self.y_cal.cpu().numpy()[rows]
+        old = self.A[rows]
+        np.subtract.at(self._A_counts, old[old >= 0].astype(np.int64), 1)
+        self.A[rows] = (self.k * len(self.layers) -
+                        class_counts[np.arange(len(rows)), y_cal])
+        np.add.at(self._A_counts, self.A[rows].astype(np.int64), 1)
+
+    def add_calibration_samples(self, x, y):
+        """Add samples to the calibration set and compute their
+        nonconformity scores
+
+        Parameters
+        ----------
+        x : torch.tensor
+            new calibration samples, shape (num_samples, ) + input_shape
+        y : torch.tensor
+            labels of x
+
+        Returns
+        -------
+        ids : np.array
+            ids of the new calibration samples, increasing in the order they
+            are added
+        """
+        num = x.size(0)
+        ids = np.arange(self._next_cal_id, self._next_cal_id + num)
+        self._next_cal_id += num
+        rows = np.arange(self.A.shape[0], self.A.shape[0] + num)
+        self.x_cal = torch.cat([self.x_cal, x.to(self.x_cal.device)])
+        self.y_cal = torch.cat([self.y_cal, y.to(self.y_cal.device)])
+        self.A = np.concatenate([self.A, np.zeros((num, )) - 1])
+        self._cal_ids = np.concatenate([self._cal_ids, ids])
+        self._cal_kth = np.concatenate(
+            [self._cal_kth, np.zeros((len(self.layers), num),
+                                     dtype=np.float32)], 1)
+        self._cal_I = np.concatenate(
+            [self._cal_I, np.zeros((len(self.layers), num, self.k),
+                                   dtype=np.int64)], 1)
+        self._calibrate(rows)
+        return ids
+
+    def remove_calibration_samples(self, ids):
+        """Remove samples from the calibration set
+
+        Parameters
+        ----------
+        ids : np.array
+            ids of the calibration samples to remove (as returned by
+            add_calibration_samples)
+        """
+        remove = np.isin(self._cal_ids, ids)
+        np.subtract.at(self._A_counts, self.A[remove].astype(np.int64), 1)
+        keep = ~remove
+        self.x_cal = self.x_cal[torch.from_numpy(keep)]
+        self.y_cal = self.y_cal[torch.from_numpy(keep)]
+        self.A = self.A[keep]
+        self._cal_ids = self._cal_ids[keep]
+        self._cal_kth = self._cal_kth[:, keep]
+        self._cal_I = self._cal_I[:, keep]
+
+    def calibrate_stream(self, x, y, window):
+        """Sliding-window calibration over a stream of labelled samples: add
+        (x, y) to the calibration set and remove the oldest calibration
+        samples so that only the last <window> remain
+
+        Parameters
+        ----------
+        x : torch.tensor
+            new labelled samples, shape (num_samples, ) + input_shape
+        y : torch.tensor
+            labels of x
+        window : int
+            number of calibration samples to keep
+        """
+        self.add_calibration_samples(x[-window:], y[-window:])
+        # ids increase with the order samples are added
+        num_old = self._cal_ids.shape[0] - window
+        if num_old > 0:
+            self.remove_calibration_samples(self._cal_ids[:num_old])
+
+    def add_training_samples(self, x, y, recalibrate=True):
+        """Add samples to the training set without rebuilding the indices
+
+        Parameters
+        ----------
+        x : torch.tensor
+            new training samples, shape (num_samples, ) + input_shape
+        y : torch.tensor
+            labels of x
+        recalibrate : bool, optional
+            update the calibration statistics of the calibration samples
+            that get one of the new samples among their k nearest neighbors
+            (Default is True)
+
+        Returns
+        -------
+        ids : np.array
+            ids (rows in x_train) of the new samples
+        """
+        ids = np.arange(self.x_train.size(0), self.x_train.size(0) + x.size(0))
+        reps = self.get_activations(x, requires_grad=False)
+        reps = {layer: reps[layer].view(x.size(0), -1).cpu().numpy()
+                for layer in self.layers}
+        for layer, index in zip(self.layers, self.indices):
+            index.add_with_ids(reps[layer], ids)
+        self.x_train = torch.cat([self.x_train, x.to(self.x_train.device)])
+        self.y_train = torch.cat([self.y_train, y.to(self.y_train.device)])
+        self.y_train_np = np.concatenate([self.y_train_np, y.cpu().numpy()])
+        self.active = np.concatenate([self.active,
+                                      np.ones((x.size(0), ), dtype=bool)])
+        self.clear_cache()
+
+        if recalibrate:
+            # a calibration sample is affected if a new sample is closer
+            # than its current k-th neighbor at some layer
+            cal_reps = self.get_activations(self.x_cal, requires_grad=False)
+            # every calibration sample is affected if it had fewer than k
+            # neighbors
+            affected = np.zeros((self.x_cal.size(0), ), dtype=bool) + (
+                self.indices[0].ntotal - x.size(0) < self.k)
+            for l, layer in enumerate(self.layers):
+                new_index = faiss.IndexFlatL2(reps[layer].shape[1])
+                new_index.add(reps[layer])
+                rep = cal_reps[layer].view(self.x_cal.size(0), -1)
+                D, _ = new_index.search(rep.cpu().numpy(), 1)
+                affected |= D[:, 0] <= self._cal_kth[l]
+            self._calibrate(np.where(affected)[0])
+        return ids
+
+    def remove_training_samples(self, ids, recalibrate=True):
+        """Remove samples from the training set without rebuilding the
+        indices. Their rows stay in x_train so that the ids of the other
+        samples do not change, but they are never returned as neighbors.
+
+        Parameters
+        ----------
+        ids : np.array
+            ids (rows in x_train) of the samples to remove
+        recalibrate : bool, optional
+            update the calibration statistics of the calibration samples
+            that have one of the removed samples among their k nearest
+            neighbors (Default is True)
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        for index in self.indices:
+            index.remove_ids(ids)
+        self.active[ids] = False
+        self.clear_cache()
+
+        if recalibrate:
+            affected = np.isin(self._cal_I, ids).any(2).any(0)
+            self._calibrate(np.where(affected)[0])
 
     def _get_activation(self, name):
         """Hook used to get activation from specified layer name
@@ -112,10 +316,12 @@ class DKNNL2(object):
         # res = faiss.StandardGpuResources()
         # index = faiss.GpuIndexFlatIP(res, d)
 
-        # brute-force search on CPU
-        index = faiss.IndexFlatL2(d)
+        # brute-force search on CPU, with ids so that samples can be
+        # removed later (id of each sample is its row in x_train)
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(d))
 
-        index.add(xb.detach().cpu().numpy())
+        index.add_with_ids(xb.detach().cpu().numpy(),
+                           np.arange(xb.size(0), dtype=np.int64))
         return index
 
     def get_activations(self, x, batch_size=500, requires_grad=True,
@@ -158,16 +364,18 @@ class DKNNL2(object):
         with torch.set_grad_enabled(requires_grad):
             for i in range(num_batches):
                 begin, end = i * batch_size, (i + 1) * batch_size
-                # run a forward pass, the attribute self.activations get set
-                # to activations of the current batch
-                self.model(x[begin:end].to(device))
-                # copy the extracted activations to the dictionary of
-                # tensor allocated earlier
-                for layer in self.layers:
-                    activations[layer][begin:end] = self.activations[layer]
+                with stage('dknn.forward', batch=x[begin:end].size(0)):
+                    # run a forward pass, the attribute self.activations get
+                    # set to activations of the current batch
+                    self.model(x[begin:end].to(device))
+                    # copy the extracted activations to the dictionary of
+                    # tensor allocated earlier
+                    for layer in self.layers:
+                        activations[layer][begin:end] = \
+                            self.activations[layer]
             return activations
 
-    def get_neighbors(self, x, k=None, layers=None):
+    def get_neighbors(self, x, k=None, layers=None, reps=None):
         """Find k neighbors of x at specified layers
 
         Parameters
@@ -175,9 +383,15 @@ class DKNNL2(object):
         x : torch.tensor
             samples to query, shape (num_samples, ) + input_shape
         k : int, optional
-            number of neighbors (Default is self.k)
+            number of neighbors, capped at the number of training samples
+            in the indices so that removed samples are never returned
+            (faiss pads missing neighbors with id -1) (Default is self.k)
         layers : list of str
             list of layer names to find neighbors on (Default is self.layers)
+        reps : dict, optional
+            activations of x (output of get_activations) if they have already
+            been computed, e.g. by the forward pass of an attack. Skips the
+            forward pass (Default is None)
 
         Returns
         -------
@@ -188,27 +402,89 @@ class DKNNL2(object):
             k = self.k
         if layers is None:
             layers = self.layers
+        k = min(k, self.indices[0].ntotal)
 
         output = []
-        reps = self.get_activations(x, requires_grad=False)
+        if reps is None:
+            reps = self.get_activations(x, requires_grad=False)
         for layer, index in zip(self.layers, self.indices):
             if layer in layers:
                 rep = reps[layer].view(x.size(0), -1)
-                rep = rep.detach().cpu().numpy()
-                D, I = index.search(rep, k)
+                with stage('dknn.to_host', nbytes=rep.numel() * 4):
+                    rep = rep.detach().cpu().numpy()
+                with stage('dknn.search', batch=x.size(0)):
+                    D, I = index.search(rep, k)
                 # D, I = search_index_pytorch(index, reps[layer], k)
                 # uncomment when using GPU
                 # res.syncDefaultStreamCurrentDevice()
                 output.append((D, I))
         return output
 
-    def classify(self, x):
+    def reset_cache_stats(self):
+        with self._cache_lock:
+            self._cache_stats = {'queries': 0, 'hits': 0}
+
+    def cache_stats(self):
+        """Return the number of samples queried through the cache (by
+        classify and predict) and answered from it since the last reset, the
+        hit rate and the number of cached samples"""
+        with self._cache_lock:
+            stats = dict(self._cache_stats)
+            stats['size'] = len(self._cache)
+        stats['hit_rate'] = stats['hits'] / max(1, stats['queries'])
+        return stats
+
+    def clear_cache(self):
+        """Drop the cached class counts, e.g. after the neighbors change"""
+        with self._cache_lock:
+            self._cache.clear()
+
+    def _cache_key(self, sample):
+        return (self.k, sample.shape, sample.dtype.str,
+                hashlib.sha1(sample.tobytes()).digest())
+
+    def _use_cache(self, x):
+        return self.cache_size > 0 and not (x.requires_grad and
+                                            torch.is_grad_enabled())
+
+    def _cache_keys(self, x):
+        """Cache keys of the samples <x>, shape (num_samples, ) +
+        input_shape"""
+        samples = np.ascontiguousarray(x.detach().cpu().numpy())
+        return [self._cache_key(sample) for sample in samples]
+
+    def _cache_get(self, keys):
+        """Return the cached class counts of each key (None if missing)"""
+        with self._cache_lock:
+            counts = [self._cache.get(key) for key in keys]
+            for key, c in zip(keys, counts):
+                if c is not None:
+                    self._cache.move_to_end(key)
+            self._cache_stats['queries'] += len(keys)
+            self._cache_stats['hits'] += sum(c is not None for c in counts)
+        return counts
+
+    def _cache_put(self, keys, class_counts):
+        with self._cache_lock:
+            for key, counts in zip(keys, class_counts):
+                self._cache[key] = counts.copy()
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def classify(self, x, reps=None):
         """Find number of k-nearest neighbors in each class
 
+        Class counts of samples classified before are served from an LRU
+        cache (see cache_size). The cache is skipped when <x> requires
+        gradients.
+
         Arguments
         ---------
         x : torch.tensor
             samples to query, shape is (num_samples, ) + input_shape
+        reps : dict, optional
+            activations of x if they have already been computed (see
+            get_neighbors)
 
         Returns
         -------
@@ -216,18 +492,196 @@ class DKNNL2(object):
             array of numbers of neighbors in each class, shape is
             (num_samples, self.num_classes)
         """
-        nb = self.get_neighbors(x)
+        if not self._use_cache(x):
+            return self._classify(x, reps=reps)
+
+        keys = self._cache_keys(x)
+        cached = self._cache_get(keys)
         class_counts = np.zeros((x.size(0), self.num_classes))
-        for (_, I) in nb:
-            y_pred = self.y_train.cpu().numpy()[I]
-            for i in range(x.size(0)):
-                class_counts[i] += np.bincount(
-                    y_pred[i], minlength=self.num_classes)
+        missing = []
+        for i, counts in enumerate(cached):
+            if counts is None:
+                missing.append(i)
+            else:
+                class_counts[i] = counts
+        if not missing:
+            return class_counts
+
+        if len(missing) < x.size(0):
+            ind = torch.tensor(missing)
+            x = x[ind.to(x.device)]
+            if reps is not None:
+                reps = {layer: rep[ind.to(rep.device)]
+                        for layer, rep in reps.items()}
+        class_counts[missing] = self._classify(x, reps=reps)
+        self._cache_put([keys[i] for i in missing], class_counts[missing])
+        return class_counts
+
+    def _classify(self, x, reps=None):
+        """classify without the cache"""
+        nb = self.get_neighbors(x, reps=reps)
+        with stage('dknn.vote', batch=x.size(0)):
+            class_counts = np.zeros((x.size(0), self.num_classes))
+            for (_, I) in nb:
+                y_pred = self.y_train_np[I]
+                for i in range(x.size(0)):
+                    class_counts[i] += np.bincount(
+                        y_pred[i], minlength=self.num_classes)
         return class_counts
 
-    def predict(self, x):
-        """Predict label of single sample x"""
-        return self.classify(x.unsqueeze(0))[0].argmax()
+    @profiled('dknn.search_block')
+    def _search_block(self, index, rep, k, begin, D, I, counts):
+        """Search one batch of representations and write its distances,
+        indices and (if <counts> is not None) class counts at <begin>"""
+        D_batch, I_batch = index.search(rep, k)
+        end = begin + rep.shape[0]
+        D[begin:end], I[begin:end] = D_batch, I_batch
+        if counts is not None:
+            # bincount of every row at once
+            y = self.y_train_np[I_batch]
+            y = y + self.num_classes * np.arange(rep.shape[0])[:, np.newaxis]
+            counts[begin:end] += np.bincount(
+                y.ravel(), minlength=rep.shape[0] * self.num_classes
+            ).reshape(rep.shape[0], self.num_classes)
+
+    def _run_pipeline(self, x, k, layers, batch_size, num_threads,
+                      max_pending, count):
+        """Run the forward pass of x batch by batch and hand the searches of
+        each batch to a thread pool, so the forward pass of the next batch
+        overlaps them. At most <max_pending> searches are queued so the
+        forward pass does not run too far ahead."""
+        num_total = x.size(0)
+        k = min(k, self.indices[0].ntotal)
+        searched = [(layer, index) for layer, index
+                    in zip(self.layers, self.indices) if layer in layers]
+        D = [np.empty((num_total, k), dtype=np.float32) for _ in searched]
+        I = [np.empty((num_total, k), dtype=np.int64) for _ in searched]
+        # one count array per layer so that threads never write to the
+        # same rows
+        counts = [np.zeros((num_total, self.num_classes), dtype=np.int64)
+                  if count else None for _ in searched]
+        pending = deque()
+        with ThreadPoolExecutor(num_threads) as executor:
+            for begin in range(0, num_total, batch_size):
+                end = min(begin + batch_size, num_total)
+                with torch.no_grad(), stage('dknn.forward',
+                                            batch=end - begin):
+                    self.model(x[begin:end].to(self.device))
+                for j, (layer, index) in enumerate(searched):
+                    rep = self.activations[layer].view(end - begin, -1)
+                    with stage('dknn.to_host', nbytes=rep.numel() * 4):
+                        rep = rep.cpu().numpy()
+                    pending.append(executor.submit(
+                        self._search_block, index, rep, k, begin, D[j], I[j],
+                        counts[j]))
+                while len(pending) > max_pending:
+                    pending.popleft().result()
+            while pending:
+                pending.popleft().result()
+        return D, I, counts
+
+    def get_neighbors_pipelined(self, x, k=None, layers=None,
+                                batch_size=500, num_threads=1,
+                                max_pending=8):
+        """Same as get_neighbors, but the forward pass of each batch of x
+        runs while the faiss searches of the previous batches run on a
+        thread pool, so large sets stream through at the rate of the slower
+        of the two
+
+        Parameters
+        ----------
+        x : torch.tensor
+            samples to query, shape (num_samples, ) + input_shape
+        k : int, optional
+            number of neighbors, capped as in get_neighbors (Default is
+            self.k)
+        layers : list of str
+            list of layer names to find neighbors on (Default is self.layers)
+        batch_size : int, optional
+            number of samples per forward pass (Default is 500)
+        num_threads : int, optional
+            number of search threads. faiss already parallelizes each
+            search, so one thread is usually enough to keep the searches
+            busy (Default is 1)
+        max_pending : int, optional
+            maximum number of queued (batch, layer) searches (Default is 8)
+
+        Returns
+        -------
+        output : list
+            list of len(layers) tuples of distances and indices of k neighbors
+        """
+        if k is None:
+            k = self.k
+        if layers is None:
+            layers = self.layers
+        D, I, _ = self._run_pipeline(x, k, layers, batch_size, num_threads,
+                                     max_pending, False)
+        return list(zip(D, I))
+
+    def classify_pipelined(self, x, batch_size=500, num_threads=1,
+                           max_pending=8):
+        """Same as classify, with the forward pass and the searches
+        pipelined as in get_neighbors_pipelined. The class counts of each
+        batch are accumulated by the search threads as the searches
+        finish."""
+        _, _, counts = self._run_pipeline(x, self.k, self.layers,
+                                          batch_size, num_threads,
+                                          max_pending, True)
+        return np.sum(counts, 0).astype(np.float64)
+
+    def predict(self, x, early_stop=True):
+        """Predict label of single sample x
+
+        Low-latency path for attacks that only need the label: one forward
+        pass without the warm-up of get_activations, and no class_counts
+        matrix. Not thread-safe (the vote counts use a shared buffer).
+        Shares the cache of classify: cached samples are answered without a
+        forward pass, and the counts are cached when every layer was
+        searched (no early stop).
+
+        Parameters
+        ----------
+        x : torch.tensor
+            sample to classify, shape is input_shape
+        early_stop : bool, optional
+            stop searching the remaining layers once one class has more
+            votes than any other class can reach. The label is the same as
+            without early stopping (Default is True)
+
+        Returns
+        -------
+        label : int
+            label predicted by DkNN
+        """
+        keys = None
+        if self._use_cache(x):
+            keys = self._cache_keys(x.unsqueeze(0))
+            cached = self._cache_get(keys)[0]
+            if cached is not None:
+                return cached.argmax()
+
+        with torch.no_grad(), stage('dknn.forward', batch=1):
+            self.model(x.unsqueeze(0).to(self.device))
+        counts = self._counts
+        counts[:] = 0
+        remaining = self.k * len(self.layers)
+        for layer, index in zip(self.layers, self.indices):
+            rep = self.activations[layer].view(1, -1).cpu().numpy()
+            with stage('dknn.search', batch=1):
+                _, I = index.search(rep, min(self.k, index.ntotal))
+            counts += np.bincount(self.y_train_np[I[0]],
+                                  minlength=self.num_classes)
+            remaining -= self.k
+            if early_stop and remaining > 0:
+                second, first = np.partition(counts, -2)[-2:]
+                if first - second > remaining:
+                    break
+        else:
+            # every layer was searched, the counts are complete
+            if keys is not None:
+                self._cache_put(keys, counts[np.newaxis].astype(np.float64))
+        return counts.argmax()
 
     def classify_soft(self, x, layer=None, k=None):
         """(Deprecated) Find average of exponential of distance from the query
@@ -272,11 +726,332 @@ class DKNNL2(object):
     def credibility(self, class_counts):
         """compute credibility of samples given their class_counts"""
         alpha = self.k * len(self.layers) - np.max(class_counts, 1)
-        cred = np.zeros_like(alpha)
-        for i, a in enumerate(alpha):
-            cred[i] = np.sum(self.A >= a)
+        # number of calibration samples with a score of at least each value
+        num_geq = self._A_counts[::-1].cumsum()[::-1]
+        cred = num_geq[alpha.astype(np.int64)]
         return cred / self.A.shape[0]
 
+    def train_activations(self, layer):
+        """Return the flattened training activations at <layer>, read back
+        from its search index
+
+        Parameters
+        ----------
+        layer : str
+            name of the layer
+
+        Returns
+        -------
+        reps : torch.tensor
+            activations of the training samples in the index, shape
+            (num_samples, dim)
+        ids : np.array
+            rows in x_train of these samples
+        """
+        index = self.indices[self.layers.index(layer)]
+        flat = faiss.downcast_index(index.index)
+        reps = flat.reconstruct_n(0, flat.ntotal)
+        ids = faiss.vector_to_array(index.id_map)
+        order = np.argsort(ids)
+        return torch.from_numpy(reps[order]), ids[order]
+
+    def _neighbors_by_class(self, index, rep, label, k):
+        """Return the distances from each row of <rep> to its k nearest
+        training samples of class <label> and to its k nearest samples of
+        the other classes, sorted, and the labels of the latter. Rows are
+        padded with inf (label -1) if there are fewer such samples. The
+        search starts with max(100, 2k) neighbors and is made 10 times
+        larger for the rows that have not found both yet."""
+        num = rep.shape[0]
+        d_same = np.zeros((num, k)) + np.inf
+        d_other = np.zeros((num, k)) + np.inf
+        y_other = np.zeros((num, k), dtype=np.int64) - 1
+        todo = np.arange(num)
+        size = max(100, 2 * k)
+        while todo.size > 0:
+            size = min(size, index.ntotal)
+            D, I = index.search(rep[todo], size)
+            y = self.y_train_np[I]
+            same = y == label[todo, np.newaxis]
+            # the k nearest samples of each group, in order
+            D_same = np.sort(np.where(same, D, np.inf), axis=1)[:, :k]
+            D_other = np.where(same, np.inf, D)
+            order = np.argsort(D_other, axis=1, kind='stable')[:, :k]
+            D_other = np.take_along_axis(D_other, order, 1)
+            y_rows = np.take_along_axis(y, order, 1)
+            cols = D_same.shape[1]
+            d_same[todo, :cols] = D_same
+            d_other[todo, :cols] = D_other
+            y_other[todo, :cols] = np.where(np.isinf(D_other), -1, y_rows)
+            if size == index.ntotal:
+                break
+            todo = todo[np.isinf(d_same[todo, -1]) |
+                        np.isinf(d_other[todo, -1])]
+            size *= 10
+        # faiss returns squared distances
+        return np.sqrt(d_same), np.sqrt(d_other), y_other
+
+    def _nearest_by_class(self, index, rep, label):
+        """Return the distances from each row of <rep> to its nearest
+        training sample of class <label> and of another class"""
+        d_same, d_other, _ = self._neighbors_by_class(index, rep, label, 1)
+        return d_same[:, 0], d_other[:, 0]
+
+    def get_margin_bound(self, x, label, reps=None, batch_size=500):
+        """Compute the 1-NN margin of x at every layer in one pass over x:
+        the distance to the nearest training sample of another class minus
+        the distance to the nearest sample of class <label>. The margin is
+        positive if the 1-NN at that layer is correct, and half of it is a
+        lower bound on the L-2 perturbation of the representation needed to
+        change the 1-NN prediction.
+
+        Parameters
+        ----------
+        x : torch.tensor
+            samples to certify, shape (num_samples, ) + input_shape
+        label : torch.tensor
+            labels of x, shape (num_samples, )
+        reps : dict, optional
+            activations of x if they have already been computed (see
+            get_neighbors)
+        batch_size : int, optional
+            number of samples embedded and searched at a time (Default is
+            500)
+
+        Returns
+        -------
+        margins : dict
+            dict of np.array of the margin of each sample, by layer
+        """
+        num_total = x.size(0)
+        label = np.asarray(label.cpu())
+        margins = {layer: np.zeros((num_total, )) for layer in self.layers}
+        for begin in range(0, num_total, batch_size):
+            end = min(begin + batch_size, num_total)
+            if reps is None:
+                batch_reps = self.get_activations(
+                    x[begin:end], batch_size=batch_size, requires_grad=False)
+            else:
+                batch_reps = {layer: reps[layer][begin:end]
+                              for layer in self.layers}
+            for layer, index in zip(self.layers, self.indices):
+                rep = batch_reps[layer].view(end - begin, -1)
+                rep = rep.detach().cpu().numpy()
+                d_same, d_other = self._nearest_by_class(
+                    index, rep, label[begin:end])
+                margins[layer][begin:end] = d_other - d_same
+        return margins
+
+    def certify(self, x, label, perts, reps=None, batch_size=500):
+        """Certified accuracy of the 1-NN at every layer for perturbations of
+        the representation of L-2 norm up to each of <perts>, from the
+        margins of get_margin_bound (one pass over x)
+
+        Parameters
+        ----------
+        x : torch.tensor
+            samples to certify, shape (num_samples, ) + input_shape
+        label : torch.tensor
+            labels of x, shape (num_samples, )
+        perts : list of float
+            perturbation sizes
+        reps : dict, optional
+            activations of x if they have already been computed
+        batch_size : int, optional
+            number of samples embedded and searched at a time (Default is
+            500)
+
+        Returns
+        -------
+        margins : dict
+            dict of np.array of the margin of each sample, by layer
+        curves : dict
+            dict of np.array with the fraction of samples that are correctly
+            classified for every perturbation of size pert, for each pert in
+            <perts>, by layer
+        """
+        margins = self.get_margin_bound(x, label, reps=reps,
+                                        batch_size=batch_size)
+        curves = {layer: np.array([(margin > 2 * pert).mean()
+                                   for pert in perts])
+                  for layer, margin in margins.items()}
+        return margins, curves
+
+    def _sorted_neighbors(self, index, rep, k):
+        """Return the sorted distances from each row of <rep> to its
+        max(100, 2k) nearest training samples, their labels, and whether
+        these are all the training samples in <index>"""
+        size = min(index.ntotal, max(100, 2 * k))
+        D, I = index.search(rep, size)
+        # faiss returns squared distances
+        return (np.sqrt(np.maximum(D, 0)), self.y_train_np[I],
+                size == index.ntotal)
+
+    @staticmethod
+    def _k_nearest(D, mask, k, pad):
+        """The k smallest distances of each row of <D> where <mask> is set,
+        padded with <pad> (one value per row)"""
+        D = np.sort(np.where(mask, D, np.inf), axis=1)[:, :k]
+        if D.shape[1] < k:
+            D = np.concatenate(
+                [D, np.zeros((D.shape[0], k - D.shape[1])) + np.inf], 1)
+        return np.where(np.isinf(D), pad[:, np.newaxis], D)
+
+    @staticmethod
+    def _count_votes(d_class, before, k):
+        """Number of the samples of a class (sorted distances <d_class>)
+        among the k nearest neighbors when <before> samples of the other
+        classes come before each of them"""
+        rank = np.arange(1, k + 1) + before
+        return (np.isfinite(d_class) & (rank <= k)).sum(1)
+
+    def _vote_bounds(self, neighbors, label, eps, k):
+        """Bounds on the votes summed over layers for any perturbation of
+        the representation at each layer of L-2 norm at most eps * scale.
+        Such a perturbation changes the distance to every training sample
+        by at most eps * scale, so class <label> gets at least the votes it
+        has when its samples are moved eps * scale further and all other
+        samples eps * scale closer. Each class c gets at most the votes it
+        has when only the samples of c are moved closer and all the others
+        (<label> included) further. The bound is computed separately for
+        every c since one perturbation cannot favor all classes at once.
+        Samples beyond the searched neighbors are taken to be at the
+        distance of the last one (<neighbors> is a list of (D, y, full,
+        scale) per layer, see _sorted_neighbors, and <eps> has one entry
+        per query).
+
+        Returns
+        -------
+        lower : np.array
+            lower bound on the votes for class <label>, shape (num, )
+        upper : np.array
+            upper bound on the votes for each class, -1 for class <label>,
+            shape (num, num_classes)
+        """
+        num = label.shape[0]
+        lower = np.zeros((num, ), dtype=np.int64)
+        upper = np.zeros((num, self.num_classes), dtype=np.int64)
+        inf = np.zeros((num, )) + np.inf
+        for D, y, full, scale in neighbors:
+            e = (eps * scale)[:, np.newaxis, np.newaxis]
+            # lower bound on the distance of the samples not searched
+            pad = inf if full else D[:, -1]
+
+            # samples of <label> not searched get no vote, and the other
+            # samples not searched are as close as they can be
+            same = y == label[:, np.newaxis]
+            d_same = self._k_nearest(D, same, k, inf)
+            d_other = self._k_nearest(D, ~same, k, pad)
+            before = (d_other[:, np.newaxis, :] - e <=
+                      d_same[:, :, np.newaxis] + e).sum(2)
+            lower += self._count_votes(d_same, before, k)
+
+            # samples of c not searched are as close as they can be, and
+            # the other samples not searched come after them
+            for c in range(self.num_classes):
+                is_c = y == c
+                d_c = self._k_nearest(D, is_c, k, pad)
+                d_rest = self._k_nearest(D, ~is_c, k, inf)
+                before = (d_rest[:, np.newaxis, :] + e <
+                          d_c[:, :, np.newaxis] - e).sum(2)
+                upper[:, c] += self._count_votes(d_c, before, k)
+        upper[np.arange(num), label] = -1
+        return lower, upper
+
+    def _is_certified(self, neighbors, label, eps, k):
+        """Whether class <label> gets more votes than any other class for
+        every perturbation of size <eps>"""
+        lower, upper = self._vote_bounds(neighbors, label, eps, k)
+        return lower > upper.max(1)
+
+    def certify_knn(self, x, label, perts, k=None, reps=None, scales=None,
+                    batch_size=500, num_steps=30):
+        """Certified robustness of the DkNN vote with k neighbors at every
+        layer, from the sorted distances to the nearest training samples. A
+        perturbation of the representation at a layer of L-2 norm eps
+        changes the distance to every training sample by at most eps, so
+        the votes for the class of x cannot drop below those obtained by
+        moving every sample of that class eps further and every other
+        sample eps closer. The votes for each other class c cannot exceed
+        those obtained by moving only the samples of c eps closer and all
+        the others eps further. x is certified if the former is larger
+        than the latter for every c. Only one pass over x is needed.
+
+        Parameters
+        ----------
+        x : torch.tensor
+            samples to certify, shape (num_samples, ) + input_shape
+        label : torch.tensor
+            labels of x, shape (num_samples, )
+        perts : list of float
+            perturbation sizes of the certified accuracy curve
+        k : int, optional
+            number of neighbors (Default is self.k)
+        reps : dict, optional
+            activations of x if they have already been computed
+        scales : dict, optional
+            the perturbation at each layer is pert * scales[layer], e.g. a
+            Lipschitz constant of the layer to certify perturbations of the
+            input. (Default is 1 at every layer, i.e. the same perturbation
+            size in every representation space)
+        batch_size : int, optional
+            number of samples embedded and searched at a time (Default is
+            500)
+        num_steps : int, optional
+            number of bisection steps on the radius (Default is 30)
+
+        Returns
+        -------
+        radius : np.array
+            certified radius of each sample, 0 if it is not certified
+            (e.g. misclassified) even without perturbation
+        curve : np.array
+            certified accuracy at each pert in <perts>
+        """
+        if k is None:
+            k = self.k
+        if scales is None:
+            scales = {layer: 1. for layer in self.layers}
+        num_total = x.size(0)
+        label = np.asarray(label.cpu())
+        radius = np.zeros((num_total, ))
+        certified = np.zeros((len(perts), num_total), dtype=bool)
+        for begin in range(0, num_total, batch_size):
+            end = min(begin + batch_size, num_total)
+            if reps is None:
+                batch_reps = self.get_activations(
+                    x[begin:end], batch_size=batch_size, requires_grad=False)
+            else:
+                batch_reps = {layer: reps[layer][begin:end]
+                              for layer in self.layers}
+            y = label[begin:end]
+            neighbors = []
+            for layer, index in zip(self.layers, self.indices):
+                rep = batch_reps[layer].view(end - begin, -1)
+                rep = rep.detach().cpu().numpy()
+                D, y_nb, full = self._sorted_neighbors(index, rep, k)
+                neighbors.append((D, y_nb, full, scales[layer]))
+
+            for i, pert in enumerate(perts):
+                certified[i, begin:end] = self._is_certified(
+                    neighbors, y, np.zeros((end - begin, )) + pert, k)
+
+            # bisection on the radius. Every searched sample of the other
+            # classes can be closer than every sample of the class of x at
+            # <hi>.
+            lo = np.zeros((end - begin, ))
+            hi = np.zeros_like(lo)
+            for D, _, _, scale in neighbors:
+                hi = np.maximum(hi, D[:, -1] / (2 * scale))
+            ok = self._is_certified(neighbors, y, lo, k)
+            for _ in range(num_steps):
+                mid = (lo + hi) / 2
+                cert = self._is_certified(neighbors, y, mid, k)
+                lo = np.where(cert, mid, lo)
+                hi = np.where(cert, hi, mid)
+            radius[begin:end] = np.where(ok, lo, 0)
+        return radius, certified.mean(1)
+
     def find_nn_diff_class(self, x, label):
         """Find the nearest neighbor of x that has a different class from the
         given label.
@@ -307,6 +1082,9 @@ class DKNNL2(object):
                 if len(ind) != 0:
                     nn[i] = I[ind[0]]
                     found_diff_class = True
+                elif len(I) == self.indices[0].ntotal:
+                    raise ValueError('no training sample has a class '
+                                     'different from %d' % int(label[i]))
                 else:
                     k *= 10
 
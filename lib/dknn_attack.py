@@ -5,17 +5,30 @@ import torch
 import torch.nn.functional as F
 import torch.optim as optim
 
+from lib.attack_utils import (compact_optimizer, converged_const, select,
+                              update_best, update_const)
+from lib.profiler import profiled, stage
+
 
 class DKNNAttack(object):
     """
+    Attack on DkNN with cosine distance. Samples that stop making progress
+    leave the batch so that the remaining iterations only run on the active
+    ones.
     """
 
+    @profiled('attack.DKNNAttack')
     def __call__(self, dknn, x_orig, label, guide_layer='relu1', m=100,
                  binary_search_steps=5, max_iterations=500,
                  learning_rate=1e-2, initial_const=1, abort_early=True,
-                 max_linf=None):
+                 max_linf=None, const_tol=None):
         """
         x_orig is tensor (requires_grad=False)
+
+        const_tol is the relative tolerance of the binary search: a sample is
+        skipped in the remaining binary search steps once
+        upper_bound - lower_bound <= const_tol * upper_bound. Set to None to
+        always run every step.
         """
 
         min_, max_ = x_orig.min(), x_orig.max()
@@ -39,7 +52,7 @@ class DKNNAttack(object):
             # from (-1, +1) to (-inf, +inf)
             return self.atanh(x)
 
-        def to_model_space(x):
+        def to_model_space(x, min_=min_, max_=max_):
             """Transforms an input from the attack space
             to the model space. This transformation and
             the returned gradient are elementwise."""
@@ -95,72 +108,111 @@ class DKNNAttack(object):
                     # TODO: find out why... it's not obvious why this is useful
                 const = upper_bound
 
-            z_delta = torch.zeros_like(z_orig, requires_grad=True)
-            loss_at_previous_check = torch.zeros(1, device=device) + 1e9
+            # samples attacked in this binary search step
+            active = (~converged_const(lower_bound, upper_bound, const_tol)
+                      ).nonzero().view(-1)
+            if active.size(0) == 0:
+                break
+            # state of the attack at the last iteration of each active sample
+            x_final = torch.zeros_like(x_orig[active])
+            l2dist_final = torch.zeros_like(const[active])
+            is_adv_final = torch.zeros_like(active, dtype=torch.bool)
+
+            # <pos> are the positions in <active> of the samples still
+            # optimized. Per-sample tensors are compacted along with it.
+            pos = torch.arange(active.size(0), device=device)
+            z_orig_, x_recon_, const_ = (z_orig[active], x_recon[active],
+                                         const[active])
+            min_act, max_act = select(min_, active), select(max_, active)
+            guide_reps_ = {l: guide_reps[l][active] for l in dknn.layers}
+            label_ = label[active.cpu().numpy()]
+
+            z_delta = torch.zeros_like(z_orig_, requires_grad=True)
+            loss_at_previous_check = torch.zeros_like(const_) + 1e9
 
             # create a new optimizer
             optimizer = optim.Adam([z_delta], lr=learning_rate)
 
             for iteration in range(max_iterations):
                 optimizer.zero_grad()
-                x = to_model_space(z_orig + z_delta)
+                x = to_model_space(z_orig_ + z_delta, min_act, max_act)
                 reps = dknn.get_activations(x)
                 loss, l2dist = self.loss_function(
-                    x, reps, guide_reps, dknn.layers, const, x_recon, device)
-                loss.backward()
-                optimizer.step()
+                    x, reps, guide_reps_, dknn.layers, const_, x_recon_,
+                    device)
+                # normalize by the full batch size so that the gradient of
+                # each sample does not depend on how many are still active
+                with stage('attack.backward', batch=loss.size(0)):
+                    (loss.sum() / batch_size).backward()
+                    optimizer.step()
 
                 if iteration % (np.ceil(max_iterations / 10)) == 0:
                     print('    step: %d; loss: %.3f; l2dist: %.3f' %
-                          (iteration, loss.cpu().detach().numpy(),
+                          (iteration, loss.mean().cpu().detach().numpy(),
                            l2dist.mean().cpu().detach().numpy()))
 
-                if abort_early and iteration % (np.ceil(max_iterations / 10)) == 0:
-                    # after each tenth of the iterations, check progress
-                    if torch.gt(loss, .9999 * loss_at_previous_check):
-                        break  # stop Adam if there has not been progress
+                # samples that stop here: no progress since the last check
+                # (after each tenth of the iterations), or last iteration
+                check = (abort_early and
+                         iteration % (np.ceil(max_iterations / 10)) == 0)
+                last = iteration == max_iterations - 1
+                if not (check or last):
+                    continue
+                loss = loss.detach()
+                done = torch.zeros_like(loss, dtype=torch.bool)
+                if check:
+                    done = torch.gt(loss, .9999 * loss_at_previous_check)
                     loss_at_previous_check = loss
+                if last:
+                    done[:] = True
+                if not done.any():
+                    continue
+
+                x_final[pos[done]] = x.detach()[done]
+                l2dist_final[pos[done]] = l2dist.detach()[done]
+                # reuse the representations of this step to tell if the
+                # finished samples are adversarial
+                with torch.no_grad():
+                    is_adv_final[pos[done]] = self.check_adv(
+                        dknn, x[done], label_[done.cpu().numpy()],
+                        reps={l: r[done] for l, r in reps.items()}).bool()
+                if done.all():
+                    break
+                # drop finished samples from the batch
+                keep = ~done
+                pos = pos[keep]
+                z_orig_, x_recon_, const_ = (z_orig_[keep], x_recon_[keep],
+                                             const_[keep])
+                min_act, max_act = select(min_act, keep), select(max_act, keep)
+                guide_reps_ = {l: g[keep] for l, g in guide_reps_.items()}
+                label_ = label_[keep.cpu().numpy()]
+                loss_at_previous_check = loss_at_previous_check[keep]
+                z_delta = compact_optimizer(optimizer, z_delta, keep)
+
+            is_adv = is_adv_final
+            print(is_adv.sum())
+
+            update_const(const, lower_bound, upper_bound, is_adv, active, 1e9)
+            # only keep adv with smallest l2dist
+            update_best(x_adv, best_l2dist, x_final, l2dist_final, is_adv,
+                        active)
 
-            with torch.no_grad():
-                is_adv = self.check_adv(dknn, x, label)
-                print(is_adv.sum())
-
-            for i in range(batch_size):
-                # set new upper and lower bounds
-                if is_adv[i]:
-                    upper_bound[i] = const[i]
-                else:
-                    lower_bound[i] = const[i]
-                # set new const
-                if upper_bound[i] == 1e9:
-                    # exponential search if adv has not been found
-                    const[i] *= 10
-                else:
-                    # binary search if adv has been found
-                    const[i] = (lower_bound[i] + upper_bound[i]) / 2
-                # only keep adv with smallest l2dist
-                if is_adv[i] and best_l2dist[i] > l2dist[i]:
-                    x_adv[i] = x[i]
-                    best_l2dist[i] = l2dist[i]
-
-            with torch.no_grad():
-                is_adv = self.check_adv(dknn, x_adv, label)
             print('binary step: %d; number of successful adv: %d/%d' %
-                  (binary_search_step, is_adv.sum(), batch_size))
+                  (binary_search_step, (best_l2dist < 1e9).sum(),
+                   batch_size))
 
         return x_adv
 
     @classmethod
-    def check_adv(cls, dknn, x, label):
-        y_pred = dknn.classify(x).argmax(1)
+    def check_adv(cls, dknn, x, label, reps=None):
+        y_pred = dknn.classify(x, reps=reps).argmax(1)
         return torch.tensor((y_pred != label).astype(np.float32)).to(dknn.device)
         # y_pred = dknn.classify_soft(x).argmax(1)
         # return (y_pred != torch.tensor(label)).to(dknn.device)
 
     @classmethod
     def loss_function(cls, x, reps, guide_reps, layers, const, x_recon, device):
-        """Returns the loss and the gradient of the loss w.r.t. x,
-        assuming that logits = model(x)."""
+        """Returns the loss of each sample and its l2 distance to x_recon."""
 
         batch_size = x.size(0)
         adv_loss = torch.zeros((batch_size, len(layers)), device=device)
@@ -198,7 +250,7 @@ class DKNNAttack(object):
         l2dist = torch.norm((x - x_recon).view(batch_size, -1), dim=1)**2
         total_loss = l2dist - const * adv_loss.mean(1)
 
-        return total_loss.mean(), l2dist.sqrt()
+        return total_loss, l2dist.sqrt()
 
     @staticmethod
     def find_guide_samples(dknn, x, label, k=100, layer='relu1'):
@@ -7,13 +7,19 @@ import torch
 import torch.nn.functional as F
 import torch.optim as optim
 
+from lib.attack_utils import (WarmStart, compact_optimizer, converged_const,
+                              select, update_best, update_const)
+from lib.profiler import profiled, stage
+
 INFTY = 1e20
 
 
 class DKNNExpAttack(object):
     """
     Implement gradient-based attack on Deep k-Nearest Neigbhor that uses
-    L-2 distance as a metric
+    L-2 distance as a metric. With abort_early, samples that stop making
+    progress leave the batch so that the remaining iterations only run on the
+    active ones.
     """
 
     def __init__(self, dknn):
@@ -24,11 +30,13 @@ class DKNNExpAttack(object):
         self.thres = None
         self.coeff = None
 
+    @profiled('attack.DKNNExpAttack')
     def __call__(self, x_orig, label, guide_layer='relu1', m=100,
                  binary_search_steps=5, max_iterations=500,
                  learning_rate=1e-2, initial_const=1, max_linf=None,
                  random_start=False, thres_steps=100, check_adv_steps=100,
-                 verbose=True):
+                 verbose=True, abort_early=False, const_tol=None,
+                 warm_start=False):
         """
         Parameters
         ----------
@@ -56,15 +64,24 @@ class DKNNExpAttack(object):
             a number the norm penalty constant should be initialized to.
             Default is 1
         abort_early : bool, optional
-            whether or not to abort the optimization early (before reaching
-            max_iterations) if the objective does not improve from the past
-            (max_iterations // 10) steps. Default is True
+            whether or not to abort the optimization of a sample early (before
+            reaching max_iterations) if its objective does not improve from
+            the past (max_iterations // 10) steps. Default is False
+        const_tol : float, optional
+            stop the binary search of a sample once its bounds on the
+            constant satisfy upper - lower <= const_tol * upper. Set to None
+            to run every binary search step. Default is None
         max_linf : float, optional
             use to bound the L-inf norm of the attacks (addition to L-2 norm
             penalty). Set to None to not use this option. Default is None
         random_start : bool, optional
             whether or not to initialize the perturbation with small isotropic
             Gaussian noise. Default is False
+        warm_start : bool, optional
+            whether or not to start each binary search step from the best
+            adversarial perturbation found so far (or from where the previous
+            step stopped if none is found yet) with the optimizer state
+            carried over, instead of starting from scratch. Default is False
 
         Returns
         -------
@@ -84,9 +101,9 @@ class DKNNExpAttack(object):
         label = label.cpu().numpy()
         input_shape = x_orig.detach().cpu().numpy().shape
         # initialize coeff for guide samples
-        self.coeff = torch.zeros((x_orig.size(0), m))
-        self.coeff[:, :m // 2] += 1
-        self.coeff[:, m // 2:] -= 1
+        coeff = torch.zeros((x_orig.size(0), m))
+        coeff[:, :m // 2] += 1
+        coeff[:, m // 2:] -= 1
 
         def to_attack_space(x):
             # map from [min_, max_] to [-1, +1]
@@ -100,7 +117,7 @@ class DKNNExpAttack(object):
             # from (-1, +1) to (-inf, +inf)
             return self.atanh(x)
 
-        def to_model_space(x):
+        def to_model_space(x, min_=min_, max_=max_):
             """Transforms an input from the attack space
             to the model space. This transformation and
             the returned gradient are elementwise."""
@@ -126,6 +143,7 @@ class DKNNExpAttack(object):
         upper_bound = torch.zeros_like(const) + INFTY
         best_l2dist = torch.zeros_like(const) + INFTY
 
+        warm = None
         for binary_search_step in range(binary_search_steps):
             if (binary_search_step == binary_search_steps - 1 and
                     binary_search_steps >= 10):
@@ -134,18 +152,43 @@ class DKNNExpAttack(object):
                     # possible constant
                 const = upper_bound
 
+            # samples attacked in this binary search step
+            active = (~converged_const(lower_bound, upper_bound, const_tol)
+                      ).nonzero().view(-1)
+            if active.size(0) == 0:
+                break
+            # state of the attack at the last iteration of each active sample
+            x_final = torch.zeros_like(x_orig[active])
+            l2dist_final = torch.zeros_like(const[active])
+            is_adv_final = torch.zeros_like(active, dtype=torch.bool)
+
+            # <pos> are the positions in <active> of the samples still
+            # optimized. Per-sample tensors, including the state used by
+            # loss_function, are compacted along with it.
+            pos = torch.arange(active.size(0), device=self.device)
+            z_orig_, x_recon_, const_ = (z_orig[active], x_recon[active],
+                                         const[active])
+            min_act, max_act = select(min_, active), select(max_, active)
+            label_ = label[active.cpu().numpy()]
+            self.coeff = coeff[active.cpu()]
+            self.guide_reps = {}
+
             # initialize perturbation in transformed space
-            if not random_start:
-                z_delta = torch.zeros_like(z_orig, requires_grad=True)
-            else:
-                rand = np.random.randn(*input_shape) * 1e-2
-                z_delta = torch.tensor(
-                    rand, dtype=torch.float32, requires_grad=True,
-                    device=self.device)
-            # loss_at_previous_check = torch.zeros(1, device=self.device) + INFTY
+            if warm is None or not warm_start:
+                if not random_start:
+                    warm = WarmStart(torch.zeros_like(z_orig))
+                else:
+                    rand = np.random.randn(*input_shape) * 1e-2
+                    warm = WarmStart(torch.tensor(
+                        rand, dtype=torch.float32, device=self.device))
+            if warm_start:
+                # perturbation and optimizer state where each sample stops
+                final = WarmStart(torch.zeros_like(z_orig_))
+            loss_at_previous_check = torch.zeros_like(const_) + INFTY
 
             # create a new optimizer
-            optimizer = optim.RMSprop([z_delta], lr=learning_rate)
+            z_delta, optimizer = warm.start(
+                active, optim.RMSprop, lr=learning_rate)
 
             # add learning rate scheduler
             lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
@@ -154,7 +197,8 @@ class DKNNExpAttack(object):
 
             for iteration in range(max_iterations):
                 optimizer.zero_grad()
-                x = to_model_space(z_orig + z_delta)
+                x = to_model_space(z_orig_ + z_delta, min_act, max_act)
+                reps = self.dknn.get_activations(x, requires_grad=True)
 
                 # adaptively choose threshold and guide samples every
                 # <thres_steps> iterations
@@ -162,77 +206,121 @@ class DKNNExpAttack(object):
                     if iteration % thres_steps == 0:
                         # order = (self.dknn.k + 1) // 2 - 1
                         # thres = self.dknn.get_neighbors(x)[0][0][:, order]
-                        thres = self.dknn.get_neighbors(x)[0][0][:, -1]
+                        thres = self.dknn.get_neighbors(
+                            x, reps=reps)[0][0][:, -1]
                         self.thres = torch.tensor(thres).to(self.device).view(
-                            batch_size, 1)
+                            x.size(0), 1)
                         self.find_guide_samples(
-                            x, label, m=m, layer=guide_layer)
+                            x, label_, m=m, layer=guide_layer, reps=reps)
 
-                reps = self.dknn.get_activations(x, requires_grad=True)
                 loss, l2dist = self.loss_function(
-                    x, reps, const, x_recon)
-                loss.backward()
-                optimizer.step()
+                    x, reps, const_, x_recon_)
+                # normalize by the full batch size so that the gradient of
+                # each sample does not depend on how many are still active
+                with stage('attack.backward', batch=loss.size(0)):
+                    (loss.sum() / batch_size).backward()
+                    optimizer.step()
                 # lr_scheduler.step(loss)
 
                 if (verbose and iteration %
                         (np.ceil(max_iterations / 10)) == 0):
                     print('    step: %d; loss: %.3f; l2dist: %.3f' %
-                          (iteration, loss.cpu().detach().numpy(),
+                          (iteration, loss.mean().cpu().detach().numpy(),
                            l2dist.mean().cpu().detach().numpy()))
 
                 # every <check_adv_steps>, save adversarial samples
                 # with minimal perturbation
+                is_adv = None
                 if ((iteration + 1) % check_adv_steps == 0 or
-                        iteration == max_iterations):
-                    is_adv = self.check_adv(x, label)
-                    for i in range(batch_size):
-                        if is_adv[i] and best_l2dist[i] > l2dist[i]:
-                            x_adv[i] = x[i]
-                            best_l2dist[i] = l2dist[i]
+                        iteration == max_iterations - 1):
+                    with torch.no_grad():
+                        is_adv = self.check_adv(x, label_, reps=reps).bool()
+                    better = update_best(x_adv, best_l2dist, x.detach(),
+                                         l2dist.detach(), is_adv, active[pos])
+                    if warm_start and better.any():
+                        warm.save(optimizer, z_delta, better,
+                                  active[pos[better]])
+
+                # samples that stop here: no progress since the last check
+                # (after each tenth of the iterations), or last iteration
+                check = (abort_early and
+                         iteration % (np.ceil(max_iterations / 10)) == 0)
+                last = iteration == max_iterations - 1
+                if not (check or last):
+                    continue
+                loss = loss.detach()
+                done = torch.zeros_like(loss, dtype=torch.bool)
+                if check:
+                    done = torch.gt(loss, .9999 * loss_at_previous_check)
+                    loss_at_previous_check = loss
+                if last:
+                    done[:] = True
+                if not done.any():
+                    continue
+
+                x_final[pos[done]] = x.detach()[done]
+                l2dist_final[pos[done]] = l2dist.detach()[done]
+                # reuse the representations of this step (or its check) to
+                # tell if the finished samples are adversarial
+                if is_adv is None:
+                    with torch.no_grad():
+                        is_adv = torch.zeros_like(done)
+                        is_adv[done] = self.check_adv(
+                            x[done], label_[done.cpu().numpy()],
+                            reps={l: r[done] for l, r in reps.items()}).bool()
+                is_adv_final[pos[done]] = is_adv[done]
+                if warm_start:
+                    final.save(optimizer, z_delta, done, pos[done])
+                if done.all():
+                    break
+                # drop finished samples from the batch
+                keep = ~done
+                pos = pos[keep]
+                z_orig_, x_recon_, const_ = (z_orig_[keep], x_recon_[keep],
+                                             const_[keep])
+                min_act, max_act = select(min_act, keep), select(max_act, keep)
+                label_ = label_[keep.cpu().numpy()]
+                self.thres = self.thres[keep]
+                self.coeff = self.coeff[keep.cpu()]
+                self.guide_reps = {l: g[keep]
+                                   for l, g in self.guide_reps.items()}
+                loss_at_previous_check = loss_at_previous_check[keep]
+                z_delta = compact_optimizer(optimizer, z_delta, keep)
 
             # check how many attacks have succeeded
-            with torch.no_grad():
-                is_adv = self.check_adv(x, label)
-                if verbose:
-                    print(is_adv.sum())
-
-            for i in range(batch_size):
-                # set new upper and lower bounds
-                if is_adv[i]:
-                    upper_bound[i] = const[i]
-                else:
-                    lower_bound[i] = const[i]
-                # set new const
-                if upper_bound[i] == INFTY:
-                    # exponential search if adv has not been found
-                    const[i] *= 10
-                else:
-                    # binary search if adv has been found
-                    const[i] = (lower_bound[i] + upper_bound[i]) / 2
-                # only keep adv with smallest l2dist
-                if is_adv[i] and best_l2dist[i] > l2dist[i]:
-                    x_adv[i] = x[i]
-                    best_l2dist[i] = l2dist[i]
+            is_adv = is_adv_final
+            if verbose:
+                print(is_adv.sum())
+
+            update_const(const, lower_bound, upper_bound, is_adv, active,
+                         INFTY)
+            # only keep adv with smallest l2dist
+            better = update_best(x_adv, best_l2dist, x_final, l2dist_final,
+                                 is_adv, active)
+            if warm_start:
+                # resume from the best adversarial example, or from where the
+                # optimization stopped if none has been found
+                resume = better | (best_l2dist[active] == INFTY)
+                warm.update(final, resume, active[resume])
 
             # check the current attack success rate (combined with previous
             # binary search steps)
             if verbose:
-                with torch.no_grad():
-                    is_adv = self.check_adv(x_adv, label)
-                    print('binary step: %d; number of successful adv: %d/%d' %
-                          (binary_search_step, is_adv.sum(), batch_size))
+                print('binary step: %d; number of successful adv: %d/%d' %
+                      (binary_search_step, (best_l2dist < INFTY).sum(),
+                       batch_size))
 
         return x_adv
 
-    def check_adv(self, x, label):
-        """Check if label of <x> predicted by <dknn> matches with <label>"""
-        y_pred = self.dknn.classify(x).argmax(1)
+    def check_adv(self, x, label, reps=None):
+        """Check if label of <x> predicted by <dknn> matches with <label>.
+        <reps> are the activations of <x> if they are already computed."""
+        y_pred = self.dknn.classify(x, reps=reps).argmax(1)
         return torch.tensor((y_pred != label).astype(np.float32)).to(self.device)
 
     def loss_function(self, x, reps, const, x_recon):
-        """Returns the loss averaged over the batch (first dimension of x) and
-        L-2 norm squared of the perturbation
+        """Returns the loss of each sample (first dimension of x) and L-2 norm
+        of the perturbation
         """
 
         batch_size = x.size(0)
@@ -257,11 +345,12 @@ class DKNNExpAttack(object):
         # of representations, multiplied by constant
         total_loss = l2dist + const * adv_loss.mean(1)
 
-        return total_loss.mean(), l2dist.sqrt()
+        return total_loss, l2dist.sqrt()
 
-    def find_guide_samples(self, x, label, m=100, layer='relu1'):
+    def find_guide_samples(self, x, label, m=100, layer='relu1', reps=None):
         """Find k nearest neighbors to <x> that all have the same class but not
-        equal to <label>
+        equal to <label>. <reps> are the activations of <x> if they are
+        already computed.
         """
         num_classes = self.dknn.num_classes
         x_train = self.dknn.x_train
@@ -269,7 +358,7 @@ class DKNNExpAttack(object):
         batch_size = x.size(0)
         nn = torch.zeros((m, ) + x.size()).transpose(0, 1)
         D, I = self.dknn.get_neighbors(
-            x, k=x_train.size(0), layers=[layer])[0]
+            x, k=x_train.size(0), layers=[layer], reps=reps)[0]
 
         for i, (d, ind) in enumerate(zip(D, I)):
             mean_dist = np.zeros((num_classes, ))
@@ -7,6 +7,10 @@ import torch
 import torch.nn.functional as F
 import torch.optim as optim
 
+from lib.attack_utils import (WarmStart, compact_optimizer, converged_const,
+                              select)
+from lib.profiler import profiled, stage
+
 INFTY = 1e20
 
 
@@ -14,12 +18,16 @@ class DKNNLinfAttack(object):
     """
     Implement gradient-based attack on Deep k-Nearest Neigbhor that uses
     L-2 distance as a metric. Perturbation is constrained in an L-inf ball.
+    Samples that stop making progress leave the batch so that the remaining
+    iterations only run on the active ones.
     """
 
+    @profiled('attack.DKNNLinfAttack')
     def __call__(self, dknn, x_orig, label, guide_layer='relu1', m=100,
                  binary_search_steps=5, max_iterations=500,
                  learning_rate=1e-2, initial_const=1, abort_early=True,
-                 max_linf=None, random_start=False, guide_mode=1):
+                 max_linf=None, random_start=False, guide_mode=1,
+                 const_tol=None, warm_start=False):
         """
         Parameters
         ----------
@@ -47,9 +55,9 @@ class DKNNLinfAttack(object):
             a number the norm penalty constant should be initialized to.
             Default is 1
         abort_early : bool, optional
-            whether or not to abort the optimization early (before reaching
-            max_iterations) if the objective does not improve from the past
-            (max_iterations // 10) steps. Default is True
+            whether or not to abort the optimization of a sample early (before
+            reaching max_iterations) if its objective does not improve from
+            the past (max_iterations // 10) steps. Default is True
         max_linf : float, optional
             use to bound the L-inf norm of the attacks (addition to L-2 norm
             penalty). Set to None to not use this option. Default is None
@@ -62,6 +70,15 @@ class DKNNLinfAttack(object):
             the same class but not equal its original label.
             - guide_mode == 2: find the nearest neighbor that has a different
             class from the input and find its m - 1 neighbors
+        const_tol : float, optional
+            stop the binary search of a sample once its bounds on the
+            constant satisfy upper - lower <= const_tol * upper. Set to None
+            to run every binary search step. Default is None
+        warm_start : bool, optional
+            whether or not to start each binary search step from the last
+            adversarial perturbation found (or from where the previous step
+            stopped if none is found yet) with the optimizer state carried
+            over, instead of starting from scratch. Default is False
 
         Returns
         -------
@@ -92,7 +109,7 @@ class DKNNLinfAttack(object):
             # from (-1, +1) to (-inf, +inf)
             return self.atanh(x)
 
-        def to_model_space(x):
+        def to_model_space(x, min_=min_, max_=max_):
             """Transforms an input from the attack space
             to the model space. This transformation and
             the returned gradient are elementwise."""
@@ -142,84 +159,148 @@ class DKNNLinfAttack(object):
                     guide_reps[layer][i] = guide_rep[layer].view(
                         m, -1).detach()
 
+        # whether an adversarial example has been found for each sample
+        has_adv = torch.zeros_like(const, dtype=torch.bool)
+        warm = None
         for binary_search_step in range(binary_search_steps):
 
-            if not random_start:
-                z_delta = torch.zeros_like(z_orig, requires_grad=True)
-            else:
-                rand = np.random.randn(*input_shape) * 1e-2
-                z_delta = torch.tensor(
-                    rand, dtype=torch.float32, requires_grad=True, device=device)
-            loss_at_previous_check = torch.zeros(1, device=device) + INFTY
+            # samples attacked in this binary search step
+            active = (~converged_const(lower_bound, upper_bound, const_tol)
+                      ).nonzero().view(-1)
+            if active.size(0) == 0:
+                break
+            # state of the attack at the last iteration of each active sample
+            x_final = torch.zeros_like(x_orig[active])
+            l2dist_final = torch.zeros_like(const[active])
+            is_adv_final = torch.zeros_like(active, dtype=torch.bool)
+
+            # <pos> are the positions in <active> of the samples still
+            # optimized. Per-sample tensors are compacted along with it.
+            pos = torch.arange(active.size(0), device=device)
+            z_orig_, x_recon_, const_ = (z_orig[active], x_recon[active],
+                                         const[active])
+            min_act, max_act = select(min_, active), select(max_, active)
+            guide_reps_ = {l: guide_reps[l][active] for l in dknn.layers}
+            label_ = label[active.cpu().numpy()]
+
+            if warm is None or not warm_start:
+                if not random_start:
+                    warm = WarmStart(torch.zeros_like(z_orig))
+                else:
+                    rand = np.random.randn(*input_shape) * 1e-2
+                    warm = WarmStart(torch.tensor(
+                        rand, dtype=torch.float32, device=device))
+            if warm_start:
+                # perturbation and optimizer state where each sample stops
+                final = WarmStart(torch.zeros_like(z_orig_))
+            loss_at_previous_check = torch.zeros_like(const_) + INFTY
 
             # create a new optimizer
-            optimizer = optim.Adam([z_delta], lr=learning_rate)
+            z_delta, optimizer = warm.start(
+                active, optim.Adam, lr=learning_rate)
             # optimizer = optim.SGD([z_delta], lr=learning_rate)
 
             for iteration in range(max_iterations):
                 optimizer.zero_grad()
-                x = to_model_space(z_orig + z_delta)
+                x = to_model_space(z_orig_ + z_delta, min_act, max_act)
                 reps = dknn.get_activations(x, requires_grad=True)
                 loss, l2dist = self.loss_function(
-                    x, reps, guide_reps, dknn.layers, const, x_recon, device)
-                loss.backward()
-                optimizer.step()
+                    x, reps, guide_reps_, dknn.layers, const_, x_recon_,
+                    device)
+                # normalize by the full batch size so that the gradient of
+                # each sample does not depend on how many are still active
+                with stage('attack.backward', batch=loss.size(0)):
+                    (loss.sum() / batch_size).backward()
+                    optimizer.step()
 
                 if iteration % (np.ceil(max_iterations / 10)) == 0:
                     print('    step: %d; loss: %.3f; l2dist: %.3f' %
-                          (iteration, loss.cpu().detach().numpy(),
+                          (iteration, loss.mean().cpu().detach().numpy(),
                            l2dist.mean().cpu().detach().numpy()))
                 # DEBUG:
                 # for i in range(5):
                 #     print(z_delta.grad[i].view(-1).norm().item())
 
-                if abort_early and iteration % (np.ceil(max_iterations / 10)) == 0:
-                    # after each tenth of the iterations, check progress
-                    if torch.gt(loss, .9999 * loss_at_previous_check):
-                        break  # stop Adam if there has not been progress
+                # samples that stop here: no progress since the last check
+                # (after each tenth of the iterations), or last iteration
+                check = (abort_early and
+                         iteration % (np.ceil(max_iterations / 10)) == 0)
+                last = iteration == max_iterations - 1
+                if not (check or last):
+                    continue
+                loss = loss.detach()
+                done = torch.zeros_like(loss, dtype=torch.bool)
+                if check:
+                    done = torch.gt(loss, .9999 * loss_at_previous_check)
                     loss_at_previous_check = loss
+                if last:
+                    done[:] = True
+                if not done.any():
+                    continue
+
+                x_final[pos[done]] = x.detach()[done]
+                l2dist_final[pos[done]] = l2dist.detach()[done]
+                # reuse the representations of this step to tell if the
+                # finished samples are adversarial
+                with torch.no_grad():
+                    is_adv_final[pos[done]] = self.check_adv(
+                        dknn, x[done], label_[done.cpu().numpy()],
+                        reps={l: r[done] for l, r in reps.items()}).bool()
+                if warm_start:
+                    final.save(optimizer, z_delta, done, pos[done])
+                if done.all():
+                    break
+                # drop finished samples from the batch
+                keep = ~done
+                pos = pos[keep]
+                z_orig_, x_recon_, const_ = (z_orig_[keep], x_recon_[keep],
+                                             const_[keep])
+                min_act, max_act = select(min_act, keep), select(max_act, keep)
+                guide_reps_ = {l: g[keep] for l, g in guide_reps_.items()}
+                label_ = label_[keep.cpu().numpy()]
+                loss_at_previous_check = loss_at_previous_check[keep]
+                z_delta = compact_optimizer(optimizer, z_delta, keep)
 
             # check how many attacks have succeeded
-            with torch.no_grad():
-                is_adv = self.check_adv(dknn, x, label)
-
-            for i in range(batch_size):
-                # set new upper and lower bounds
-                if l2dist[i] > 0:
-                    lower_bound[i] = const[i]
-                else:
-                    upper_bound[i] = const[i]
-                    if is_adv[i]:
-                        x_adv[i] = x[i]
-                # set new const
-                if upper_bound[i] == INFTY:
-                    # exponential search if adv has not satisfied the
-                    # constraint once
-                    const[i] *= 10
-                elif lower_bound[i] == 0:
-                    const[i] /= 10
-                else:
-                    # binary search if adv has been found
-                    const[i] = (lower_bound[i] + upper_bound[i]) / 2
-
-            # check the current attack success rate
-            with torch.no_grad():
-                is_adv = self.check_adv(dknn, x_adv, label)
+            is_adv = is_adv_final
+
+            # set new upper and lower bounds
+            c = const[active]
+            satisfied = l2dist_final == 0
+            upper = torch.where(satisfied, c, upper_bound[active])
+            lower = torch.where(satisfied, lower_bound[active], c)
+            upper_bound[active], lower_bound[active] = upper, lower
+            found = satisfied & is_adv
+            x_adv[active[found]] = x_final[found]
+            if warm_start:
+                # resume from the last adversarial example, or from where the
+                # optimization stopped if none has been found
+                resume = found | ~has_adv[active]
+                warm.update(final, resume, active[resume])
+            has_adv[active[found]] = True
+            # set new const: exponential search if adv has not satisfied the
+            # constraint once, binary search if adv has been found
+            const[active] = torch.where(
+                upper == INFTY, c * 10,
+                torch.where(lower == 0, c / 10, (lower + upper) / 2))
+
+            # current attack success rate
             print('binary step: %d; number of successful adv: %d/%d' %
-                  (binary_search_step, is_adv.sum(), batch_size))
+                  (binary_search_step, has_adv.sum(), batch_size))
 
         return x_adv
 
     @classmethod
-    def check_adv(cls, dknn, x, label):
-        """Check if label of <x> predicted by <dknn> matches with <label>"""
-        y_pred = dknn.classify(x).argmax(1)
+    def check_adv(cls, dknn, x, label, reps=None):
+        """Check if label of <x> predicted by <dknn> matches with <label>.
+        <reps> are the activations of <x> if they are already computed."""
+        y_pred = dknn.classify(x, reps=reps).argmax(1)
         return torch.tensor((y_pred != label).astype(np.float32)).to(dknn.device)
 
     @classmethod
     def loss_function(cls, x, reps, guide_reps, layers, const, x_recon, device):
-        """Returns the loss averaged over the batch (first dimension of x) and
-        L-2 norm squared of the perturbation
+        """Returns the loss of each sample (first dimension of x) and the
+        L-2 norm of the part of the perturbation outside the L-inf ball
         """
 
         batch_size = x.size(0)
@@ -236,7 +317,7 @@ class DKNNLinfAttack(object):
         # of representations, multiplied by constant
         total_loss = const * dist + adv_loss.mean(1)
 
-        return total_loss.mean(), dist.sqrt()
+        return total_loss, dist.sqrt()
 
     @staticmethod
     def find_guide_samples(dknn, x, label, k=100, layer='relu1'):
@@ -4,6 +4,9 @@ import numpy as np
 import torch
 import torch.optim as optim
 
+from lib.attack_utils import best_restart, run_chunked
+from lib.profiler import profiled
+
 INFTY = 1e20
 
 
@@ -11,7 +14,13 @@ class DKNN_PGD(object):
     """
     Implement gradient-based attack on DkNN with L-inf norm constraint.
     The loss function is the same as the L-2 attack, but it uses PGD as an
-    optimizer.
+    optimizer. Random restarts run in parallel, stacked along the batch
+    dimension.
+
+    The thresholds and guide samples (every <thres_steps> iterations) and the
+    success check (every <check_adv_steps> iterations) are computed from the
+    representations of the gradient step, so they do not need another
+    forward pass.
     """
 
     def __init__(self, dknn):
@@ -22,10 +31,20 @@ class DKNN_PGD(object):
         self.thres = None
         self.coeff = None
 
+    @profiled('attack.DKNN_PGD')
     def __call__(self, x_orig, label, guide_layer, m, epsilon=0.1,
                  max_epsilon=0.3, max_iterations=1000, num_restart=1,
                  rand_start=True, thres_steps=100, check_adv_steps=100,
-                 verbose=True):
+                 verbose=True, max_batch=None):
+        """
+        The restarts are stacked along the batch dimension and run as one
+        batch of batch_size * num_restart rows. It is split into chunks of
+        at most <max_batch> rows (all rows if None) that fit in GPU memory,
+        estimated from one attack step on a few rows. A chunk that still
+        runs out of GPU memory is split further. For each sample, the
+        adversarial example with the most neighbors of the wrong class over
+        all restarts is returned.
+        """
 
         # make sure we run at least once
         if num_restart < 1:
@@ -37,38 +56,51 @@ class DKNN_PGD(object):
 
         label = label.cpu().numpy()
         batch_size = x_orig.size(0)
+        num_rows = batch_size * num_restart
         min_, max_ = x_orig.min(), x_orig.max()
-        # initialize adv to the original
-        x_adv = x_orig.detach()
-        best_num_nn = np.zeros((batch_size, ))
-
-        # set coefficient of guide samples
-        self.coeff = torch.zeros((x_orig.size(0), m))
-        self.coeff[:, :m // 2] += 1
-        self.coeff[:, m // 2:] -= 1
-
-        for i in range(num_restart):
+        # best adversarial example of every row (initialized to the original)
+        # and its number of neighbors of the predicted class
+        x_rows = x_orig.detach().repeat(
+            (num_restart, ) + (1, ) * (x_orig.dim() - 1))
+        num_nn_rows = np.zeros((num_rows, ))
+
+        def attack_rows(begin, end):
+            # row r * batch_size + i is restart r of sample i. The best
+            # examples are returned and only written by commit_rows, so a
+            # chunk that runs out of memory can be run again
+            idx = np.arange(begin, end) % batch_size
+            x_idx = x_orig[torch.from_numpy(idx).to(x_orig.device)]
+            label_idx = label[idx]
+            x_best = x_idx.detach().clone()
+            num_nn_best = np.zeros((end - begin, ))
+
+            # set coefficient of guide samples
+            self.coeff = torch.zeros((end - begin, m))
+            self.coeff[:, :m // 2] += 1
+            self.coeff[:, m // 2:] -= 1
+            self.guide_reps = {}
 
             # initialize perturbation
-            delta = torch.zeros_like(x_adv)
+            delta = torch.zeros_like(x_idx)
             if rand_start:
                 delta.uniform_(- max_epsilon, max_epsilon)
             delta.requires_grad_()
 
             for iteration in range(max_iterations):
-                x = torch.clamp(x_orig + delta, min_, max_)
+                x = torch.clamp(x_idx + delta, min_, max_)
+                reps = self.dknn.get_activations(x, requires_grad=True)
 
                 # adaptively choose threshold and guide samples every
                 # <thres_steps> iterations
                 with torch.no_grad():
                     if iteration % thres_steps == 0:
-                        thres = self.dknn.get_neighbors(x)[0][0][:, -1]
+                        thres = self.dknn.get_neighbors(
+                            x, reps=reps)[0][0][:, -1]
                         self.thres = torch.tensor(thres).to(self.device).view(
-                            batch_size, 1)
+                            end - begin, 1)
                         self.find_guide_samples(
-                            x, label, m=m, layer=guide_layer)
+                            x, label_idx, m=m, layer=guide_layer, reps=reps)
 
-                reps = self.dknn.get_activations(x, requires_grad=True)
                 loss = self.loss_function(reps)
                 loss.backward()
                 # perform update on delta
@@ -76,33 +108,57 @@ class DKNN_PGD(object):
                     delta -= epsilon * delta.grad.detach().sign()
                     delta.clamp_(- max_epsilon, max_epsilon)
 
-                if (verbose and iteration % (np.ceil(max_iterations / 10)) == 0):
+                if (verbose and
+                        iteration % (np.ceil(max_iterations / 10)) == 0):
                     print('    step: %d; loss: %.3f' %
                           (iteration, loss.cpu().detach().numpy()))
 
                 if ((iteration + 1) % check_adv_steps == 0 or
-                        iteration == max_iterations):
+                        iteration == max_iterations - 1):
                     with torch.no_grad():
                         # check if x are adversarial. Only store adversarial
                         # examples if they have a larger number of wrong
                         # neighbors than orevious
-                        is_adv, num_nn = self.check_adv(x, label)
-                        for j in range(batch_size):
-                            if is_adv[j] and num_nn[j] > best_num_nn[j]:
-                                x_adv[j] = x[j]
-                                best_num_nn[j] = num_nn[j]
-
-            with torch.no_grad():
-                is_adv, _ = self.check_adv(x_adv, label)
-            if verbose:
-                print('number of successful adv: %d/%d' %
-                      (is_adv.sum(), batch_size))
+                        is_adv, num_nn = self.check_adv(
+                            x, label_idx, reps=reps)
+                        better = (is_adv == 1) & (num_nn > num_nn_best)
+                        ind = np.where(better)[0]
+                        x_best[ind] = x[ind]
+                        num_nn_best[ind] = num_nn[ind]
+            return x_best, num_nn_best
+
+        def commit_rows(begin, end, result):
+            x_rows[begin:end], num_nn_rows[begin:end] = result
+
+        def probe(num):
+            # forward and backward pass of one attack step on <num> rows,
+            # with the guide samples of each row
+            idx = torch.arange(num, device=x_orig.device) % batch_size
+            x = x_orig[idx].detach().clone().requires_grad_()
+            reps = self.dknn.get_activations(x, requires_grad=True)
+            loss = 0
+            for layer in self.layers:
+                rep = reps[layer].view(num, 1, -1)
+                guide = torch.zeros((num, m, rep.size(2)), device=self.device)
+                loss = loss + ((rep - guide)**2).sum()
+            torch.autograd.grad(loss, x)
+
+        run_chunked(attack_rows, commit_rows, num_rows, max_batch=max_batch,
+                    probe=probe, device=x_orig.device, verbose=verbose)
+
+        # pick the best restart of each sample
+        row, best_num_nn = best_restart(torch.tensor(num_nn_rows), num_restart)
+        x_adv = x_rows[row.to(x_rows.device)]
+        if verbose:
+            print('number of successful adv: %d/%d' %
+                  ((best_num_nn > 0).sum(), batch_size))
 
         return x_adv
 
-    def check_adv(self, x, label):
-        """Check if label of <x> predicted by <dknn> matches with <label>"""
-        output = self.dknn.classify(x)
+    def check_adv(self, x, label, reps=None):
+        """Check if label of <x> predicted by <dknn> matches with <label>.
+        <reps> are the activations of <x> if they are already computed."""
+        output = self.dknn.classify(x, reps=reps)
         num_nn = output.max(1)
         y_pred = output.argmax(1)
         is_adv = (y_pred != label).astype(np.float32)
@@ -128,9 +184,10 @@ class DKNN_PGD(object):
 
         return adv_loss.mean()
 
-    def find_guide_samples(self, x, label, m=100, layer='relu1'):
+    def find_guide_samples(self, x, label, m=100, layer='relu1', reps=None):
         """Find k nearest neighbors to <x> that all have the same class but not
-        equal to <label>
+        equal to <label>. <reps> are the activations of <x> if they are
+        already computed.
         """
         num_classes = self.dknn.num_classes
         x_train = self.dknn.x_train
@@ -138,7 +195,7 @@ class DKNN_PGD(object):
         batch_size = x.size(0)
         nn = torch.zeros((m, ) + x.size()).transpose(0, 1)
         D, I = self.dknn.get_neighbors(
-            x, k=x_train.size(0), layers=[layer])[0]
+            x, k=x_train.size(0), layers=[layer], reps=reps)[0]
 
         for i, (d, ind) in enumerate(zip(D, I)):
             mean_dist = np.zeros((num_classes, ))
@@ -0,0 +1,181 @@
+'''
+In-process serving layer for DKNNL2. Requests made on an asyncio event loop
+are grouped by a MicroBatcher (lib/batching.py) into micro-batches (up to
+max_batch samples, waiting at most max_wait seconds for more) that are
+classified with one forward pass and one set of faiss searches. Also a load
+generator that measures latency percentiles and throughput.
+'''
+import asyncio
+import time
+
+import numpy as np
+import torch
+
+from lib.batching import MicroBatcher
+
+
+class DkNNServer(object):
+    """
+    Serve DkNN predictions of single samples with dynamic micro-batching.
+    Call start() and stop() from the event loop the requests are made on.
+
+    Parameters
+    ----------
+    dknn : DKNNL2
+        DkNN used to classify the requests
+    max_batch : int, optional
+        maximal number of samples classified together (default is 64)
+    max_wait : float, optional
+        time in seconds the dispatcher waits for more requests after the
+        first one of a batch (default is 2e-3)
+    """
+
+    def __init__(self, dknn, max_batch=64, max_wait=2e-3):
+        self.dknn = dknn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        # classify blocks, so batches are collected and classified in the
+        # dispatcher thread of the batcher and the event loop keeps
+        # accepting requests in the meantime
+        self._batcher = None
+        self._loop = None
+
+    def reset_stats(self):
+        self._batcher.reset_stats()
+
+    def stats(self):
+        """Return the number of requests and batches since the last reset,
+        and the mean batch size"""
+        stats = self._batcher.stats()
+        return {'requests': stats['requests'], 'batches': stats['batches'],
+                'mean_batch': stats['mean_batch']}
+
+    async def start(self):
+        """Start the dispatcher"""
+        self._loop = asyncio.get_event_loop()
+        self._batcher = MicroBatcher(self._classify, self.max_batch,
+                                     self.max_wait)
+
+    async def stop(self):
+        """Serve the pending requests and stop the dispatcher"""
+        await self._loop.run_in_executor(None, self._batcher.close)
+
+    async def predict(self, x):
+        """Classify one sample
+
+        Parameters
+        ----------
+        x : torch.tensor
+            sample to classify, shape is input_shape
+
+        Returns
+        -------
+        output : dict
+            'label': predicted label, 'counts': np.array of the number of
+            neighbors in each class, 'credibility': credibility of the
+            prediction
+        """
+        future = self._loop.create_future()
+
+        def callback(output, error):
+            # called from the dispatcher thread
+            self._loop.call_soon_threadsafe(self._set_result, future,
+                                            output, error)
+
+        self._batcher.submit(x.unsqueeze(0), callback)
+        return await future
+
+    @staticmethod
+    def _set_result(future, output, error):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+            return
+        class_counts, cred = output
+        future.set_result({'label': int(class_counts[0].argmax()),
+                           'counts': class_counts[0],
+                           'credibility': float(cred[0])})
+
+    def _classify(self, x):
+        with torch.no_grad():
+            class_counts = self.dknn.classify(x)
+        return class_counts, self.dknn.credibility(class_counts)
+
+
+async def generate_load(server, x, num_requests, concurrency=16, rate=None):
+    """Send <num_requests> single-sample requests drawn from <x> to a started
+    DkNNServer
+
+    Parameters
+    ----------
+    server : DkNNServer
+        server to query
+    x : torch.tensor
+        pool of samples, shape (num_samples, ) + input_shape
+    num_requests : int
+        total number of requests
+    concurrency : int, optional
+        number of clients that each send a request once the previous one is
+        answered (closed loop). Ignored if <rate> is set (default is 16)
+    rate : float, optional
+        if set, requests arrive as a Poisson process with this rate in
+        requests per second, regardless of the answers (open loop)
+
+    Returns
+    -------
+    report : dict
+        'p50', 'p99' and 'mean' latency in seconds, 'throughput' in
+        requests per second and the server stats
+    """
+    latencies = []
+    ind = np.random.randint(x.size(0), size=num_requests)
+
+    async def send(i):
+        start = time.time()
+        await server.predict(x[ind[i]])
+        latencies.append(time.time() - start)
+
+    server.reset_stats()
+    start = time.time()
+    if rate is None:
+        async def client(c):
+            for i in range(c, num_requests, concurrency):
+                await send(i)
+        await asyncio.gather(*[client(c) for c in range(concurrency)])
+    else:
+        tasks = []
+        for i in range(num_requests):
+            tasks.append(asyncio.ensure_future(send(i)))
+            await asyncio.sleep(np.random.exponential(1 / rate))
+        await asyncio.gather(*tasks)
+    total = time.time() - start
+
+    report = {'p50': np.percentile(latencies, 50),
+              'p99': np.percentile(latencies, 99),
+              'mean': np.mean(latencies),
+              'throughput': num_requests / total}
+    report.update(server.stats())
+    return report
+
+
+def benchmark(dknn, x, num_requests, max_batch=64, max_wait=2e-3,
+              concurrency=16, rate=None):
+    """Start a DkNNServer on a new event loop, run generate_load on it and
+    return the report"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = DkNNServer(dknn, max_batch=max_batch, max_wait=max_wait)
+
+    async def run():
+        await server.start()
+        try:
+            return await generate_load(server, x, num_requests,
+                                       concurrency=concurrency, rate=rate)
+        finally:
+            await server.stop()
+
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
@@ -1,6 +1,10 @@
+import threading
+import time
+import numpy as np
 import torch
 
 import foolbox
+from lib.batching import MicroBatcher
 
 
 class DkNNFoolboxModel(foolbox.models.Model):
@@ -19,3 +23,93 @@ class DkNNFoolboxModel(foolbox.models.Model):
 
     def num_classes(self):
         return self.dknn.num_classes
+
+
+class BatchedDkNNFoolboxModel(DkNNFoolboxModel):
+    """
+    DkNNFoolboxModel that can be shared by attacks running in several
+    threads. Queries from all threads are coalesced by a MicroBatcher
+    (lib/batching.py) into batched dknn.classify calls. Predictions of
+    exactly repeated inputs are served by the cache of DKNNL2 if it is
+    enabled (see DKNNL2.cache_size and DKNNL2.cache_stats). stats() reports
+    query counts and latency. Call close() to stop the dispatcher.
+    """
+
+    def __init__(self, dknn, bounds, channel_axis, preprocessing=(0, 1),
+                 max_batch=256, max_wait=1e-3):
+        """
+        Parameters
+        ----------
+        max_batch : int, optional
+            the dispatcher stops collecting queries once it has this many
+            images (default is 256)
+        max_wait : float, optional
+            time in seconds the dispatcher waits for more queries after the
+            first one (default is 1e-3)
+        """
+        super(BatchedDkNNFoolboxModel, self).__init__(
+            dknn, bounds, channel_axis, preprocessing=preprocessing)
+        # guards the stats
+        self._lock = threading.Lock()
+        self._batcher = MicroBatcher(self._classify, max_batch, max_wait)
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'queries': 0, 'calls': 0,
+                           'latency': 0., 'max_latency': 0.}
+        self._batcher.reset_stats()
+
+    def stats(self):
+        """Return the query counts and latency since the last reset
+
+        Returns
+        -------
+        stats : dict
+            'queries': images queried, 'calls': calls to batch_predictions,
+            'classify_calls' and 'classified': batched dknn.classify calls
+            and the images they classified, 'mean_batch': average images per
+            classify call,
+            'mean_latency' and 'max_latency': time in seconds spent in
+            batch_predictions per call
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        batcher_stats = self._batcher.stats()
+        stats['classify_calls'] = batcher_stats['batches']
+        stats['classified'] = batcher_stats['samples']
+        stats['mean_batch'] = batcher_stats['mean_batch']
+        stats['mean_latency'] = stats['latency'] / max(1, stats['calls'])
+        return stats
+
+    def batch_predictions(self, images):
+        start = time.time()
+        done = threading.Event()
+        result = []
+
+        def callback(output, error):
+            result.append((output, error))
+            done.set()
+
+        self._batcher.submit(np.ascontiguousarray(images), callback)
+        done.wait()
+        output, error = result[0]
+        if error is not None:
+            raise error
+
+        latency = time.time() - start
+        with self._lock:
+            self._stats['queries'] += len(images)
+            self._stats['calls'] += 1
+            self._stats['latency'] += latency
+            self._stats['max_latency'] = max(self._stats['max_latency'],
+                                             latency)
+        return output
+
+    def _classify(self, images):
+        with torch.no_grad():
+            return self.dknn.classify(torch.tensor(images))
+
+    def close(self):
+        """Stop the dispatcher thread"""
+        self._batcher.close()
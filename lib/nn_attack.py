@@ -0,0 +1,286 @@
+'''
+Exact minimal adversarial examples for a 1-nearest-neighbor classifier with
+Euclidean distance (e.g. one layer of DKNNL2 with k=1). The closest point to
+x that is misclassified lies in the region of some training sample j of
+another class, i.e. the points that are at least as close to x_j as to any
+training sample of the class of x. Projecting x onto that region is a small
+quadratic program with one linear constraint per sample of the class of x.
+'''
+import numpy as np
+import torch
+
+from lib.profiler import profiled
+
+INFTY = 1e20
+
+
+class ExactNNAttack(object):
+    """
+    Find the minimal L-2 adversarial examples of a 1-NN classifier.
+
+    For each query, the candidate targets j are the training samples of
+    other classes. A candidate cannot do better than (d(x, x_j) - d(x, x_nn))
+    / 2 where x_nn is the nearest sample of the class of x (triangle
+    inequality), so candidates are visited in increasing order of that bound
+    and skipped once it exceeds the best distance found. Only candidates
+    whose region is next to the Voronoi cell of x_nn can get past the bound
+    in practice. The projection onto the region of each candidate is solved
+    in its dual form with projected accelerated gradient until the relative
+    duality gap and constraint violation are below qp_tol, starting with the
+    constraints of the m nearest samples of the class of x. A constraint of
+    any other sample violated by the solution is added and the projection is
+    solved again. A candidate still violating a constraint after max_cuts
+    cuts is dropped. The projection with fewer constraints (or the dual
+    objective if qp_steps iterations were not enough) bounds the distance
+    to the region of a dropped or unconverged candidate from below, and the
+    result is only reported exact (see the <exact> output) if no such bound
+    is below the distance found. The programs of all (query, candidate)
+    pairs are solved in batches.
+    """
+
+    def __init__(self, x_train, y_train, device='cpu'):
+        """
+        Parameters
+        ----------
+        x_train : torch.tensor
+            training samples (or their representations) of the 1-NN
+        y_train : torch.tensor
+            labels of x_train, shape (num_train_samples, )
+        device : str, optional
+            device the search runs on (default is 'cpu')
+        """
+        self.device = device
+        self.x_train = x_train.view(x_train.size(0), -1).float().to(device)
+        self.y_train = y_train.to(device)
+        self.sqnorm = (self.x_train**2).sum(1)
+
+    def _dist(self, x):
+        """L-2 distance between the samples <x> and all training samples"""
+        sqdist = ((x**2).sum(1, keepdim=True) + self.sqnorm -
+                  2 * x @ self.x_train.t())
+        return sqdist.clamp(min=0).sqrt()
+
+    def margin_bound(self, x, label):
+        """Return the gap between the distances from x to the nearest
+        training sample of another class and to the nearest sample of its
+        own class, and the indices of the samples correctly classified. Half
+        the gap is a lower bound on the minimal adversarial perturbation."""
+        x = x.view(x.size(0), -1).float().to(self.device)
+        dist = self._dist(x)
+        same = self.y_train.unsqueeze(0) == label.to(self.device).view(-1, 1)
+        d_nn = dist.masked_fill(~same, INFTY).min(1)[0]
+        d_other = dist.masked_fill(same, INFTY).min(1)[0]
+        gap = (d_other - d_nn).cpu()
+        return gap, np.where(gap.numpy() > 0)[0]
+
+    @profiled('attack.ExactNNAttack')
+    def __call__(self, x, label, batch_size=100, m=100, num_cand=50,
+                 max_cuts=10, qp_batch=32, qp_steps=500, qp_tol=1e-4,
+                 tol=1e-4):
+        """
+        Parameters
+        ----------
+        x : torch.tensor
+            samples to attack, same shape as the training samples
+        label : torch.tensor
+            labels of x
+        batch_size : int, optional
+            number of queries attacked together (default is 100)
+        m : int, optional
+            number of nearest samples of the class of x whose constraints are
+            used from the start (default is 100)
+        num_cand : int, optional
+            number of candidates of each query tried per round (default is
+            50)
+        max_cuts : int, optional
+            maximum number of violated constraints added to the projection of
+            one candidate. Candidates still violating a constraint after that
+            are dropped (default is 10)
+        qp_batch : int, optional
+            number of projections solved together (default is 32)
+        qp_steps : int, optional
+            maximum number of iterations of the projection solver (default
+            is 500)
+        qp_tol : float, optional
+            the projection solver stops once the duality gap and the
+            violation of every constraint are below qp_tol times the squared
+            distance to the solution (default is 1e-4)
+        tol : float, optional
+            a constraint is violated if the nearest sample of the class of x
+            is closer to the solution than the target by more than <tol>
+            (default is 1e-4)
+
+        Returns
+        -------
+        x_adv : torch.tensor
+            adversarial examples, on the boundary of the region of the best
+            target. Samples that are already misclassified are returned as is
+        dist : torch.tensor
+            L-2 norm of the minimal adversarial perturbation of each sample
+        exact : torch.tensor
+            False for the samples where a candidate that was dropped or not
+            solved to qp_tol might have given a perturbation smaller by more
+            than <tol>. <dist> is then only an upper bound.
+        """
+        x_adv = torch.zeros_like(x)
+        dist = torch.zeros((x.size(0), ))
+        exact = torch.zeros((x.size(0), ), dtype=torch.bool)
+        for begin in range(0, x.size(0), batch_size):
+            end = begin + batch_size
+            out = self._attack_batch(
+                x[begin:end], label[begin:end], m, num_cand, max_cuts,
+                qp_batch, qp_steps, qp_tol, tol)
+            x_adv[begin:end] = out[0].view_as(x[begin:end]).to(x.device)
+            dist[begin:end] = out[1].cpu()
+            exact[begin:end] = out[2].cpu()
+        return x_adv, dist, exact
+
+    def _attack_batch(self, x, label, m, num_cand, max_cuts, qp_batch,
+                      qp_steps, qp_tol, tol):
+        n = x.size(0)
+        x = x.view(n, -1).float().to(self.device)
+        label = label.to(self.device)
+        dist = self._dist(x)
+        same = self.y_train.unsqueeze(0) == label.view(-1, 1)
+        d_same = dist.masked_fill(~same, INFTY)
+        d_nn = d_same.min(1)[0]
+        d_other = dist.masked_fill(same, INFTY)
+
+        # the nearest sample of another class is an adversarial example
+        best_dist, best_ind = d_other.min(1)
+        x_adv = self.x_train[best_ind].clone()
+        wrong = best_dist < d_nn
+        x_adv[wrong] = x[wrong]
+        best_dist[wrong] = 0
+
+        # lower bound on the distance to the region of each candidate
+        lower = (d_other - d_nn.unsqueeze(1)) / 2
+        lower[wrong] = INFTY
+        cons = d_same.topk(min(m, same.sum(1).min().item()), 1,
+                           largest=False)[1]
+        # smallest lower bound on the distance to the region of the
+        # candidates of each query that were not solved exactly
+        unsolved = torch.zeros_like(best_dist) + INFTY
+
+        while True:
+            num = min(num_cand, lower.size(1))
+            bound, cand = lower.topk(num, 1, largest=False)
+            valid = bound < best_dist.unsqueeze(1)
+            if not valid.any():
+                break
+            q, c = valid.nonzero(as_tuple=True)
+            tar = cand[q, c]
+            lower[q, tar] = INFTY
+
+            z = torch.zeros((q.size(0), x.size(1)), device=self.device)
+            d = torch.zeros((q.size(0), ), device=self.device)
+            d_low = torch.zeros_like(d)
+            for i in range(0, q.size(0), qp_batch):
+                rows = slice(i, i + qp_batch)
+                z[rows], d[rows], d_low[rows] = self._solve(
+                    x[q[rows]], label[q[rows]], tar[rows], cons[q[rows]],
+                    max_cuts, qp_steps, qp_tol, tol)
+            inexact = d_low < d
+            if inexact.any():
+                unsolved.scatter_reduce_(0, q[inexact], d_low[inexact],
+                                         'amin')
+
+            # keep the best candidate of each query
+            cand_dist = torch.zeros_like(bound) + INFTY
+            cand_dist[q, c] = d
+            round_dist, round_best = cand_dist.min(1)
+            better = round_dist < best_dist
+            if better.any():
+                pair = torch.zeros_like(cand, dtype=torch.long)
+                pair[q, c] = torch.arange(q.size(0), device=self.device)
+                rows = better.nonzero().view(-1)
+                best_dist[rows] = round_dist[rows]
+                x_adv[rows] = z[pair[rows, round_best[rows]]]
+
+        return x_adv, best_dist, unsolved >= best_dist - tol
+
+    def _solve(self, x, label, tar, cons, max_cuts, qp_steps, qp_tol, tol):
+        """Project each x onto the region of training sample <tar>: points
+        at least as close to x_tar as to every training sample of class
+        <label>. Return the projections, their distance to x (INFTY if
+        the constraints are still violated after <max_cuts> cuts) and a
+        lower bound on the distance from x to the region, equal to the
+        distance if the projection is exact."""
+        num, m = cons.size()
+        cons = torch.cat([cons, torch.zeros((num, max_cuts), dtype=cons.dtype,
+                                            device=cons.device)], 1)
+        mask = torch.zeros(cons.size(), device=self.device)
+        mask[:, :m] = 1
+        same = self.y_train.unsqueeze(0) == label.view(-1, 1)
+        x_tar = self.x_train[tar]
+        for cut in range(max_cuts + 1):
+            z, converged, dual = self._project(
+                x, tar, cons[:, :m + cut], mask[:, :m + cut], qp_steps,
+                qp_tol)
+            # the nearest sample of class <label> must not be closer to z
+            # than the target
+            d_same, nn = self._dist(z).masked_fill(~same, INFTY).min(1)
+            violated = d_same < (z - x_tar).norm(2, 1) - tol
+            if not violated.any() or cut == max_cuts:
+                break
+            cons[violated, m + cut] = nn[violated]
+            mask[violated, m + cut] = 1
+        d = (z - x).norm(2, 1)
+        # the region is contained in the one of the constraints used, so its
+        # projection (or the dual objective if it did not converge) bounds
+        # the distance from below
+        d_low = torch.where(converged, d, (2 * dual).clamp(min=0).sqrt())
+        d[violated] = INFTY
+        return z, d, d_low
+
+    def _project(self, x, tar, cons, mask, qp_steps, qp_tol,
+                 check_every=10):
+        """Solve min ||z - x||^2 s.t. G z <= h for each sample where the
+        rows of G and h are the constraints <cons> (masked by <mask>). Run
+        FISTA on the dual: min_{lam >= 0} lam'Q lam / 2 - lam'c with
+        Q = G G', c = G x - h and z = x - G' lam. Stop when, for every
+        sample, the duality gap lam'(Q lam - c) and the violation of every
+        constraint are below qp_tol * ||z - x||^2. Return z, whether each
+        sample converged and the dual objective lam'c - lam'Q lam / 2,
+        which is at most ||z* - x||^2 / 2 for the exact solution z*."""
+        x_tar = self.x_train[tar]
+        G = 2 * (self.x_train[cons] - x_tar.unsqueeze(1))
+        G = G * mask.unsqueeze(2)
+        h = (self.sqnorm[cons] - self.sqnorm[tar].unsqueeze(1)) * mask
+        Q = G @ G.transpose(1, 2)
+        c = (G @ x.unsqueeze(2)).squeeze(2) - h
+
+        # step size from an upper bound of the largest eigenvalue of Q
+        gersh = Q.abs().sum(2).max(1)[0]
+        frob = Q.view(Q.size(0), -1).norm(2, 1)
+        step = 1 / torch.min(gersh, frob).clamp(min=1e-12)
+        step = step.view(-1, 1)
+
+        lam = torch.zeros_like(c)
+        y = lam
+        t = 1.
+        for i in range(qp_steps):
+            grad = (Q @ y.unsqueeze(2)).squeeze(2) - c
+            lam_new = (y - step * grad).clamp(min=0)
+            t_new = (1 + np.sqrt(1 + 4 * t**2)) / 2
+            y = lam_new + (t - 1) / t_new * (lam_new - lam)
+            lam, t = lam_new, t_new
+            if (i + 1) % check_every == 0 or i == qp_steps - 1:
+                converged, dual = self._check(Q, c, lam, qp_tol)
+                if converged.all():
+                    break
+        z = x - (G.transpose(1, 2) @ lam.unsqueeze(2)).squeeze(2)
+        return z, converged, dual
+
+    @staticmethod
+    def _check(Q, c, lam, qp_tol):
+        """Convergence of the projection for dual variables <lam> (see
+        _project) and dual objective"""
+        Q_lam = (Q @ lam.unsqueeze(2)).squeeze(2)
+        # G z - h = c - Q lam
+        slack = c - Q_lam
+        sqdist = (lam * Q_lam).sum(1)
+        gap = -(lam * slack).sum(1)
+        limit = qp_tol * sqdist.clamp(min=1e-12)
+        converged = (slack.max(1)[0] <= limit) & (gap.abs() <= limit)
+        return converged, (lam * c).sum(1) - sqdist / 2
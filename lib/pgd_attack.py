@@ -4,16 +4,37 @@ import numpy as np
 import torch
 import torch.optim as optim
 
+from lib.attack_utils import best_restart, run_chunked
+from lib.profiler import profiled
+
 
 class PGDAttack(object):
     """
+    Linf PGD attack. Random restarts run in parallel, stacked along the
+    batch dimension. With early_stop (off by default), a sample leaves the
+    batch as soon as an adversarial example is found for it (by any
+    restart), and the attack ends once every sample succeeds. The example
+    returned is then the first misclassified iterate rather than the
+    max-loss one of the full attack. self.stats counts the sample-steps
+    computed ('steps') out of the ones a full attack would take
+    ('max_steps').
     """
 
+    def __init__(self):
+        self.stats = {'steps': 0, 'max_steps': 0}
+
+    @profiled('attack.PGDAttack')
     def __call__(self, net, x_orig, label, targeted=False, epsilon=0.1,
                  max_epsilon=0.3, max_iterations=1000, num_restart=1,
-                 rand_start=True):
+                 rand_start=True, early_stop=False, max_batch=None):
         """
         x_orig is tensor (requires_grad=False)
+
+        The restarts are stacked along the batch dimension and run as one
+        batch of batch_size * num_restart rows. It is split into chunks of
+        at most max_batch rows (all rows if None) that fit in GPU memory,
+        estimated from one attack step on a few rows. A chunk that still
+        runs out of GPU memory is split further.
         """
 
         # make sure we run at least once
@@ -26,56 +47,131 @@ class PGDAttack(object):
 
         label = label.view(-1, 1)
         batch_size = x_orig.size(0)
+        num_rows = batch_size * num_restart
         min_, max_ = x_orig.min(), x_orig.max()
-        x_adv = x_orig.detach()
-
-        for i in range(num_restart):
+        x_adv = x_orig.detach().clone()
+        found = torch.zeros(batch_size, dtype=torch.bool,
+                            device=x_orig.device)
+        if not early_stop:
+            # final state of every row, the best restart is picked at the end
+            x_rows = x_orig.new_zeros((num_rows, ) + x_orig.size()[1:])
+            confidence_rows = torch.zeros(
+                (num_rows, ), device=x_orig.device) - 1e9
+        self.stats = {'steps': 0, 'max_steps': num_rows * max_iterations}
+
+        def attack_rows(begin, end):
+            # row r * batch_size + i is restart r of sample i. The results
+            # are returned and only written by commit_rows, so a chunk that
+            # runs out of memory can be run again
+            idx = torch.arange(begin, end, device=x_orig.device) % batch_size
+            steps = 0
+            if early_stop:
+                # samples that already have an adversarial example from
+                # another restart are not attacked again
+                found_rows = found.clone()
+                idx = idx[~found_rows[idx]]
+                adv_idx, adv_x = [], []
+                if idx.size(0) == 0:
+                    return steps, (idx, x_orig[idx])
+            x_idx, label_idx = x_orig[idx], label[idx]
 
             # initialize perturbation
-            delta = torch.zeros_like(x_adv)
+            delta = torch.zeros_like(x_idx)
             if rand_start:
                 delta.uniform_(- max_epsilon, max_epsilon)
-            delta.requires_grad_()
-
-            best_confidence = torch.zeros(
-                (batch_size, ), device=x_orig.device) - 1e9
 
             for _ in range(max_iterations):
-                x = torch.clamp(x_orig + delta, min_, max_)
+                delta.requires_grad_()
+                x = torch.clamp(x_idx + delta, min_, max_)
                 logits = net(x)
-                loss = self.loss_function(logits, label, targeted)
-                loss.backward()
+                loss = self.loss_function(logits, label_idx, targeted)
+                grad = torch.autograd.grad(loss, delta)[0].detach()
+                delta = delta.detach()
+                x, logits = x.detach(), logits.detach()
+                steps += idx.size(0)
+
+                if early_stop:
+                    # successful samples leave the batch together with their
+                    # other restarts
+                    is_adv = self.check_adv(logits, label_idx, targeted)
+                    adv_idx.append(idx[is_adv])
+                    adv_x.append(x[is_adv])
+                    found_rows[idx[is_adv]] = True
+                    keep = ~found_rows[idx]
+                    idx, x_idx = idx[keep], x_idx[keep]
+                    label_idx = label_idx[keep]
+                    delta, grad = delta[keep], grad[keep]
+                    if idx.size(0) == 0:
+                        break
+
                 # perform update on delta
-                with torch.no_grad():
-                    delta -= epsilon * delta.grad.detach().sign()
-                    delta.clamp_(- max_epsilon, max_epsilon)
+                delta = delta - epsilon * grad.sign()
+                delta.clamp_(- max_epsilon, max_epsilon)
+
+            if early_stop:
+                if not adv_idx:
+                    return steps, (idx[:0], x_idx[:0])
+                return steps, (torch.cat(adv_idx), torch.cat(adv_x))
 
             with torch.no_grad():
-                is_adv = self.check_adv(logits, label, targeted)
+                is_adv = self.check_adv(logits, label_idx, targeted)
 
             # calculate confidence (difference between target class and the
             # class with the second highest score)
-            real = torch.gather(logits, 1, label)
-            other = self.best_other_class(logits, label)
+            real = torch.gather(logits, 1, label_idx).squeeze(1)
+            other = self.best_other_class(logits, label_idx)
             if targeted:
                 confidence = real - other
             else:
-                confidence = other - other
+                confidence = other - real
+            confidence = torch.where(
+                is_adv, confidence, torch.zeros_like(confidence) - 1e9)
+            return steps, (x, confidence)
+
+        def commit_rows(begin, end, result):
+            steps, output = result
+            self.stats['steps'] += steps
+            if early_stop:
+                idx, x = output
+                x_adv[idx] = x
+                found[idx] = True
+            else:
+                x_rows[begin:end], confidence_rows[begin:end] = output
+
+        def probe(num):
+            # one attack step on <num> rows
+            idx = torch.arange(num, device=x_orig.device) % batch_size
+            x = x_orig[idx].detach().clone().requires_grad_()
+            loss = self.loss_function(net(x), label[idx], targeted)
+            torch.autograd.grad(loss, x)
 
-            for i in range(batch_size):
-                # only keep adv with highest confidence
-                if is_adv[i] and best_confidence[i] < confidence[i]:
-                    x_adv[i] = x[i]
-                    best_confidence[i] = confidence[i]
+        run_chunked(attack_rows, commit_rows, num_rows, max_batch=max_batch,
+                    probe=probe, device=x_orig.device)
+
+        if not early_stop:
+            # only keep adv with highest confidence over the restarts
+            row, confidence = best_restart(confidence_rows, num_restart)
+            better = confidence > -1e9
+            x_adv[better] = x_rows[row[better]]
 
         with torch.no_grad():
             logits = net(x_adv)
             is_adv = self.check_adv(logits, label, targeted)
         print('number of successful adv: %d/%d' %
               (is_adv.sum().cpu().numpy(), batch_size))
+        if early_stop:
+            print('attack steps: %d/%d (%.1f%% saved)' %
+                  (self.stats['steps'], self.stats['max_steps'],
+                   100 * self.steps_saved()))
 
         return x_adv
 
+    def steps_saved(self):
+        """Return the fraction of attack steps skipped by early stopping"""
+        if self.stats['max_steps'] == 0:
+            return 0.
+        return 1. - self.stats['steps'] / self.stats['max_steps']
+
     @classmethod
     def check_adv(cls, logits, label, targeted):
         if targeted:
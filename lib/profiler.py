@@ -0,0 +1,205 @@
+'''
+Opt-in instrumentation of the hot paths of DKNNL2 and the attacks. Code is
+split into named stages (e.g. 'dknn.forward', 'dknn.search') with stage() or
+the profiled() decorator. Nothing is recorded unless a Profiler is enabled,
+and a disabled stage costs one global lookup.
+
+    with Profiler(trace=True) as prof:
+        dknn.classify(x_test)
+    prof.print_report()
+    prof.export_chrome_trace('trace.json')
+'''
+import functools
+import json
+import resource
+import threading
+import time
+
+import torch
+
+# profiler that stages report to, None when profiling is disabled
+_profiler = None
+
+
+class _NullStage(object):
+    """Stage used when profiling is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+
+    def __init__(self, profiler, name, batch, nbytes):
+        self.profiler = profiler
+        self.name = name
+        self.batch = batch
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.profiler._sync()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler._sync()
+        self.profiler._record(self.name, self.start, time.perf_counter(),
+                              self.batch, self.nbytes)
+        return False
+
+
+def stage(name, batch=None, nbytes=None):
+    """Context manager that times the code it wraps as stage <name>
+
+    Parameters
+    ----------
+    name : str
+        name of the stage
+    batch : int, optional
+        number of samples processed by this call
+    nbytes : int, optional
+        number of bytes copied by this call (e.g. device to host)
+    """
+    if _profiler is None:
+        return _NULL_STAGE
+    return _Stage(_profiler, name, batch, nbytes)
+
+
+def profiled(name):
+    """Decorator that times every call of a function as stage <name>"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            with _Stage(_profiler, name, None, None):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiler(object):
+    """
+    Collect the wall time, number of calls, batch sizes and bytes copied of
+    every stage, and the peak memory, while it is enabled (as a context
+    manager, or with enable() and disable()). Stages may run in several
+    threads.
+
+    Parameters
+    ----------
+    sync : bool, optional
+        synchronize CUDA at the start and end of every stage so that GPU
+        work is counted in the stage that launched it. Slower, but the
+        stage times are accurate (default is False)
+    trace : bool, optional
+        keep every call to export a Chrome trace (default is False)
+    """
+
+    def __init__(self, sync=False, trace=False):
+        self.sync = sync and torch.cuda.is_available()
+        self.trace = trace
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.events = []
+        self._origin = time.perf_counter()
+
+    def enable(self):
+        global _profiler
+        if torch.cuda.is_available():
+            torch.cuda.reset_max_memory_allocated()
+        _profiler = self
+
+    def disable(self):
+        global _profiler
+        _profiler = None
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *args):
+        self.disable()
+        return False
+
+    def _sync(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    def _record(self, name, start, end, batch, nbytes):
+        with self._lock:
+            s = self.stages.get(name)
+            if s is None:
+                s = {'calls': 0, 'time': 0., 'max_time': 0., 'samples': 0,
+                     'max_batch': 0, 'bytes': 0}
+                self.stages[name] = s
+            s['calls'] += 1
+            s['time'] += end - start
+            s['max_time'] = max(s['max_time'], end - start)
+            if batch is not None:
+                s['samples'] += batch
+                s['max_batch'] = max(s['max_batch'], batch)
+            if nbytes is not None:
+                s['bytes'] += nbytes
+            if self.trace:
+                self.events.append((name, start, end,
+                                    threading.get_ident()))
+
+    def report(self):
+        """Return the statistics collected so far
+
+        Returns
+        -------
+        report : dict
+            'stages': dict of the 'calls', total and max 'time' (seconds),
+            'samples', 'max_batch', 'mean_batch' and 'bytes' of each stage,
+            'peak_rss_bytes': peak resident memory of the process,
+            'peak_cuda_bytes': peak memory allocated by torch on the GPU
+            while enabled (0 without CUDA)
+        """
+        with self._lock:
+            stages = {name: dict(s) for name, s in self.stages.items()}
+        for s in stages.values():
+            s['mean_batch'] = s['samples'] / s['calls']
+        # ru_maxrss is in kilobytes on Linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        cuda = (torch.cuda.max_memory_allocated()
+                if torch.cuda.is_available() else 0)
+        return {'stages': stages, 'peak_rss_bytes': rss,
+                'peak_cuda_bytes': cuda}
+
+    def print_report(self):
+        """Print the stages sorted by total time"""
+        report = self.report()
+        print('%-28s %8s %10s %10s %10s %12s' %
+              ('stage', 'calls', 'total s', 'mean ms', 'mean batch',
+               'MB copied'))
+        stages = sorted(report['stages'].items(),
+                        key=lambda item: -item[1]['time'])
+        for name, s in stages:
+            print('%-28s %8d %10.3f %10.3f %10.1f %12.1f' %
+                  (name, s['calls'], s['time'], 1e3 * s['time'] / s['calls'],
+                   s['mean_batch'], s['bytes'] / 2**20))
+        print('peak rss: %.1f MB, peak cuda: %.1f MB' %
+              (report['peak_rss_bytes'] / 2**20,
+               report['peak_cuda_bytes'] / 2**20))
+
+    def export_chrome_trace(self, path):
+        """Write the recorded calls (requires trace=True) in the Chrome
+        trace format, viewable in chrome://tracing"""
+        with self._lock:
+            events = list(self.events)
+        trace = [{'name': name, 'ph': 'X', 'pid': 0, 'tid': tid,
+                  'ts': 1e6 * (start - self._origin),
+                  'dur': 1e6 * (end - start)}
+                 for name, start, end, tid in events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace}, f)
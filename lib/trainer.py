@@ -0,0 +1,449 @@
+'''
+Shared training engine used by the training scripts. Metrics are accumulated
+on the device and synchronized once per epoch.
+'''
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+
+from lib.checkpoint import (AsyncCheckpointWriter, get_rng_state,
+                            load_checkpoint, save_checkpoint, set_rng_state,
+                            to_cpu)
+from lib.distributed import all_reduce_sum, is_distributed, is_main_process
+
+
+def _flatten_batch(inputs, targets, input_shape):
+    """Rotation datasets yield inputs of shape (batch_size, 4) + input_shape.
+    Flatten them to (-1, ) + input_shape and the targets to (-1, )"""
+    if input_shape is None:
+        return inputs, targets
+    return inputs.view((-1, ) + tuple(input_shape)), targets.view(-1)
+
+
+def classification_step(criterion, input_shape=None, **kwargs):
+    """Return a step function that computes <criterion> on
+    net(inputs, **kwargs)"""
+
+    def step(net, inputs, targets):
+        inputs, targets = _flatten_batch(inputs, targets, input_shape)
+        outputs = net(inputs, **kwargs)
+        return criterion(outputs, targets), outputs
+    return step
+
+
+def adv_classification_step(criterion, attack=True, input_shape=None):
+    """Return a step function for PGDModel-style wrappers whose forward pass
+    takes (inputs, targets, attack)"""
+
+    def step(net, inputs, targets):
+        inputs, targets = _flatten_batch(inputs, targets, input_shape)
+        outputs = net(inputs, targets, attack=attack)
+        return criterion(outputs, targets), outputs
+    return step
+
+
+def adv_training_step(input_shape=None):
+    """Return a step function that calls net.train_step(inputs, targets,
+    optimizer) of the wrappers in lib/adv_model.py. These update the weights
+    themselves (e.g. several times per batch in free adversarial training),
+    so the step is flagged with <manual_optimization>. Outside of training
+    (no optimizer), the step evaluates the loss on PGD adversarial examples.
+    Not supported under DistributedDataParallel."""
+
+    def step(net, inputs, targets, optimizer=None):
+        inputs, targets = _flatten_batch(inputs, targets, input_shape)
+        if optimizer is None:
+            outputs = net(inputs, targets, attack=True)
+            return F.cross_entropy(outputs, targets), outputs
+        return net.train_step(inputs, targets, optimizer)
+    step.manual_optimization = True
+    return step
+
+
+class Trainer(object):
+    """
+    Train and evaluate a model with a step function supplied by the script.
+
+    A step function has the signature step(net, inputs, targets) and returns
+    a tuple (loss, outputs). <loss> is a scalar tensor averaged over the
+    batch and <outputs> is either the logits used to compute accuracy or None
+    when accuracy is not meaningful (e.g. autoencoders).
+
+    A step function with the attribute manual_optimization set to True is
+    called as step(net, inputs, targets, optimizer) during training and
+    updates the weights itself. Gradient accumulation and loss scaling do
+    not apply to it.
+
+    Under DistributedDataParallel (see lib/distributed.py), metrics are summed
+    over all processes and only the main process logs and writes files.
+    """
+
+    def __init__(self, net, optimizer, train_step, device='cuda',
+                 lr_scheduler=None, log=None, model_path=None,
+                 monitor='val_loss', mode='min', save_best_only=True,
+                 accum_steps=1, amp=False, compile=False,
+                 checkpoint_path=None, checkpoint_every=1,
+                 async_checkpoint=True):
+        """
+        Parameters
+        ----------
+        net : torch.nn.Module
+            model to train. Its state_dict (that of the wrapped module under
+            DistributedDataParallel) is what gets saved to model_path
+        optimizer : torch.optim.Optimizer
+            optimizer over the parameters of net
+        train_step : function
+            step function used in the training phase
+        device : str, optional
+            name of the device the model is on (default is 'cuda')
+        lr_scheduler : optional
+            learning rate scheduler stepped once at the end of every epoch
+            (default is None)
+        log : logging.Logger, optional
+            logger to write the epoch summary to (default is None)
+        model_path : str, optional
+            path to save the model weights to. Set to None to not save
+            (default is None)
+        monitor : str, optional
+            name of the metric used to pick the best model, e.g. 'val_loss',
+            'val_acc' or 'adv_loss' (default is 'val_loss')
+        mode : str, optional
+            'min' or 'max', whether the monitored metric should be minimized
+            or maximized (default is 'min')
+        save_best_only : bool, optional
+            only save weights when the monitored metric improves. Otherwise,
+            save after every epoch (default is True)
+        accum_steps : int, optional
+            number of batches to accumulate gradients over before each
+            optimizer step (default is 1)
+        amp : bool, optional
+            run the step functions under autocast: bfloat16 on CPU and
+            float16 with loss scaling on CUDA (default is False)
+        compile : bool, optional
+            wrap the model with torch.compile if available (default is False)
+        checkpoint_path : str, optional
+            path to write resumable checkpoints to. These hold the model,
+            optimizer, LR scheduler, RNG and epoch state. Set to None to not
+            write checkpoints (default is None)
+        checkpoint_every : int, optional
+            write a checkpoint every this many epochs (default is 1)
+        async_checkpoint : bool, optional
+            write checkpoints and model weights from a background thread
+            (default is True)
+        """
+        if mode not in ('min', 'max'):
+            raise ValueError("Invalid mode (choose between 'min' and 'max')")
+        ddp = isinstance(net, DistributedDataParallel)
+        if ddp and getattr(train_step, 'manual_optimization', False):
+            # these steps call methods of the wrapped module, which bypass
+            # the gradient synchronization of DistributedDataParallel
+            raise ValueError('Step functions with manual_optimization (e.g. '
+                             'adv_training_step) do not support '
+                             'DistributedDataParallel')
+        self.is_main = is_main_process()
+        # DistributedDataParallel is unwrapped so that a model trained with
+        # torchrun saves the same state_dict keys as a single-process run
+        self.net = net.module if ddp else net
+        self.optimizer = optimizer
+        self.train_step = train_step
+        self.device = device
+        self.lr_scheduler = lr_scheduler
+        self.log = log if self.is_main else None
+        self.model_path = model_path
+        self.monitor = monitor
+        self.mode = mode
+        self.save_best_only = save_best_only
+        self.accum_steps = max(1, accum_steps)
+        self.amp = amp
+
+        self.device_type = 'cuda' if str(device).startswith('cuda') else 'cpu'
+        self.amp_dtype = (torch.bfloat16 if self.device_type == 'cpu'
+                          else torch.float16)
+        # loss scaling is only needed for float16
+        self.scaler = torch.cuda.amp.GradScaler(
+            enabled=(amp and self.amp_dtype == torch.float16))
+
+        # <model> is what the step functions call. <net> keeps the original
+        # module so that saved state_dict keys do not depend on compilation
+        # or DistributedDataParallel.
+        self.model = net
+        if compile and hasattr(torch, 'compile'):
+            self.model = torch.compile(net)
+
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.writer = AsyncCheckpointWriter() if async_checkpoint else None
+
+        self.best = np.inf if mode == 'min' else -np.inf
+        self.epoch = 0
+        self.timing = {}
+
+    def _autocast(self):
+        return torch.autocast(self.device_type, dtype=self.amp_dtype,
+                              enabled=self.amp)
+
+    def _sync(self):
+        if self.device_type == 'cuda':
+            torch.cuda.synchronize()
+
+    def _is_better(self, value):
+        if self.mode == 'min':
+            return value < self.best
+        return value > self.best
+
+    def run_epoch(self, dataloader, step=None, train=False):
+        """Run <step> over every batch in <dataloader>
+
+        Parameters
+        ----------
+        dataloader : torch.utils.data.DataLoader
+            data to iterate over, yields (inputs, targets)
+        step : function, optional
+            step function (Default is self.train_step)
+        train : bool, optional
+            whether to update the weights (Default is False)
+
+        Returns
+        -------
+        loss : float
+            loss averaged over batches
+        acc : float
+            accuracy, or None if the step function returns no outputs
+        """
+        if step is None:
+            step = self.train_step
+        self.model.train(train)
+        num_batches = len(dataloader)
+        # reshuffle distributed shards differently every epoch
+        sampler = getattr(dataloader, 'sampler', None)
+        if train and hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(self.epoch)
+
+        # accumulate on device to avoid a sync every batch
+        loss_sum = torch.zeros((), device=self.device)
+        num_correct = torch.zeros((), dtype=torch.long, device=self.device)
+        num_total = 0
+        has_outputs = False
+        manual = train and getattr(step, 'manual_optimization', False)
+
+        if train:
+            self.optimizer.zero_grad()
+        with torch.set_grad_enabled(train):
+            for batch_idx, (inputs, targets) in enumerate(dataloader):
+                inputs = inputs.to(self.device, non_blocking=True)
+                targets = targets.to(self.device, non_blocking=True)
+                with self._autocast():
+                    if manual:
+                        loss, outputs = step(self.model, inputs, targets,
+                                             self.optimizer)
+                    else:
+                        loss, outputs = step(self.model, inputs, targets)
+
+                if train and not manual:
+                    self.scaler.scale(loss / self.accum_steps).backward()
+                    if ((batch_idx + 1) % self.accum_steps == 0 or
+                            batch_idx + 1 == num_batches):
+                        self.scaler.step(self.optimizer)
+                        self.scaler.update()
+                        self.optimizer.zero_grad()
+
+                loss_sum += loss.detach().float()
+                if outputs is not None:
+                    has_outputs = True
+                    targets = targets.view(-1)
+                    num_correct += outputs.detach().argmax(1).eq(
+                        targets).sum()
+                    num_total += targets.size(0)
+
+        if is_distributed():
+            stats = torch.stack([loss_sum, loss_sum.new_tensor(num_batches),
+                                 num_correct.float(),
+                                 loss_sum.new_tensor(num_total)])
+            loss_sum, num_batches, num_correct, num_total = \
+                all_reduce_sum(stats).tolist()
+            loss = loss_sum / max(num_batches, 1)
+            acc = num_correct / max(num_total, 1) if has_outputs else None
+            return loss, acc
+
+        # single device sync per epoch
+        loss = loss_sum.item() / max(num_batches, 1)
+        acc = num_correct.item() / max(num_total, 1) if has_outputs else None
+        return loss, acc
+
+    def evaluate(self, dataloader, step=None):
+        """Evaluate the model on <dataloader>, return (loss, acc)"""
+        return self.run_epoch(dataloader, step=step, train=False)
+
+    def _timed(self, phase, fn, *args, **kwargs):
+        self._sync()
+        start = time.time()
+        out = fn(*args, **kwargs)
+        self._sync()
+        self.timing[phase] = time.time() - start
+        return out
+
+    def train_epoch(self, trainloader, validloader=None, eval_steps=None):
+        """Train for one epoch, evaluate, and save the model if needed
+
+        Parameters
+        ----------
+        trainloader : torch.utils.data.DataLoader
+            training data
+        validloader : torch.utils.data.DataLoader, optional
+            validation data (Default is None)
+        eval_steps : dict, optional
+            dict mapping a phase name (e.g. 'val', 'adv') to the step function
+            to evaluate on validloader. Metrics are reported as
+            '<name>_loss' and '<name>_acc' (Default is {'val': train_step})
+
+        Returns
+        -------
+        metrics : dict
+            dict of metrics of this epoch
+        """
+        if eval_steps is None:
+            eval_steps = {'val': self.train_step}
+        self.timing = {}
+
+        metrics = {}
+        metrics['loss'], metrics['acc'] = self._timed(
+            'train', self.run_epoch, trainloader, train=True)
+        if validloader is not None:
+            for name, step in eval_steps.items():
+                loss, acc = self._timed(name, self.evaluate, validloader,
+                                        step=step)
+                metrics[name + '_loss'], metrics[name + '_acc'] = loss, acc
+
+        if self.lr_scheduler is not None:
+            self.lr_scheduler.step()
+
+        self._log_epoch(metrics)
+
+        # save model weights
+        value = metrics.get(self.monitor)
+        improved = value is not None and self._is_better(value)
+        if improved:
+            self.best = value
+        if self.model_path is not None and (
+                not self.save_best_only or improved):
+            if self.log is not None:
+                self.log.info('Saving model...')
+            self.save(self.model_path)
+
+        self.epoch += 1
+        if (self.checkpoint_path is not None and
+                self.epoch % self.checkpoint_every == 0):
+            self.save_checkpoint()
+        return metrics
+
+    def fit(self, trainloader, validloader, epochs, eval_steps=None,
+            callbacks=None, resume=False):
+        """Train until self.epoch reaches <epochs>
+
+        <callbacks> is a list of functions called as fn(trainer, metrics) at
+        the end of every epoch. If <resume> is True and self.checkpoint_path
+        exists, training continues from the checkpoint.
+        """
+        if resume:
+            self.resume()
+        if self.log is not None:
+            self.log.info(' epoch | ' + ' | '.join(self._phase_names(
+                validloader, eval_steps)) + ' | time')
+        history = []
+        while self.epoch < epochs:
+            metrics = self.train_epoch(trainloader, validloader, eval_steps)
+            for callback in (callbacks or []):
+                callback(self, metrics)
+            history.append(metrics)
+        self.wait()
+        return history
+
+    def save(self, path):
+        """Save weights of the (uncompiled) model to <path>"""
+        self._write(self.net.state_dict(), path)
+
+    def _write(self, state, path):
+        if not self.is_main:
+            return
+        state = to_cpu(state)
+        if self.writer is not None:
+            self.writer.save(state, path)
+        else:
+            save_checkpoint(state, path)
+
+    def wait(self):
+        """Block until pending background writes are done"""
+        if self.writer is not None:
+            self.writer.wait()
+
+    def state_dict(self):
+        """Return everything needed to resume training"""
+        state = {'epoch': self.epoch,
+                 'best': self.best,
+                 'net': self.net.state_dict(),
+                 'optimizer': self.optimizer.state_dict(),
+                 'scaler': self.scaler.state_dict(),
+                 'rng': get_rng_state()}
+        if self.lr_scheduler is not None:
+            state['lr_scheduler'] = self.lr_scheduler.state_dict()
+        return state
+
+    def load_state_dict(self, state):
+        """Restore a state returned by state_dict"""
+        self.net.load_state_dict(state['net'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scaler.load_state_dict(state['scaler'])
+        if self.lr_scheduler is not None and 'lr_scheduler' in state:
+            self.lr_scheduler.load_state_dict(state['lr_scheduler'])
+        set_rng_state(state['rng'])
+        self.epoch = state['epoch']
+        self.best = state['best']
+
+    def save_checkpoint(self, path=None):
+        """Write a resumable checkpoint to <path> (Default is
+        self.checkpoint_path)"""
+        if path is None:
+            path = self.checkpoint_path
+        self._write(self.state_dict(), path)
+
+    def resume(self, path=None):
+        """Load the checkpoint at <path> (Default is self.checkpoint_path).
+        Return True if a checkpoint was found."""
+        if path is None:
+            path = self.checkpoint_path
+        if path is None:
+            return False
+        state = load_checkpoint(path)
+        if state is None:
+            return False
+        self.load_state_dict(state)
+        if self.log is not None:
+            self.log.info('Resumed from %s at epoch %d', path, self.epoch)
+        return True
+
+    def _phase_names(self, validloader, eval_steps):
+        if eval_steps is None:
+            eval_steps = {'val': self.train_step}
+        names = ['loss, acc']
+        if validloader is not None:
+            names += ['%s_l, %s_a' % (n, n) for n in eval_steps]
+        return names
+
+    def _log_epoch(self, metrics):
+        if self.log is None:
+            return
+        cols = []
+        for key in metrics:
+            if key.endswith('acc'):
+                continue
+            acc = metrics[key[:-4] + 'acc'] if key != 'loss' \
+                else metrics['acc']
+            if acc is None:
+                cols.append('%.4f' % metrics[key])
+            else:
+                cols.append('%.4f, %.4f' % (metrics[key], acc))
+        timing = ', '.join('%s %.1fs' % t for t in self.timing.items())
+        self.log.info(' %5d | %s | %s', self.epoch, ' | '.join(cols), timing)
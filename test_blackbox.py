@@ -13,7 +13,8 @@ import torch.optim as optim
 
 import foolbox
 from lib.adv_model import *
-from lib.blackbox_attack import attack_untargeted
+from lib.attack_runner import AttackRunner
+from lib.blackbox_attack import TrainCandidates, attack_untargeted
 from lib.cwl2_attack import CWL2Attack
 from lib.dataset_utils import *
 from lib.dknn import DKNN, DKNNL2
@@ -103,12 +104,26 @@ num = 10
 dknn = DKNNL2(net, x_train, y_train, x_valid, y_valid, layers,
               k=75, num_classes=10)
 
-x_adv = x_test[:num].clone()
+# DkNN predictions on the training set are computed once and shared by all
+# attacks to pick their initial directions
+train_dataset = TrainCandidates(dknn, x_train)
 
-for i in range(num):
-    x_adv[i] = attack_untargeted(
-        dknn, list(zip(x_train, y_train)), x_test[i], y_test[i], alpha=2, beta=0.005,
-        iterations=1000)
+
+def attack_shard(dknn, x, y):
+    x_adv = x.clone()
+    for i in range(x.size(0)):
+        x_adv[i] = attack_untargeted(
+            dknn, train_dataset, x[i], y[i], alpha=2, beta=0.005,
+            iterations=1000)
+    return x_adv
+
+
+# finished shards are saved as they complete, rerun to resume
+runner = AttackRunner(attack_shard, 'attack_results/blackbox_' + model_name,
+                      shard_size=5, context=dknn, seed=seed,
+                      config={'model': model_name, 'layers': layers, 'k': 75,
+                              'alpha': 2, 'beta': 0.005, 'iterations': 1000})
+x_adv = runner.run(x_test[:num], y_test[:num])
 
 y_pred = dknn.classify(x_adv)
 acc = (y_pred.argmax(1) == y_test[:num].numpy()).sum() / len(y_pred)
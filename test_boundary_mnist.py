@@ -2,6 +2,7 @@ import os
 import pdb
 import pickle
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as npr
 import torch
@@ -10,6 +11,7 @@ import torch.backends.cudnn as cudnn
 from foolbox.criteria import Misclassification
 from foolbox.distances import MeanSquaredDistance
 from lib.adv_model import *
+from lib.attack_runner import AttackRunner
 from lib.dataset_utils import *
 from lib.dknn import *
 from lib.foolbox_model import *
@@ -100,13 +102,13 @@ with torch.no_grad():
     ind = np.where(y_pred.argmax(1) == y_test.numpy())[0]
     print((y_pred.argmax(1) == y_test.numpy()).sum() / y_test.size(0))
 
-dknn_fb = DkNNFoolboxModel(dknn, (0, 1), 1, preprocessing=(0, 1))
+# queries of the concurrent attacks are batched, and cached by dknn since
+# the attacks query the same images repeatedly
+dknn.cache_size = 10000
+dknn_fb = BatchedDkNNFoolboxModel(dknn, (0, 1), 1, preprocessing=(0, 1))
 criterion = Misclassification()
 distance = MeanSquaredDistance
 
-attack = foolbox.attacks.BoundaryAttack(
-    model=dknn_fb, criterion=criterion, distance=distance)
-
 attack_params = {
     'iterations': 5000,
     'max_directions': 25,
@@ -124,13 +126,32 @@ attack_params = {
 }
 
 num = 100
-x_adv = np.zeros_like(x_test[:num].numpy())
+num_threads = 10
+
+
+def attack_image(model, x, y):
+    # one attack object per thread
+    attack = foolbox.attacks.BoundaryAttack(
+        model=model, criterion=criterion, distance=distance)
+    return attack(x.numpy(), label=y.numpy(), unpack=True, verbose=False,
+                  **attack_params)
+
+
+def attack_shard(model, x, y):
+    # attack the images of the shard concurrently
+    with ThreadPoolExecutor(num_threads) as executor:
+        x_adv = list(executor.map(attack_image, [model] * x.size(0), x, y))
+    print(model.stats(), model.dknn.cache_stats())
+    return torch.tensor(np.stack(x_adv))
+
 
+# finished shards are saved as they complete, rerun to resume
 start_time = time.time()
-for i in range(num):
-    print(i)
-    x_adv[i] = attack(x_test[ind][i].numpy(), label=y_test[ind][i].numpy(),
-                      unpack=True, verbose=False, **attack_params)
+runner = AttackRunner(attack_shard, 'attack_results/ba_adv2_mnist_0.2_0.001',
+                      shard_size=10, context=dknn_fb, seed=seed,
+                      config={'model': model_name, 'layers': layers, 'k': 75,
+                              'attack': attack_params})
+x_adv = runner.run(x_test[ind][:num], y_test[ind][:num]).numpy()
 print(time.time() - start_time)
 
 pickle.dump(x_adv, open('x_ba_adv2_mnist_0.2_0.001.p', 'wb'))
@@ -90,7 +90,7 @@ dknn = DKNNL2(net, x_train, y_train, x_valid, y_valid, layers,
               k=75, num_classes=10)
 
 with torch.no_grad():
-    y_pred = dknn.classify(x_test)
+    y_pred = dknn.classify_pipelined(x_test)
     ind = np.where(y_pred.argmax(1) == y_test.numpy())[0]
     print((y_pred.argmax(1) == y_test.numpy()).sum() / y_test.size(0))
 
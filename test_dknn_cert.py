@@ -16,9 +16,9 @@ from lib.cwl2_attack import CWL2Attack
 from lib.dataset_utils import *
 from lib.dknn import DKNN, DKNNL2
 from lib.dknn_attack import DKNNAttack, SoftDKNNAttack
-from lib.knn import *
 from lib.lip_model import *
 from lib.mnist_model import *
+from lib.nn_attack import ExactNNAttack
 from tune_mnist import Identity
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -164,46 +164,44 @@ net.eval()
 #     a.append((dist > pert).mean())
 # print(a)
 
+# one DkNN (and one embedding of the training set) for all layers
+dknn = DKNNL2(net, x_train, y_train, x_valid, y_valid, layers,
+              k=1, num_classes=10, device=device)
+rep_test = dknn.get_activations(x_test, requires_grad=False)
+
+# 1-NN margins of every layer from a single pass over the test set
+perts = [0.5, 1, 1.5, 2]
+margins, curves = dknn.certify(x_test, y_test, perts, reps=rep_test)
+
 gaps = []
 for layer in layers:
+    gap = margins[layer]
+    ind = np.where(gap > 0)[0]
     output = '(' + layer + ') '
-    dknn = DKNNL2(net, x_train, y_train, x_valid, y_valid, [layer],
-                  k=1, num_classes=10)
-
-    with torch.no_grad():
-        y_pred = dknn.classify(x_test)
-        output += '%.4f, ' % ((y_pred.argmax(1) ==
-                               y_test.numpy()).sum() / y_test.size(0))
-
-    rep_train = dknn.get_activations(
-        x_train, requires_grad=False, batch_size=100, device='cpu')[layer]
-    rep_test = dknn.get_activations(
-        x_test, requires_grad=False, batch_size=100, device='cpu')[layer]
-    rep_valid = dknn.get_activations(
-        x_valid, requires_grad=False, batch_size=100, device='cpu')[layer]
-
-    rep_train = rep_train.numpy()
-    rep_test = rep_test.numpy()
-    rep_valid = rep_valid.numpy()
-
-    knn = KNNL2NP(rep_train, y_train, rep_valid, y_valid, k=1, num_classes=10)
-
-    # print('finding adv neighbors...')
-    rep_nn = knn.find_nn_diff_class(rep_test, y_test)
-    # rep_adv = knn.get_min_dist(rep_test, y_test, rep_nn, iterations=10)
-    # print('calculating margin...')
-    gap, ind = knn.get_margin_bound(rep_test, y_test, rep_nn)
-
-    # move perpendicular to edge
-    # rep_adv = knn.opt_attack(rep_test, y_test, pert_bound=2, iterations=10)
-
-    output += '%.4f, [' % gap[ind].mean().item()
-
-    perts = [0.5, 1, 1.5, 2]
-    a = []
-    for pert in perts[:-1]:
-        output += '%.4f, ' % (gap[ind] > 2 * pert).mean()
-    output += '%.4f]' % (gap[ind] > 2 * perts[-1]).mean()
+    output += '%.4f, ' % (gap > 0).mean()
+
+    # margin of the correctly classified samples (same columns as the
+    # per-layer KNNL2NP.get_margin_bound loop this replaces)
+    output += '%.4f, [' % gap[ind].mean()
+    output += ', '.join('%.4f' % (gap[ind] > 2 * pert).mean()
+                        for pert in perts) + '], '
+
+    # certified accuracy over all samples (misclassified samples count as 0)
+    output += '[' + ', '.join('%.4f' % a for a in curves[layer]) + '], '
+
+    # exact minimal adversarial perturbation in the representation space
+    rep_train, ids = dknn.train_activations(layer)
+    attack = ExactNNAttack(rep_train, y_train[torch.from_numpy(ids)],
+                           device=device)
+    _, dist, exact = attack(rep_test[layer], y_test)
+    dist = dist.numpy()
+    if not exact.all():
+        print('(%s) %d samples not solved exactly' %
+              (layer, (~exact).sum().item()))
+    output += '%.4f, [' % dist[ind].mean()
+    # robust accuracy at each pert (misclassified samples have dist 0)
+    output += ', '.join('%.4f' % (dist > pert).mean()
+                        for pert in perts) + ']'
 
     print(output)
     gaps.append(gap[ind])
@@ -220,4 +218,10 @@ for layer in layers:
     #     a.append((dist > pert).mean())
     # print(a)
 
+# certified accuracy of the DkNN vote over all layers with k = 75
+radius, curve = dknn.certify_knn(x_test, y_test, perts, k=75, reps=rep_test)
+print('(k=75) %.4f, %.4f, [%s]' % (
+    (radius > 0).mean(), radius[radius > 0].mean(),
+    ', '.join('%.4f' % a for a in curve)))
+
 # pickle.dump(gaps, open('gaps_dist11.p', 'wb'))
@@ -13,6 +13,7 @@ import torch.optim as optim
 
 import foolbox
 from lib.adv_model import *
+from lib.attack_runner import AttackRunner
 from lib.cifar10_model import *
 from lib.cifar_resnet import *
 from lib.cwl2_attack import CWL2Attack
@@ -84,34 +85,36 @@ dknn = DKNNL2(net, x_train, y_train, x_valid, y_valid, layers,
               k=75, num_classes=10)
 
 with torch.no_grad():
-    y_pred = dknn.classify(x_test)
+    y_pred = dknn.classify_pipelined(x_test)
     ind = np.where(y_pred.argmax(1) == y_test.numpy())[0]
     print((y_pred.argmax(1) == y_test.numpy()).sum() / y_test.size(0))
 
 # attack = SoftDKNNAttack()
 attack = DKNNL2Attack()
 
+attack_params = {'m': 300,
+                 'binary_search_steps': 10,
+                 'max_iterations': 500,
+                 'learning_rate': 1e-2,
+                 'initial_const': 1e-7,
+                 'abort_early': False,
+                 'random_start': True,
+                 'guide_mode': 2}
 
-def attack_batch(x, y, batch_size, layer):
-    x_a = torch.zeros_like(x)
-    total_num = x.size(0)
-    num_batches = total_num // batch_size
-    for i in range(num_batches):
-        print(i)
-        begin = i * batch_size
-        end = (i + 1) * batch_size
-        x_a[begin:end] = attack(
-            dknn, x[begin:end], y[begin:end],
-            guide_layer=layer, m=300, binary_search_steps=10,
-            max_iterations=500, learning_rate=1e-2, initial_const=1e-7,
-            abort_early=False, random_start=True, guide=2)
-    return x_a
+
+def attack_shard(layer, x, y):
+    return attack(dknn, x.to(device), y, guide_layer=layer, **attack_params)
 
 
 for layer in layers:
 
-    x_adv = attack_batch(x_test[ind][:num].cuda(),
-                         y_test[ind][:num], 100, layer)
+    # finished shards are saved as they complete, rerun to resume
+    runner = AttackRunner(
+        attack_shard, 'attack_results/dknn_%s_%s' % (layer, model_name),
+        shard_size=100, context=layer, seed=seed,
+        config={'model': model_name, 'layers': layers, 'k': 75,
+                'guide_layer': layer, 'attack': attack_params})
+    x_adv = runner.run(x_test[ind][:num], y_test[ind][:num])
 
     pickle.dump(x_adv.cpu().detach(), open('x_adv_' + model_name + '.p', 'wb'))
 
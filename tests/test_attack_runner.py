@@ -0,0 +1,34 @@
+'''
+Checks that AttackRunner resumes a store only for the job that wrote it.
+'''
+import pytest
+import torch
+
+from lib.attack_runner import AttackRunner
+
+
+def shift(offset, x, y):
+    return x + offset
+
+
+def test_resume_only_same_job(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    x, y = torch.rand(10, 3), torch.arange(10) % 2
+
+    runner = AttackRunner(shift, store_dir, shard_size=4, context=1.,
+                          seed=0, config={'offset': 1.})
+    x_adv = runner.run(x, y)
+    assert torch.allclose(x_adv, x + 1)
+    # the finished shards are returned as they are
+    assert torch.equal(runner.run(x, y), x_adv)
+
+    # other samples, labels, seed or config
+    jobs = [(x + 1, y, 0, {'offset': 1.}),
+            (x, 1 - y, 0, {'offset': 1.}),
+            (x, y, 1, {'offset': 1.}),
+            (x, y, 0, {'offset': 2.})]
+    for x_job, y_job, seed, config in jobs:
+        runner = AttackRunner(shift, store_dir, shard_size=4, context=1.,
+                              seed=seed, config=config)
+        with pytest.raises(ValueError):
+            runner.run(x_job, y_job)
@@ -0,0 +1,63 @@
+'''
+Checks of the chunked execution of stacked PGD restarts.
+'''
+import torch
+
+from lib.attack_utils import estimate_max_batch, run_chunked
+from lib.pgd_attack import PGDAttack
+
+
+class SmallMemoryNet(torch.nn.Module):
+    """Linear model that runs out of memory on batches of more than
+    <max_rows> rows once it has been called <calls> times"""
+
+    def __init__(self, max_rows, calls):
+        super(SmallMemoryNet, self).__init__()
+        self.fc = torch.nn.Linear(4, 3)
+        self.max_rows = max_rows
+        self.calls = calls
+
+    def forward(self, x):
+        self.calls -= 1
+        if x.size(0) > self.max_rows and self.calls < 0:
+            raise RuntimeError('CUDA out of memory (simulated)')
+        return self.fc(x)
+
+
+def test_retried_chunks_are_committed_once():
+    calls, committed = [], []
+
+    def fn(begin, end):
+        calls.append((begin, end))
+        if end - begin > 3:
+            raise RuntimeError('CUDA out of memory (simulated)')
+        return end - begin
+
+    run_chunked(fn, lambda begin, end, n: committed.append((begin, end, n)),
+                10)
+    # chunks of 10 and 5 rows run out of memory
+    assert calls[:2] == [(0, 10), (0, 5)]
+    assert [c[:2] for c in committed] == [(0, 2), (2, 4), (4, 6), (6, 8),
+                                          (8, 10)]
+    assert sum(c[2] for c in committed) == 10
+
+
+def test_estimate_max_batch_cpu():
+    # no memory limit on the CPU, the probe is not run
+    def probe(num):
+        raise AssertionError
+
+    assert estimate_max_batch(probe, 100, 'cpu') == 100
+
+
+def test_pgd_chunk_out_of_memory():
+    torch.manual_seed(0)
+    x, y = torch.rand(5, 4), torch.arange(5) % 3
+    # the stack of 2 * 5 rows runs out of memory after 10 steps and is run
+    # again in chunks of 5 rows
+    net = SmallMemoryNet(max_rows=5, calls=10)
+    net.requires_grad_(False)
+    attack = PGDAttack()
+    x_adv = attack(net, x, y, max_iterations=20, num_restart=2)
+    assert attack.stats['steps'] == attack.stats['max_steps'] == 2 * 5 * 20
+    assert (x_adv - x).abs().max() <= 0.3 + 1e-6
@@ -0,0 +1,88 @@
+'''
+Checks of the micro-batching shared by the DkNN server and the Foolbox model.
+'''
+import asyncio
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+import torch
+
+from lib.batching import MicroBatcher
+from lib.dknn import DKNNL2
+from lib.dknn_server import DkNNServer
+
+
+def test_outputs_go_to_their_request():
+    def process(x):
+        if (x < 0).any():
+            raise ValueError('negative sample')
+        return x * 2, x.sum(1)
+
+    batcher = MicroBatcher(process, max_batch=8, max_wait=0.05)
+    results = {}
+
+    def submit(i, num):
+        done = threading.Event()
+
+        def callback(output, error):
+            results[i] = (output, error)
+            done.set()
+
+        batcher.submit(np.zeros((num, 2)) + i, callback)
+        done.wait()
+
+    threads = [threading.Thread(target=submit, args=(i, 1 + i % 3))
+               for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+
+    for i in range(10):
+        (double, total), error = results[i]
+        assert error is None
+        assert (double == 2 * i).all() and double.shape == (1 + i % 3, 2)
+        assert (total == 2 * i).all()
+    stats = batcher.stats()
+    assert stats['requests'] == 10
+    assert stats['samples'] == sum(1 + i % 3 for i in range(10))
+    assert stats['batches'] < 10
+
+
+def test_server_matches_classify():
+    rng = np.random.RandomState(0)
+    x_train = torch.tensor(rng.randn(60, 2), dtype=torch.float32)
+    y_train = torch.tensor(rng.randint(0, 3, size=60))
+    net = torch.nn.Sequential(OrderedDict([('flat', torch.nn.Flatten())]))
+    dknn = DKNNL2(net, x_train, y_train, x_train[:20], y_train[:20],
+                  ['flat'], k=5, num_classes=3, device='cpu')
+    x_test = torch.tensor(rng.randn(12, 2), dtype=torch.float32)
+    counts = dknn.classify(x_test)
+    cred = dknn.credibility(counts)
+
+    loop = asyncio.new_event_loop()
+    server = DkNNServer(dknn, max_batch=4, max_wait=0.01)
+
+    async def run():
+        await server.start()
+        try:
+            outputs = await asyncio.gather(
+                *[server.predict(x) for x in x_test])
+            with pytest.raises(Exception):
+                await server.predict(torch.zeros(3))
+            return outputs
+        finally:
+            await server.stop()
+
+    try:
+        outputs = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    for i, output in enumerate(outputs):
+        assert output['label'] == counts[i].argmax()
+        assert (output['counts'] == counts[i]).all()
+        assert output['credibility'] == pytest.approx(cred[i])
+    assert server.stats()['batches'] < len(x_test)
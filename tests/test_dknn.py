@@ -0,0 +1,200 @@
+'''
+Checks of DKNNL2 on small 2-D toy sets, where the representation is the
+input itself so that perturbations can be searched exhaustively.
+'''
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from lib.dknn import DKNNL2
+from lib.dknn_attack_l2 import DKNNL2Attack
+
+
+def toy_dknn(x_train, y_train, k, num_classes):
+    """DKNNL2 with a single 'flat' layer that is the identity on 2-D
+    inputs"""
+    net = torch.nn.Sequential(OrderedDict([('flat', torch.nn.Flatten())]))
+    return DKNNL2(net, x_train, y_train, x_train[:10], y_train[:10],
+                  ['flat'], k=k, num_classes=num_classes, device='cpu')
+
+
+def toy_set(seed, num_classes=3, num_per_class=15):
+    """Clusters of samples of each class, with the rival clusters close
+    together"""
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(-1, 1, size=(num_classes, 2))
+    x = np.concatenate([c + 0.4 * rng.randn(num_per_class, 2)
+                        for c in centers])
+    y = np.repeat(np.arange(num_classes), num_per_class)
+    return torch.tensor(x, dtype=torch.float32), torch.tensor(y)
+
+
+def disk(radius, num_angles=360, num_radii=10):
+    """Grid of perturbations of L-2 norm at most <radius>"""
+    angles = np.linspace(0, 2 * np.pi, num_angles, endpoint=False)
+    radii = np.linspace(0, radius, num_radii + 1)[1:]
+    grid = np.stack([np.outer(radii, np.cos(angles)).ravel(),
+                     np.outer(radii, np.sin(angles)).ravel()], 1)
+    return torch.tensor(grid, dtype=torch.float32)
+
+
+def test_vote_bounds_brute_force():
+    k, num_classes = 5, 3
+    for seed in range(5):
+        x_train, y_train = toy_set(seed)
+        dknn = toy_dknn(x_train, y_train, k, num_classes)
+        x_test, _ = toy_set(seed + 100, num_per_class=4)
+        label = dknn.classify(x_test).argmax(1)
+        neighbors = [dknn._sorted_neighbors(
+            dknn.indices[0], x_test.numpy(), k) + (1., )]
+        for eps in [0.05, 0.1, 0.2, 0.4]:
+            lower, upper = dknn._vote_bounds(
+                neighbors, label, np.zeros((len(label), )) + eps, k)
+            for i in range(len(label)):
+                counts = dknn.classify(x_test[i] + disk(eps))
+                assert (counts[:, label[i]] >= lower[i]).all()
+                rival = np.arange(num_classes) != label[i]
+                assert (counts[:, rival] <= upper[i, rival]).all()
+
+
+def test_certified_radius_brute_force():
+    k, num_classes = 5, 3
+    for seed in range(5):
+        x_train, y_train = toy_set(seed)
+        dknn = toy_dknn(x_train, y_train, k, num_classes)
+        x_test, _ = toy_set(seed + 100, num_per_class=4)
+        label = torch.tensor(dknn.classify(x_test).argmax(1))
+        radius, _ = dknn.certify_knn(x_test, label, [0.1], k=k)
+        for i in np.where(radius > 0)[0]:
+            counts = dknn.classify(x_test[i] + disk(0.999 * radius[i]))
+            assert (counts.argmax(1) == label[i].item()).all()
+
+
+def test_rival_class_pulled_in():
+    # class 3 wins with 2 votes against 1 for classes 0, 1 and 2. Moving
+    # towards (1, 0) brings in the second sample of class 0 in place of the
+    # one of class 2, and class 0 wins the tie. A bound that pulls in the
+    # samples of all classes at once misses this and certifies a radius of
+    # 0.3, the radius is 0.04
+    x_train = torch.tensor([[0., .5], [0., -.5], [1., 0.], [1.1, 0.],
+                            [-1., 0.], [0., 1.02]])
+    y_train = torch.tensor([3, 3, 0, 0, 1, 2])
+    dknn = toy_dknn(x_train, y_train, 5, 4)
+    x = torch.zeros((1, 2))
+    label = torch.tensor([3])
+    radius, curve = dknn.certify_knn(x, label, [0.03, 0.1], k=5)
+    assert abs(radius[0] - 0.04) < 1e-3
+    assert curve.tolist() == [1, 0]
+    assert (dknn.classify(x + torch.tensor([[0.1, 0.]])).argmax(1) == 0).all()
+
+
+def test_removed_samples_never_used():
+    k, num_classes = 5, 3
+    x_train, y_train = toy_set(0)
+    dknn = toy_dknn(x_train, y_train, k, num_classes)
+    # faiss pads with id -1, which indexes the last rows
+    removed = np.arange(len(x_train) - 10, len(x_train))
+    dknn.remove_training_samples(removed)
+    x_test, y_test = toy_set(100, num_per_class=4)
+
+    nn = dknn.find_nn_diff_class(x_test, y_test)
+    assert not np.isin(nn, removed).any()
+    assert (y_train[nn.astype(np.int64)] != y_test).all()
+
+    guides = DKNNL2Attack.find_guide_samples(
+        dknn, x_test, y_test.numpy(), k=k, layer='flat')
+    x_removed = x_train[removed]
+    dist = ((guides.reshape(-1, 1, 2) - x_removed.view(1, -1, 2))**2).sum(2)
+    assert (dist > 0).all()
+
+    # fewer training samples than k
+    dknn.remove_training_samples(np.arange(len(x_train) - 12))
+    dknn.k = 10
+    counts = dknn.classify(x_test)
+    assert (counts.sum(1) == 2).all()
+    assert (dknn.predict(x_test[0]) == counts[0].argmax())
+
+
+def test_predict_shares_classify_cache():
+    x_train, y_train = toy_set(0)
+    net = torch.nn.Sequential(OrderedDict([('flat', torch.nn.Flatten())]))
+    dknn = DKNNL2(net, x_train, y_train, x_train[:10], y_train[:10],
+                  ['flat'], k=5, num_classes=3, device='cpu', cache_size=100)
+    x_test, _ = toy_set(100, num_per_class=4)
+    dknn.reset_cache_stats()
+    counts = dknn.classify(x_test)
+    labels = [dknn.predict(x) for x in x_test]
+    assert (np.array(labels) == counts.argmax(1)).all()
+    stats = dknn.cache_stats()
+    assert stats['queries'] == 2 * len(x_test)
+    assert stats['hits'] == len(x_test)
+
+    # samples first seen by predict are cached for classify
+    dknn.clear_cache()
+    dknn.predict(x_test[0], early_stop=False)
+    dknn.classify(x_test[:2])
+    assert dknn.cache_stats()['hits'] == len(x_test) + 1
+
+
+def test_pipelined_matches_unpipelined():
+    torch.manual_seed(0)
+    x_train, y_train = toy_set(0)
+    net = torch.nn.Sequential(OrderedDict([('flat', torch.nn.Flatten()),
+                                           ('fc', torch.nn.Linear(2, 4))]))
+    dknn = DKNNL2(net, x_train, y_train, x_train[:10], y_train[:10],
+                  ['flat', 'fc'], k=5, num_classes=3, device='cpu')
+    x_test, _ = toy_set(100, num_per_class=10)
+    with torch.no_grad():
+        counts = dknn.classify(x_test)
+        neighbors = dknn.get_neighbors(x_test)
+        # the last batch is ragged except for batch sizes 1 and 30
+        for batch_size in [1, 7, 16, 30, 64]:
+            for num_threads in [1, 3]:
+                assert (dknn.classify_pipelined(
+                    x_test, batch_size=batch_size,
+                    num_threads=num_threads, max_pending=2) == counts).all()
+                output = dknn.get_neighbors_pipelined(
+                    x_test, batch_size=batch_size, num_threads=num_threads,
+                    max_pending=2)
+                assert len(output) == len(neighbors)
+                for (D, I), (D_ref, I_ref) in zip(output, neighbors):
+                    assert (I == I_ref).all()
+                    assert np.allclose(D, D_ref)
+
+
+def test_credibility_after_calibration_updates():
+    k, num_classes = 5, 3
+    x_train, y_train = toy_set(0)
+    x_cal, y_cal = toy_set(200, num_per_class=10)
+    x_test, _ = toy_set(100, num_per_class=10)
+    net = torch.nn.Sequential(OrderedDict([('flat', torch.nn.Flatten())]))
+
+    def check(dknn, x_cal, y_cal):
+        fresh = DKNNL2(net, x_train, y_train, x_cal, y_cal, ['flat'], k=k,
+                       num_classes=num_classes, device='cpu')
+        counts = dknn.classify(x_test)
+        cred = dknn.credibility(counts)
+        assert np.allclose(cred, fresh.credibility(counts))
+        # same as counting the calibration scores directly
+        alpha = k - counts.max(1)
+        assert np.allclose(cred, [(fresh.A >= a).mean() for a in alpha])
+
+    dknn = DKNNL2(net, x_train, y_train, x_cal[:10], y_cal[:10], ['flat'],
+                  k=k, num_classes=num_classes, device='cpu')
+    ids = dknn.add_calibration_samples(x_cal[10:], y_cal[10:])
+    check(dknn, x_cal, y_cal)
+
+    keep = np.ones((len(x_cal), ), dtype=bool)
+    keep[[0, 3, 4]] = False
+    keep[ids[::3]] = False
+    dknn.remove_calibration_samples(np.concatenate([[0, 3, 4], ids[::3]]))
+    check(dknn, x_cal[torch.from_numpy(keep)], y_cal[torch.from_numpy(keep)])
+
+    # sliding window over a stream of new samples
+    x_new, y_new = toy_set(300, num_per_class=5)
+    dknn.calibrate_stream(x_new[:9], y_new[:9], window=20)
+    dknn.calibrate_stream(x_new[9:], y_new[9:], window=20)
+    x_window = torch.cat([x_cal[torch.from_numpy(keep)], x_new])[-20:]
+    y_window = torch.cat([y_cal[torch.from_numpy(keep)], y_new])[-20:]
+    check(dknn, x_window, y_window)
@@ -0,0 +1,38 @@
+'''
+Check ExactNNAttack against a brute-force search on a 2-D toy set.
+'''
+import numpy as np
+import torch
+
+from lib.nn_attack import ExactNNAttack
+
+
+def test_exact_attack_brute_force():
+    rng = np.random.RandomState(0)
+    x_train = torch.tensor(rng.uniform(-1, 1, size=(40, 2)),
+                           dtype=torch.float32)
+    y_train = torch.tensor(rng.randint(0, 3, size=40))
+    x = torch.tensor(rng.uniform(-1, 1, size=(20, 2)), dtype=torch.float32)
+    dist = ((x.unsqueeze(1) - x_train.unsqueeze(0))**2).sum(2)
+    label = y_train[dist.argmin(1)]
+
+    attack = ExactNNAttack(x_train, y_train)
+    x_adv, d, exact = attack(x, label, m=5, qp_steps=5000, tol=1e-5)
+    assert exact.all()
+
+    # the adversarial examples are (at the boundary of being) misclassified
+    # and no point of a fine grid closer to x is misclassified
+    grid = np.stack(np.meshgrid(np.linspace(-2, 2, 801),
+                                np.linspace(-2, 2, 801)), -1).reshape(-1, 2)
+    grid = torch.tensor(grid, dtype=torch.float32)
+    pred = y_train[torch.cdist(grid, x_train).argmin(1)]
+    for i in range(x.size(0)):
+        assert abs((x_adv[i] - x[i]).norm() - d[i]) < 1e-4
+        wrong = pred != label[i]
+        d_grid = (grid[wrong] - x[i]).norm(dim=1).min()
+        assert d[i] <= d_grid + 1e-4
+        assert d[i] >= d_grid - 2 * 4 / 800
+
+    # projections stopped long before convergence are reported
+    _, _, exact = attack(x, label, m=5, qp_steps=1, tol=1e-5)
+    assert not exact.all()
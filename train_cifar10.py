@@ -12,59 +12,9 @@ import torch.optim as optim
 
 from lib.cifar_resnet import *
 from lib.dataset_utils import *
-
-
-def evaluate(net, dataloader, criterion, device):
-
-    net.eval()
-    val_loss = 0
-    val_correct = 0
-    val_total = 0
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(dataloader):
-            inputs, targets = inputs.to(device), targets.to(device)
-            outputs = net(inputs)
-            loss = criterion(outputs, targets)
-            val_loss += loss.item()
-            _, predicted = outputs.max(1)
-            val_total += targets.size(0)
-            val_correct += predicted.eq(targets).sum().item()
-
-    return val_loss / val_total, val_correct / val_total
-
-
-def train(net, trainloader, validloader, criterion, optimizer, epoch, device,
-          log, save_best_only=True, best_acc=0, model_path='./model.pt'):
-
-    net.train()
-    train_loss = 0
-    train_correct = 0
-    train_total = 0
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), targets.to(device)
-        optimizer.zero_grad()
-        outputs = net(inputs)
-        loss = criterion(outputs, targets)
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss.item()
-        _, predicted = outputs.max(1)
-        train_total += targets.size(0)
-        train_correct += predicted.eq(targets).sum().item()
-
-    val_loss, val_acc = evaluate(net, validloader, criterion, device)
-
-    log.info(' %5d | %.4f, %.4f | %8.4f, %7.4f', epoch,
-             train_loss / train_total, train_correct / train_total,
-             val_loss, val_acc)
-
-    # Save model weights
-    if not save_best_only or (save_best_only and val_acc > best_acc):
-        log.info('Saving model...')
-        torch.save(net.state_dict(), model_path)
-        best_acc = val_acc
-    return best_acc
+from lib.distributed import (cleanup_distributed, init_distributed,
+                             is_main_process, launched_distributed, wrap_ddp)
+from lib.trainer import Trainer, classification_step
 
 
 def main():
@@ -89,11 +39,17 @@ def main():
     np.random.seed(seed)
     torch.manual_seed(seed)
 
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # run with torchrun to train with DistributedDataParallel, one process
+    # per GPU or several processes per CPU node (gloo backend)
+    distributed = launched_distributed()
+    if distributed:
+        device = init_distributed()
+    else:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
     # Set up model directory
     save_dir = os.path.join(os.getcwd(), 'saved_models')
-    if not os.path.isdir(save_dir):
+    if is_main_process() and not os.path.isdir(save_dir):
         os.makedirs(save_dir)
     model_path = os.path.join(save_dir, model_name + '.h5')
 
@@ -104,11 +60,12 @@ def main():
     # Create formatter and add it to the handlers
     formatter = logging.Formatter(
         '[%(levelname)s %(asctime)s %(name)s] %(message)s')
-    # Create file handler
-    fh = logging.FileHandler(log_file, mode='w')
-    fh.setLevel(logging.DEBUG)
-    fh.setFormatter(formatter)
-    log.addHandler(fh)
+    if is_main_process():
+        # Create file handler (on the main process only)
+        fh = logging.FileHandler(log_file, mode='w')
+        fh.setLevel(logging.DEBUG)
+        fh.setFormatter(formatter)
+        log.addHandler(fh)
 
     log.info(log_file)
     log.info(('CIFAR10 | exp_id: {}, seed: {}, init_learning_rate: {}, ' +
@@ -118,20 +75,19 @@ def main():
                   epochs, data_augmentation, subtract_pixel_mean))
 
     log.info('Preparing data...')
-    trainloader, validloader, testloader = load_cifar10(batch_size,
-                                                        data_dir='/data',
-                                                        val_size=0.1,
-                                                        normalize=False,
-                                                        augment=True,
-                                                        shuffle=True,
-                                                        seed=seed)
+    trainloader, validloader, testloader = load_cifar10(
+        batch_size, data_dir='/data', val_size=0.1, normalize=False,
+        augment=True, shuffle=True, seed=seed, distributed=distributed)
 
     log.info('Building model...')
     # net = ResNet(BasicBlock, [2, 2, 2, 2])
     net = PreActResNet(PreActBlock, [2, 2, 2, 2])
     net = net.to(device)
-    if device == 'cuda':
+    if distributed:
+        net = wrap_ddp(net, device)
+    elif device == 'cuda':
         net = torch.nn.DataParallel(net)
+    if device.startswith('cuda'):
         cudnn.benchmark = True
 
     criterion = nn.CrossEntropyLoss()
@@ -140,16 +96,14 @@ def main():
     lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(
         optimizer, [50, 70, 90], gamma=0.1)
 
-    log.info(' epoch | loss  , acc    | val_loss, val_acc')
-    best_acc = 0
-    for epoch in range(epochs):
-        lr_scheduler.step()
-        best_acc = train(net, trainloader, validloader, criterion, optimizer,
-                         epoch, device, log, save_best_only=True,
-                         best_acc=best_acc, model_path=model_path)
+    trainer = Trainer(net, optimizer, classification_step(criterion),
+                      device=device, lr_scheduler=lr_scheduler, log=log,
+                      model_path=model_path, monitor='val_acc', mode='max')
+    trainer.fit(trainloader, validloader, epochs)
 
-    test_loss, test_acc = evaluate(net, testloader, criterion, device)
+    test_loss, test_acc = trainer.evaluate(testloader)
     log.info('Test loss: %.4f, Test acc: %.4f', test_loss, test_acc)
+    cleanup_distributed()
 
 
 if __name__ == '__main__':
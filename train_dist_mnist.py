@@ -12,54 +12,15 @@ import torch.optim as optim
 
 from lib.dataset_utils import *
 from lib.lip_model import *
+from lib.trainer import Trainer
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "1"
 
 
-def evaluate(net, dataloader, device):
-
-    net.eval()
-    val_loss = 0
-    val_total = 0
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(dataloader):
-            inputs, targets = inputs.to(device), targets.to(device)
-            outputs = net(inputs)
-            loss = net.loss_function(outputs, targets)
-            val_loss += loss.item()
-            val_total += targets.size(0)
-
-    return val_loss / val_total
-
-
-def train(net, trainloader, validloader, optimizer, epoch, device,
-          log, save_best_only=True, best_loss=0, model_path='./model.pt'):
-
-    net.train()
-    train_loss = 0
-    train_total = 0
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), targets.to(device)
-        optimizer.zero_grad()
-        outputs = net(inputs)
-        loss = net.loss_function(outputs, targets)
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss.item()
-        train_total += targets.size(0)
-
-    val_loss = evaluate(net, validloader, device)
-
-    log.info(' %5d | %.4f | %.4f', epoch, train_loss / train_total, val_loss)
-
-    # Save model weights
-    if not save_best_only or (save_best_only and val_loss < best_loss):
-        log.info('Saving model...')
-        torch.save(net.state_dict(), model_path)
-        best_loss = val_loss
-    return best_loss
+def step(net, inputs, targets):
+    outputs = net(inputs)
+    return net.loss_function(outputs, targets), None
 
 
 def main():
@@ -129,20 +90,17 @@ def main():
     net.load_state_dict(torch.load('saved_models/dist_mnist_exp24.h5'))
 
     optimizer = optim.Adam(net.parameters(), lr=learning_rate)
+    lr_scheduler = None
     if use_schedule:
         lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(
             optimizer, [100, 150], gamma=0.1)
 
-    log.info(' epoch | loss  | v_loss')
-    best_loss = 1e9
-    for epoch in range(epochs):
-        if use_schedule:
-            lr_scheduler.step()
-        best_loss = train(net, trainloader, validloader, optimizer,
-                          epoch, device, log, save_best_only=True,
-                          best_loss=best_loss, model_path=model_path)
+    trainer = Trainer(net, optimizer, step, device=device,
+                      lr_scheduler=lr_scheduler, log=log,
+                      model_path=model_path, monitor='val_loss', mode='min')
+    trainer.fit(trainloader, validloader, epochs)
 
-    test_loss = evaluate(net, testloader, device)
+    test_loss, _ = trainer.evaluate(testloader)
     log.info('Test loss: %.4f', test_loss)
 
 
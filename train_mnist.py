@@ -13,64 +13,12 @@ import torch.optim as optim
 from lib.dataset_utils import *
 from lib.lip_model import *
 from lib.mnist_model import *
+from lib.trainer import Trainer, classification_step
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "1"
 
 
-def evaluate(net, dataloader, criterion, device):
-
-    net.eval()
-    val_loss = 0
-    val_correct = 0
-    val_total = 0
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(dataloader):
-            inputs, targets = inputs.to(device), targets.to(device)
-            outputs = net(inputs)
-            loss = criterion(outputs, targets)
-            val_loss += loss.item()
-            _, predicted = outputs.max(1)
-            val_total += targets.size(0)
-            val_correct += predicted.eq(targets).sum().item()
-
-    return val_loss / val_total, val_correct / val_total
-
-
-def train(net, trainloader, validloader, criterion, optimizer, epoch, device,
-          log, save_best_only=True, best_acc=0, model_path='./model.pt'):
-
-    net.train()
-    train_loss = 0
-    train_correct = 0
-    train_total = 0
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), targets.to(device)
-        optimizer.zero_grad()
-        outputs = net(inputs)
-        loss = criterion(outputs, targets)
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss.item()
-        _, predicted = outputs.max(1)
-        train_total += targets.size(0)
-        train_correct += predicted.eq(targets).sum().item()
-
-    val_loss, val_acc = evaluate(net, validloader, criterion, device)
-
-    log.info(' %5d | %.4f, %.4f | %8.4f, %7.4f', epoch,
-             train_loss / train_total, train_correct / train_total,
-             val_loss, val_acc)
-
-    # Save model weights
-    if not save_best_only or (save_best_only and val_acc > best_acc):
-        log.info('Saving model...')
-        torch.save(net.state_dict(), model_path)
-        best_acc = val_acc
-    return best_acc
-
-
 def main():
 
     # Set experiment id
@@ -139,14 +87,12 @@ def main():
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.Adam(net.parameters(), lr=learning_rate)
 
-    log.info(' epoch | loss  , acc    | val_loss, val_acc')
-    best_acc = 0
-    for epoch in range(epochs):
-        best_acc = train(net, trainloader, validloader, criterion, optimizer,
-                         epoch, device, log, save_best_only=True,
-                         best_acc=best_acc, model_path=model_path)
+    step = classification_step(criterion)
+    trainer = Trainer(net, optimizer, step, device=device, log=log,
+                      model_path=model_path, monitor='val_acc', mode='max')
+    trainer.fit(trainloader, validloader, epochs)
 
-    test_loss, test_acc = evaluate(net, testloader, criterion, device)
+    test_loss, test_acc = trainer.evaluate(testloader)
     log.info('Test loss: %.4f, Test acc: %.4f', test_loss, test_acc)
 
 
@@ -11,52 +11,7 @@ import torch.optim as optim
 
 from lib.dataset_utils import *
 from lib.mnist_model import *
-
-
-def evaluate(net, dataloader, device):
-
-    net.eval()
-    val_loss = 0
-    val_total = 0
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(dataloader):
-            inputs, targets = inputs.to(device), targets.to(device)
-            en_mu, en_logvar, out = net(inputs)
-            loss = loss_function(inputs, en_mu, en_logvar, out)
-            val_loss += loss.item()
-            val_total += targets.size(0)
-
-    return val_loss / val_total
-
-
-def train(net, trainloader, validloader, optimizer, epoch, device,
-          log, save_best_only=True, best_loss=np.inf, model_path='./model.pt'):
-
-    net.train()
-    train_loss = 0
-    train_total = 0
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), targets.to(device)
-        optimizer.zero_grad()
-        en_mu, en_logvar, out = net(inputs)
-        loss = loss_function(inputs, en_mu, en_logvar, out)
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss.item()
-        train_total += targets.size(0)
-
-    val_loss = evaluate(net, validloader, device)
-
-    log.info(' %5d | %.4f, %.4f', epoch, train_loss / train_total)
-
-    # Save model weights
-    # if not save_best_only or (save_best_only and val_acc > best_acc):
-    if not save_best_only or (save_best_only and val_loss < best_loss):
-        log.info('Saving model...')
-        torch.save(net.state_dict(), model_path)
-        best_loss = val_loss
-    return best_loss
+from lib.trainer import Trainer
 
 
 def loss_function(x, en_mu, en_logvar, out):
@@ -78,6 +33,11 @@ def loss_function(x, en_mu, en_logvar, out):
     return logprob + beta * kld
 
 
+def step(net, inputs, targets):
+    en_mu, en_logvar, out = net(inputs)
+    return loss_function(inputs, en_mu, en_logvar, out), None
+
+
 def main():
 
     # Set experiment id
@@ -141,19 +101,20 @@ def main():
 
     optimizer = optim.Adam(net.parameters(), lr=learning_rate)
 
-    log.info(' epoch | loss  , acc    | val_loss, val_acc')
-    best_loss = np.inf
-    for epoch in range(epochs):
-        best_loss = train(net, trainloader, validloader, optimizer,
-                          epoch, device, log, save_best_only=True,
-                          best_loss=best_loss, model_path=model_path)
+    def save_samples(trainer, metrics):
         with torch.no_grad():
             z = torch.randn(100, net.module.latent_dim).to(device)
             out = net.module.decode(z)
-            torchvision.utils.save_image(out, 'epoch%d.png' % epoch, 10)
+            torchvision.utils.save_image(
+                out, 'epoch%d.png' % (trainer.epoch - 1), 10)
+
+    trainer = Trainer(net, optimizer, step, device=device,
+                      log=log, model_path=model_path, monitor='val_loss',
+                      mode='min')
+    trainer.fit(trainloader, validloader, epochs, callbacks=[save_samples])
 
-    test_loss, test_acc = evaluate(net, testloader, device)
-    log.info('Test loss: %.4f, Test acc: %.4f', test_loss, test_acc)
+    test_loss, _ = trainer.evaluate(testloader)
+    log.info('Test loss: %.4f', test_loss)
 
 
 if __name__ == '__main__':
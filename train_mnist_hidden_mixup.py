@@ -12,66 +12,14 @@ import torch.optim as optim
 
 from lib.dataset_utils import *
 from lib.mnist_model import *
+from lib.trainer import Trainer, classification_step
 
 
-def evaluate(net, dataloader, device):
-
-    net.eval()
-    val_loss = 0
-    val_correct = 0
-    val_total = 0
-    criterion = nn.CrossEntropyLoss()
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(dataloader):
-            inputs, targets = inputs.to(device), targets.to(device)
-            outputs = net(inputs, mixup_hidden=False)
-            # loss = net.loss_function(outputs, y_a, y_b, lam)
-            loss = criterion(outputs, targets)
-            val_loss += loss.item()
-            _, predicted = outputs.max(1)
-            val_total += targets.size(0)
-            val_correct += predicted.eq(targets).sum().item()
-
-    return val_loss / val_total, val_correct / val_total
-
-
-def train(net, trainloader, validloader, optimizer, epoch, device,
-          log, save_best_only=True, best_acc=0, model_path='./model.pt'):
-
-    net.train()
-    train_loss = 0
-    train_correct = 0
-    train_total = 0
-    # with torch.autograd.detect_anomaly():
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), targets.to(device)
-        optimizer.zero_grad()
-        outputs, y_a, y_b, lam = net(
-            inputs, target=targets, mixup_hidden=True, mixup_alpha=1.0,
-            layer_mix=0)
-        loss = net.loss_function(outputs, y_a, y_b, lam)
-        loss.backward()
-        optimizer.step()
-
-        # print(batch_idx, loss.item())
-
-        train_loss += loss.item()
-        _, predicted = outputs.max(1)
-        train_total += targets.size(0)
-        train_correct += predicted.eq(targets).sum().item()
-
-    val_loss, val_acc = evaluate(net, validloader, device)
-
-    log.info(' %5d | %.4f, %.4f | %8.4f, %7.4f', epoch,
-             train_loss / train_total, train_correct / train_total,
-             val_loss, val_acc)
-
-    # Save model weights
-    if not save_best_only or (save_best_only and val_acc > best_acc):
-        log.info('Saving model...')
-        torch.save(net.state_dict(), model_path)
-        best_acc = val_acc
-    return best_acc
+def step(net, inputs, targets):
+    outputs, y_a, y_b, lam = net(
+        inputs, target=targets, mixup_hidden=True, mixup_alpha=1.0,
+        layer_mix=0)
+    return net.loss_function(outputs, y_a, y_b, lam), outputs
 
 
 def main():
@@ -140,14 +88,14 @@ def main():
 
     optimizer = optim.Adam(net.parameters(), lr=learning_rate)
 
-    log.info(' epoch | loss  , acc    | val_loss, val_acc')
-    best_acc = 0
-    for epoch in range(epochs):
-        best_acc = train(net, trainloader, validloader, optimizer,
-                         epoch, device, log, save_best_only=True,
-                         best_acc=best_acc, model_path=model_path)
+    eval_step = classification_step(nn.CrossEntropyLoss(), mixup_hidden=False)
+    trainer = Trainer(net, optimizer, step, device=device,
+                      log=log, model_path=model_path, monitor='val_acc',
+                      mode='max')
+    trainer.fit(trainloader, validloader, epochs,
+                eval_steps={'val': eval_step})
 
-    test_loss, test_acc = evaluate(net, testloader, device)
+    test_loss, test_acc = trainer.evaluate(testloader, eval_step)
     log.info('Test loss: %.4f, Test acc: %.4f', test_loss, test_acc)
 
 
@@ -11,57 +11,12 @@ import torch.optim as optim
 
 from lib.dataset_utils import *
 from lib.mnist_model import *
+from lib.trainer import Trainer
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "1"
 
 
-def evaluate(net, dataloader, device):
-
-    net.eval()
-    val_loss = 0
-    val_total = 0
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(dataloader):
-            inputs, targets = inputs.to(device), targets.to(device)
-            en_mu, en_logvar, out = net(inputs)
-            loss = loss_function(inputs, en_mu, en_logvar, out)
-            val_loss += loss.item()
-            val_total += targets.size(0)
-
-    return val_loss / val_total
-
-
-def train(net, trainloader, validloader, optimizer, epoch, device,
-          log, save_best_only=True, best_loss=np.inf, model_path='./model.pt'):
-
-    net.train()
-    train_loss = 0
-    train_total = 0
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), targets.to(device)
-        optimizer.zero_grad()
-        en_mu, en_logvar, out = net(inputs)
-        loss = loss_function(inputs, en_mu, en_logvar, out)
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss.item()
-        train_total += targets.size(0)
-
-    val_loss = evaluate(net, validloader, device)
-
-    log.info(' %5d | %.4f | %.4f', epoch, train_loss / train_total, val_loss)
-
-    # Save model weights
-    # if not save_best_only or (save_best_only and val_acc > best_acc):
-    if not save_best_only or (save_best_only and val_loss < best_loss):
-        log.info('Saving model...')
-        torch.save(net.state_dict(), model_path)
-        best_loss = val_loss
-    return best_loss
-
-
 def loss_function(x, en_mu, en_logvar, out):
 
     # constants that balance loss terms
@@ -83,6 +38,11 @@ def loss_function(x, en_mu, en_logvar, out):
     return logprob + beta * kld
 
 
+def step(net, inputs, targets):
+    en_mu, en_logvar, out = net(inputs)
+    return loss_function(inputs, en_mu, en_logvar, out), None
+
+
 def main():
 
     # Set experiment id
@@ -147,18 +107,17 @@ def main():
 
     optimizer = optim.Adam(net.parameters(), lr=learning_rate)
 
-    log.info(' epoch | loss')
-    best_loss = np.inf
-    for epoch in range(epochs):
-        best_loss = train(net, trainloader, validloader, optimizer,
-                          epoch, device, log, save_best_only=True,
-                          best_loss=best_loss, model_path=model_path)
+    trainer = Trainer(net, optimizer, step, device=device,
+                      log=log, model_path=model_path, monitor='val_loss',
+                      mode='min')
+    trainer.fit(trainloader, validloader, epochs)
+    epoch = trainer.epoch - 1
     with torch.no_grad():
         z = torch.randn(100, net.module.latent_dim).to(device)
         out = net.module.decode(z)
         torchvision.utils.save_image(out, 'mnist_vae_epoch%d.png' % epoch, 10)
 
-    test_loss = evaluate(net, testloader, device)
+    test_loss, _ = trainer.evaluate(testloader)
     log.info('Test loss: %.4f', test_loss)
 
 
@@ -13,69 +13,25 @@ import torch.optim as optim
 
 from lib.cifar_resnet import *
 from lib.dataset_utils import *
+from lib.distributed import (cleanup_distributed, init_distributed,
+                             is_main_process, launched_distributed, wrap_ddp)
 from lib.nin import *
+from lib.trainer import Trainer
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
 
-def evaluate(net, dataloader, device):
-
-    # net.eval()
-    net.fc.training = False
-    val_loss = 0
-    val_total = 0
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(dataloader):
-            inputs, targets = inputs.to(device), targets.to(device)
-            outputs = net(inputs)
-            loss = loss_function(outputs, targets)
-            val_loss += loss.item()
-            val_total += targets.size(0)
-
-    return val_loss / val_total
-
-
-def train(net, trainloader, validloader, optimizer, epoch, device,
-          log, save_best_only=True, best_loss=1e9, model_path='./model.pt'):
-
-    # net.train()
-    net.fc.training = True
-    train_loss = 0
-    train_total = 0
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), targets.to(device)
-        optimizer.zero_grad()
-        outputs = net(inputs)
-        loss = loss_function(outputs, targets)
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss.item()
-        train_total += targets.size(0)
-
-    val_loss = evaluate(net, validloader, device)
-
-    log.info(' %5d | %.4f | %.4f', epoch, train_loss / train_total, val_loss)
-
-    # Save model weights
-    if not save_best_only or (save_best_only and val_loss < best_loss):
-        log.info('Saving model...')
-        torch.save(net.state_dict(), model_path)
-        best_loss = val_loss
-    return best_loss
-
-
 def loss_function(outputs, targets):
 
     batch_size = outputs.size(0)
-    loss = torch.zeros(1).cuda()
+    loss = torch.zeros(1, device=outputs.device)
     for i in range(batch_size):
         mask_same = (targets[i] == targets).type(torch.float32)
         # if mask_same.sum() == 1:
         #     break
         mask_diff = (targets[i] != targets).type(torch.float32)
-        mask_self = torch.ones(batch_size).cuda()
+        mask_self = torch.ones(batch_size, device=outputs.device)
         mask_self[i] = 0
         dist = ((outputs[i] - outputs) ** 2).sum(1)
         # upper bound distance to prevent overflow
@@ -85,7 +41,7 @@ def loss_function(outputs, targets):
         #                   torch.sum(mask_self * exp))
         if mask_diff.sum() > 0:
             loss -= torch.min(torch.min(1e20 * mask_same + dist),
-                              torch.tensor(100.).cuda())
+                              torch.tensor(100., device=outputs.device))
         # additional regularization to pull same class
         const = 1e0
         # exp = torch.exp(- torch.min(dist * self.it.exp(),
@@ -116,6 +72,11 @@ def loss_function(outputs, targets):
     return loss
 
 
+def step(net, inputs, targets):
+    outputs = net(inputs)
+    return loss_function(outputs, targets), None
+
+
 def main():
 
     # Set experiment id
@@ -139,11 +100,17 @@ def main():
     np.random.seed(seed)
     torch.manual_seed(seed)
 
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # run with torchrun to train with DistributedDataParallel, one process
+    # per GPU or several processes per CPU node (gloo backend)
+    distributed = launched_distributed()
+    if distributed:
+        device = init_distributed()
+    else:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
     # Set up model directory
     save_dir = os.path.join(os.getcwd(), 'saved_models')
-    if not os.path.isdir(save_dir):
+    if is_main_process() and not os.path.isdir(save_dir):
         os.makedirs(save_dir)
     model_path = os.path.join(save_dir, model_name + '.h5')
 
@@ -154,11 +121,12 @@ def main():
     # Create formatter and add it to the handlers
     formatter = logging.Formatter(
         '[%(levelname)s %(asctime)s %(name)s] %(message)s')
-    # Create file handler
-    fh = logging.FileHandler(log_file, mode='w')
-    fh.setLevel(logging.DEBUG)
-    fh.setFormatter(formatter)
-    log.addHandler(fh)
+    if is_main_process():
+        # Create file handler (on the main process only)
+        fh = logging.FileHandler(log_file, mode='w')
+        fh.setLevel(logging.DEBUG)
+        fh.setFormatter(formatter)
+        log.addHandler(fh)
 
     log.info(log_file)
     log.info(('CIFAR-10 | exp_id: {}, seed: {}, init_learning_rate: {}, ' +
@@ -168,13 +136,9 @@ def main():
                   epochs, data_augmentation, subtract_pixel_mean))
 
     log.info('Preparing data...')
-    trainloader, validloader, testloader = load_cifar10(batch_size,
-                                                        data_dir='/data',
-                                                        val_size=0.1,
-                                                        normalize=False,
-                                                        augment=False,
-                                                        shuffle=True,
-                                                        seed=seed)
+    trainloader, validloader, testloader = load_cifar10(
+        batch_size, data_dir='/data', val_size=0.1, normalize=False,
+        augment=False, shuffle=True, seed=seed, distributed=distributed)
 
     log.info('Building model...')
     # net = PreActResNet(PreActBlock, [2, 2, 2, 2])
@@ -211,7 +175,8 @@ def main():
     # net_wrap = net_wrap.to('cuda')
 
     net = PreActResNet(PreActBlock, [2, 2, 2, 2], num_classes=4)
-    net.load_state_dict(torch.load('saved_models/rot_cifar10_exp0.h5'))
+    net.load_state_dict(torch.load('saved_models/rot_cifar10_exp0.h5',
+                                   map_location='cpu'))
     net_wrap = ResNetWrapper(net, block=block, dim=16384)
     for param in net_wrap.parameters():
         param.requires_grad = False
@@ -236,7 +201,9 @@ def main():
             nn.BatchNorm1d(400),
             nn.Linear(400, 128),
         )
-    net_wrap = net_wrap.to('cuda')
+    net_wrap = net_wrap.to(device)
+    if distributed:
+        net_wrap = wrap_ddp(net_wrap, device)
 
     # mean = pickle.load(open('resnet_block3_mean.p', 'rb'))
     # std = pickle.load(open('resnet_block3_std.p', 'rb'))
@@ -252,16 +219,14 @@ def main():
     lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(
         optimizer, [50, 70, 90], gamma=0.1)
 
-    log.info(' epoch | loss | val_loss')
-    best_loss = 1e9
-    for epoch in range(epochs):
-        lr_scheduler.step()
-        best_loss = train(net_wrap, trainloader, validloader, optimizer,
-                          epoch, device, log, save_best_only=True,
-                          best_loss=best_loss, model_path=model_path)
+    trainer = Trainer(net_wrap, optimizer, step, device=device,
+                      lr_scheduler=lr_scheduler, log=log,
+                      model_path=model_path, monitor='val_loss', mode='min')
+    trainer.fit(trainloader, validloader, epochs)
 
-    test_loss = evaluate(net_wrap, testloader, device)
+    test_loss, _ = trainer.evaluate(testloader)
     log.info('Test loss: %.4f', test_loss)
+    cleanup_distributed()
 
 
 if __name__ == '__main__':